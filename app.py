@@ -1,36 +1,294 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, session
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, session, g, has_request_context
 import sqlite3
+import queue
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import threading
 import time
 import requests
 import json
 import os
+import sys
 import hashlib
-from functools import wraps
+import socket
+import uuid
+import atexit
+import base64
+from functools import wraps, lru_cache
+from markupsafe import escape
 import logging
+import logging.handlers
+import heapq
+import string
+import re
+import csv
+import io
+import click
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('app.log'),
-        logging.StreamHandler()
-    ]
-)
+# 日志配置（可通过环境变量覆盖）
+LOG_FILE = os.environ.get('TODO_LOG_FILE', 'app.log')  # 可包含 {pid}，每个进程写自己的文件
+# 文件轮转方式：size 由本进程按大小轮转；external 只在文件被外部 logrotate 移走后重新打开（WatchedFileHandler）。
+# 多进程部署（gunicorn 多 worker）时各进程独立轮转同一个文件会互相覆盖，需使用 external 或在文件名中加 {pid}
+LOG_ROTATION = os.environ.get('TODO_LOG_ROTATION', 'size')
+LOG_LEVEL = os.environ.get('TODO_LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.environ.get('TODO_LOG_LEVELS', '')  # 按模块设置级别，如 "todo.reminder.todo=WARNING,todo.notify=INFO"
+LOG_FILE_FORMAT = os.environ.get('TODO_LOG_FORMAT', 'json')  # 文件日志格式：json 或 text
+LOG_MAX_BYTES = int(os.environ.get('TODO_LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get('TODO_LOG_BACKUPS', '5'))
+LOG_QUEUE_SIZE = 10000
+LOG_SAMPLE_PER_MINUTE = int(os.environ.get('TODO_LOG_SAMPLE_PER_MINUTE', '120'))  # 逐条任务/消息日志每分钟上限
+LOG_TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+class JsonLogFormatter(logging.Formatter):
+    """每条日志输出一行 JSON"""
+    
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage()
+        }
+        if getattr(record, 'suppressed', 0):
+            data["suppressed"] = record.suppressed
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+class LogRateLimitFilter(logging.Filter):
+    """按分钟限制 INFO 及以下日志的条数，超出的丢弃，并在下一条放行的日志上记录省略的条数"""
+    
+    def __init__(self, per_minute):
+        super().__init__()
+        self.per_minute = per_minute
+        self.window = None
+        self.count = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+    
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        minute = int(record.created // 60)
+        with self._lock:
+            if minute != self.window:
+                self.window = minute
+                self.count = 0
+            if self.count >= self.per_minute:
+                self.suppressed += 1
+                return False
+            self.count += 1
+            if self.suppressed:
+                record.suppressed = self.suppressed
+                self.suppressed = 0
+        return True
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """把日志放入队列由后台线程写出，队列满时丢弃而不阻塞调用线程"""
+    
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging():
+    """请求线程和调度线程只把日志放入队列，由 QueueListener 线程写文件（按 LOG_ROTATION 轮转）和控制台"""
+    if LOG_FILE_FORMAT == 'json':
+        file_formatter = JsonLogFormatter()
+    else:
+        file_formatter = logging.Formatter(LOG_TEXT_FORMAT)
+    log_file = LOG_FILE.replace('{pid}', str(os.getpid()))
+    if LOG_ROTATION == 'external':
+        file_handler = logging.handlers.WatchedFileHandler(log_file, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES,
+                                                            backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(file_formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+    
+    queue_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, console_handler,
+                                              respect_handler_level=True)
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(','))):
+        name, _, level = item.partition('=')
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    
+    # 每个任务、每条消息各一行的日志量随任务数增长，限制每分钟条数
+    for name in ('todo.reminder.todo', 'todo.notify.message'):
+        logging.getLogger(name).addFilter(LogRateLimitFilter(LOG_SAMPLE_PER_MINUTE))
+    return queue_handler
+
+log_queue_handler = setup_logging()
+db_logger = logging.getLogger('todo.db')
+notify_logger = logging.getLogger('todo.notify')
+notify_message_logger = logging.getLogger('todo.notify.message')
+reminder_logger = logging.getLogger('todo.reminder')
+reminder_todo_logger = logging.getLogger('todo.reminder.todo')
+web_logger = logging.getLogger('todo.web')
 
 app = Flask(__name__)
 app.secret_key = 'your-super-secret-key-for-sessions-2023'
 
+# 数据库配置（可通过环境变量覆盖）
+app.config['DATABASE'] = os.environ.get('TODO_DB_PATH', 'todolist.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('TODO_DB_POOL_SIZE', '16'))
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('TODO_DB_BUSY_TIMEOUT_MS', '5000'))
+app.config['DB_STATEMENT_CACHE_SIZE'] = 256
+
 # 时区配置
 CHINA_TZ = pytz.timezone('Asia/Shanghai')
 
-# 全局锁和已处理记录，防止并发处理同一任务
+# 全局锁，防止并发处理同一任务（已处理提醒的缓存见 processed_reminders）
 reminder_lock = threading.Lock()
-processed_reminders = set()  # 存储已处理的提醒，格式：task_id_date_hour_minute
-last_check_minute = None  # 记录上次检查的分钟，防止同一分钟内多次执行
+last_check_minute = None  # 上次处理的分钟（中国时间），用于调试页面展示
+
+# 提醒调度：每个任务的下一次触发时间持久化在 todos.next_fire_at（UTC），
+# 内存中用最小堆缓存近期窗口内的触发点，元素格式：(next_fire_at, todo_id)
+FIRE_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+REMINDER_HEAP_WINDOW = timedelta(hours=6)
+reminder_heap = []
+reminder_heap_lock = threading.Lock()
+reminder_heap_window_end = None  # 堆中已加载触发点的时间上限（UTC字符串）
+schedule_rebuild_requested = threading.Event()  # 提醒设置变化后需要重新计算所有任务
+
+# 通知时间按 UTC 分钟存储（todos.notify_utc_minute），记录各时区已换算的 UTC 偏移，夏令时切换后重新换算
+notify_timezone_offsets = {}  # 时区 -> 已换算的偏移分钟数（None 表示尚未检查）
+notify_timezones_loaded_at = None
+NOTIFY_TIMEZONE_RELOAD_SECONDS = 3600
+
+# 每分钟到期的任务按 id 取模分片，由线程池并行处理；本分钟结束前仍未处理的任务保留触发点，下一轮补处理
+REMINDER_SHARDS = int(os.environ.get('TODO_REMINDER_SHARDS', '4'))
+REMINDER_DEADLINE_MARGIN_SECONDS = 1
+REMINDER_MIN_CYCLE_SECONDS = 5  # 本分钟末尾才开始的周期至少有这么多处理时间，不会把全部任务推迟到下一轮
+REMINDER_DUE_BATCH_SIZE = 5000
+REMINDER_EVALUATE_CHUNK_SIZE = 500  # 按任务 id 判断提醒时每条查询的 id 数，低于 SQLite 参数个数上限
+REMINDER_CLAIM_BATCH_SIZE = 200  # 每个事务批量占用的提醒数
+reminder_executor = None
+scheduler_stats = {"cycles": 0, "catch_up_cycles": 0, "deferred_total": 0, "last_cycle": None}  # 调度周期耗时与分片统计
+
+# 调度器租约：多进程部署时只有持有租约的进程运行提醒调度和消息发送
+SCHEDULER_LEASE_NAME = 'reminder_scheduler'
+SCHEDULER_LEASE_TTL_SECONDS = 90
+SCHEDULER_LEASE_RENEW_SECONDS = SCHEDULER_LEASE_TTL_SECONDS / 3  # 心跳线程续约间隔，与调度耗时无关
+SCHEDULER_INSTANCE_TOKEN = uuid.uuid4().hex[:8]
+is_scheduler_leader = False
+background_workers_started = False
+
+# 调度线程按事件唤醒：睡到最早的触发点（最长不超过续约间隔），写入更早的触发点时提前唤醒；
+# 线程停顿或进程重启错过的分钟在补发窗口内按顺序补处理
+SCHEDULER_MAX_SLEEP_SECONDS = SCHEDULER_LEASE_TTL_SECONDS / 3
+SCHEDULER_RETRY_SECONDS = 1
+SCHEDULER_CATCHUP_MINUTES = int(os.environ.get('TODO_SCHEDULER_CATCHUP_MINUTES', '15'))
+SCHEDULER_MAX_CYCLES_PER_WAKE = 100
+REMINDER_CATCHUP_CYCLE_SECONDS = 20
+scheduler_wakeup = threading.Event()
+scheduler_next_wakeup = None  # 调度线程当前睡眠的目标时间（UTC字符串）
+
+# 提醒发件箱（reminder_outbox）：每个触发点预先生成记录，错过的在宽限窗口内分批补发，
+# 发送队列积压时暂停补发，由消息队列按机器人限速慢慢发出
+REMINDER_GRACE_MINUTES = int(os.environ.get('TODO_REMINDER_GRACE_MINUTES', '180'))
+REMINDER_OUTBOX_BATCH_SIZE = int(os.environ.get('TODO_REMINDER_OUTBOX_BATCH', '200'))
+REMINDER_OUTBOX_MAX_QUEUED = 500
+REMINDER_OUTBOX_RETRY_SECONDS = 5
+reminder_outbox_backlog = False
+
+# 归档：完成较久的任务和旧提醒记录分批移到 todos_archive / reminder_logs_archive，
+# 热表只保留近期数据，历史通过 todos_all / reminder_logs_all 视图查询
+ARCHIVE_TODOS_AFTER_DAYS = int(os.environ.get('TODO_ARCHIVE_AFTER_DAYS', '30'))
+REMINDER_LOG_RETENTION_DAYS = 7
+REMINDER_LOG_ARCHIVE_RETENTION_DAYS = int(os.environ.get('TODO_LOG_ARCHIVE_RETENTION_DAYS', '365'))  # 0 表示永久保留
+ARCHIVE_BATCH_SIZE = 500
+
+# 数据保留维护线程：独立于提醒调度（不占用 reminder_lock），只在调度 leader 上每小时执行一次；
+# 按 rowid 范围分批归档/删除，批次之间暂停让出写锁，最后增量 VACUUM 归还空闲页
+MAINTENANCE_INTERVAL_SECONDS = 3600
+MAINTENANCE_START_DELAY_SECONDS = 60
+RETENTION_BATCH_PAUSE_SECONDS = 0.05
+INCREMENTAL_VACUUM_PAGES = 1000
+last_retention_report = None  # 最近一次数据保留任务的报告（调试页面展示）
+
+# 企业微信消息发送队列（notification_queue 表），由后台工作线程池异步发送
+NOTIFY_WORKERS = int(os.environ.get('TODO_NOTIFY_WORKERS', '8'))
+NOTIFY_PER_ROBOT_CONCURRENCY = int(os.environ.get('TODO_NOTIFY_PER_ROBOT', '2'))
+NOTIFY_MAX_INFLIGHT = NOTIFY_WORKERS * 2
+NOTIFY_MAX_ATTEMPTS = 5
+NOTIFY_BACKOFF_BASE_SECONDS = 5
+NOTIFY_BACKOFF_MAX_SECONDS = 600
+NOTIFY_CLAIM_TIMEOUT_SECONDS = 300
+notification_wakeup = threading.Event()
+notification_state_lock = threading.Lock()
+notification_inflight = {}  # robot_id -> 正在发送的消息数
+notification_executor = None
+
+# 企业微信群机器人限流与提醒合并
+WECOM_RATE_LIMIT_PER_MINUTE = int(os.environ.get('TODO_WECOM_RATE_LIMIT', '20'))
+WECOM_MESSAGE_MAX_BYTES = {'text': 2048, 'markdown': 4096}
+WECOM_NEWS_MAX_ARTICLES = 8
+WECOM_NEWS_TITLE_MAX_BYTES = 128
+WECOM_NEWS_DESCRIPTION_MAX_BYTES = 512
+REMINDER_COALESCE = os.environ.get('TODO_REMINDER_COALESCE', '1') == '1'  # 同一分钟同一机器人的提醒合并为一条
+REMINDER_DIGEST_MSGTYPE = os.environ.get('TODO_REMINDER_DIGEST_MSGTYPE', 'text')
+robot_rate_limiters = {}  # robot_id -> TokenBucket
+
+# 机器人和提醒设置的进程内缓存，每秒最多检查一次数据库中的版本号
+CACHE_VERSION_CHECK_INTERVAL = 1.0
+
+# 首页任务列表分页
+TODO_PAGE_SIZE = 50
+TODO_PAGE_SIZE_MAX = 200
+TODO_COUNT_ESTIMATE_LIMIT = 1000
+
+# 任务搜索：todos_fts（FTS5 trigram）由触发器与 todos 同步，少于 3 个字符的词退回 LIKE
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_RESULTS = 1000
+SEARCH_MIN_TERM_CHARS = 3
+SEARCH_MAX_TERMS = 8
+SEARCH_TERM_MAX_CHARS = 64
+SEARCH_SNIPPET_TOKENS = 32
+SEARCH_ARCHIVED_ERROR = "搜索不支持 archived=1（已归档的任务不在全文索引中）"
+SEARCH_MARK_START, SEARCH_MARK_END = '\x02', '\x03'  # 高亮标记字符，转义 HTML 后再替换为 <mark>
+todo_search_fts = None  # 数据库是否有 todos_fts（首次搜索时检测）
+
+# 提醒调试接口分页
+DEBUG_REMINDERS_PAGE_SIZE = 200
+DEBUG_REMINDERS_PAGE_SIZE_MAX = 1000
+
+# JSON API 单次批量操作的上限
+API_BATCH_MAX = 5000
+
+# 数据导出/导入：按块读取和分批事务写入，内存占用与数据量无关
+EXPORT_FETCH_SIZE = 1000
+EXPORT_FLUSH_BYTES = 64 * 1024
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 20
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = {
+    'todos': ['id', 'title', 'description', 'due_date', 'priority', 'status', 'created_at', 'reminder_sent',
+              'robot_id', 'notification_time', 'last_notification_date', 'timezone', 'completed_at'],
+    'reminder_logs': ['id', 'todo_id', 'reminder_key', 'reminder_type', 'days_before', 'sent_at', 'status'],
+}
+
+# /metrics 访问令牌（为空时不校验）
+METRICS_TOKEN = os.environ.get('TODO_METRICS_TOKEN', '')
+
+# 共享 HTTP 会话，复用到企业微信的长连接
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=NOTIFY_WORKERS))
 
 def get_china_time():
     """获取中国时间"""
@@ -40,6 +298,28 @@ def get_server_time():
     """获取服务器时间"""
     return datetime.now()
 
+@lru_cache(maxsize=256)
+def get_timezone(name):
+    """获取时区对象（缓存，避免每个任务重复构造）"""
+    return pytz.timezone(name)
+
+def compute_notify_utc_minute(notification_time, timezone, now_utc=None):
+    """把任务时区的通知时间按当前 UTC 偏移换算成 UTC 一天中的分钟数
+    
+    返回 (notify_utc_minute, 偏移分钟数)，时间或时区无效时返回 (None, None)。
+    """
+    try:
+        notify_hour, notify_minute = map(int, (notification_time or '10:30').split(':'))
+        offset = get_timezone_offset(timezone or 'Asia/Shanghai', now_utc)
+    except (ValueError, pytz.UnknownTimeZoneError):
+        return None, None
+    return (notify_hour * 60 + notify_minute - offset) % 1440, offset
+
+def get_timezone_offset(timezone, now_utc=None):
+    """时区当前的 UTC 偏移（分钟）"""
+    now_utc = now_utc or datetime.now(pytz.utc)
+    return int(now_utc.astimezone(get_timezone(timezone)).utcoffset().total_seconds() // 60)
+
 def dict_factory(cursor, row):
     """将查询结果转换为字典格式"""
     d = {}
@@ -47,6 +327,295 @@ def dict_factory(cursor, row):
         d[col[0]] = row[idx]
     return d
 
+class Metric:
+    """Prometheus 文本格式的计数器/仪表盘指标，按标签值分别统计"""
+    
+    def __init__(self, name, help_text, metric_type='counter', labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.values = {}  # 标签值元组 -> 数值
+        self._lock = threading.Lock()
+        metrics_registry.append(self)
+    
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+    
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+    
+    def _samples(self):
+        with self._lock:
+            return [(self.name, self._format_labels(key), value) for key, value in sorted(self.values.items())]
+    
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        lines.extend(f'{name}{labels} {value}' for name, labels, value in self._samples())
+        return lines
+
+class Histogram(Metric):
+    """Prometheus 直方图：累计分桶计数、总和与次数"""
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+    
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self.values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append((f'{self.name}_bucket', self._format_labels(key, [('le', str(bound))]), cumulative))
+            samples.append((f'{self.name}_bucket', self._format_labels(key, [('le', '+Inf')]), count))
+            samples.append((f'{self.name}_sum', self._format_labels(key), round(total, 6)))
+            samples.append((f'{self.name}_count', self._format_labels(key), count))
+        return samples
+
+metrics_registry = []
+
+# 指标定义（/metrics 输出）
+HTTP_REQUESTS = Metric('todo_http_requests_total', 'HTTP 请求数', labelnames=('endpoint', 'method', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('todo_http_request_duration_seconds', 'HTTP 请求耗时', labelnames=('endpoint',))
+DB_QUERIES = Metric('todo_db_queries_total', '请求内执行的数据库语句数', labelnames=('endpoint',))
+DB_QUERY_SECONDS = Metric('todo_db_query_seconds_total', '请求内数据库语句的累计耗时', labelnames=('endpoint',))
+REMINDER_CYCLE_SECONDS = Histogram('todo_reminder_cycle_duration_seconds', '每分钟提醒调度周期耗时')
+REMINDER_TODOS = Metric('todo_reminder_todos_total', '调度周期处理的任务数（due: 到期, sent: 已发送, deferred: 超时顺延, replayed: 发件箱补发）',
+                        labelnames=('stage',))
+WEBHOOK_REQUESTS = Metric('todo_webhook_requests_total', '企业微信 webhook 请求数', labelnames=('robot_id', 'result'))
+WEBHOOK_SECONDS = Histogram('todo_webhook_duration_seconds', '企业微信 webhook 请求耗时', labelnames=('robot_id',))
+RUNTIME_GAUGES = Metric('todo_runtime', '运行状态（抓取时采集）', 'gauge', labelnames=('name',))
+NOTIFICATION_QUEUE_DEPTH = Metric('todo_notification_queue_messages', '发送队列中各状态的消息数', 'gauge',
+                                  labelnames=('status',))
+RETENTION_ROWS = Metric('todo_retention_rows_total', '数据保留任务归档/删除的行数', labelnames=('step',))
+RETENTION_SECONDS = Metric('todo_retention_last_run_seconds', '最近一次数据保留任务各步骤的耗时', 'gauge',
+                           labelnames=('step',))
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """记录语句执行次数和耗时（累加到所属连接上）的游标"""
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record_query(time.perf_counter() - start)
+    
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.record_query(time.perf_counter() - start)
+    
+    # SQLite 在取结果时才逐步执行查询，取结果的耗时也计入语句耗时（不增加语句数）
+    def _timed_fetch(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self.connection.query_seconds += time.perf_counter() - start
+    
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+    
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+    
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+    
+    def __next__(self):
+        return self._timed_fetch(super().__next__)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """统计语句数和耗时的连接，请求结束时按路由汇总到指标中"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_query_stats()
+    
+    def reset_query_stats(self):
+        self.query_count = 0
+        self.query_seconds = 0.0
+    
+    def record_query(self, seconds):
+        self.query_count += 1
+        self.query_seconds += seconds
+    
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+    
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+    
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionPool:
+    """线程安全的 SQLite 连接池（WAL 模式，连接复用预编译语句缓存）"""
+    
+    def __init__(self, db_path, size, busy_timeout_ms, statement_cache_size):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache_size = statement_cache_size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+    
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path,
+                               timeout=self.busy_timeout_ms / 1000,
+                               check_same_thread=False,
+                               cached_statements=self.statement_cache_size,
+                               factory=InstrumentedConnection)
+        # 只对新建的数据库文件生效，已有数据库需执行一次 flask vacuum-db 切换
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={self.busy_timeout_ms}')
+        return conn
+    
+    def acquire(self, timeout=30):
+        """借出连接：优先复用空闲连接，未达上限时新建，否则等待归还"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError(f"等待数据库连接超时（连接池大小: {self.size}）")
+    
+    def release(self, conn):
+        """归还连接，未提交的事务会被回滚"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+        except sqlite3.Error as e:
+            db_logger.error(f"归还数据库连接失败，已丢弃: {e}")
+            with self._lock:
+                self._created -= 1
+    
+    def stats(self):
+        return {"size": self.size, "created": self._created, "idle": self._idle.qsize()}
+
+db_pool = None
+db_pool_lock = threading.Lock()
+db_local = threading.local()  # 后台线程内复用同一个连接
+
+def get_db_pool():
+    """获取全局连接池（首次使用时按 app.config 创建）"""
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = ConnectionPool(app.config['DATABASE'],
+                                         app.config['DB_POOL_SIZE'],
+                                         app.config['DB_BUSY_TIMEOUT_MS'],
+                                         app.config['DB_STATEMENT_CACHE_SIZE'])
+    return db_pool
+
+def get_db():
+    """获取当前请求的数据库连接（同一请求内复用）"""
+    if 'db' not in g:
+        g.db = get_db_pool().acquire()
+        g.db.reset_query_stats()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exception):
+    """请求结束时把连接归还连接池"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_db_pool().release(conn)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """按路由记录请求数、耗时和数据库语句数"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=endpoint)
+        conn = g.get('db')
+        if conn is not None:
+            DB_QUERIES.inc(conn.query_count, endpoint=endpoint)
+            DB_QUERY_SECONDS.inc(round(conn.query_seconds, 6), endpoint=endpoint)
+    return response
+
+@contextmanager
+def db_connection():
+    """借出数据库连接：请求内复用请求连接，后台线程内复用线程连接"""
+    if has_request_context():
+        yield get_db()
+        return
+    
+    conn = getattr(db_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+    
+    pool = get_db_pool()
+    conn = pool.acquire()
+    db_local.conn = conn
+    try:
+        yield conn
+    finally:
+        db_local.conn = None
+        pool.release(conn)
+
 def hash_password(password):
     """对密码进行哈希处理"""
     return hashlib.sha256(password.encode()).hexdigest()
@@ -61,11 +630,14 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-def init_db():
-    """初始化数据库"""
-    conn = sqlite3.connect('todolist.db')
-    c = conn.cursor()
-    
+def add_column_if_missing(c, table, column, definition):
+    """表中不存在该字段时才添加"""
+    columns = [row[1] for row in c.execute(f'PRAGMA table_info({table})').fetchall()]
+    if column not in columns:
+        c.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+def migration_001_initial_schema(c):
+    """初始表结构（兼容旧版本已存在的表）"""
     # 创建用户表
     c.execute('''CREATE TABLE IF NOT EXISTS users
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -117,135 +689,881 @@ def init_db():
                   sent_at TEXT DEFAULT CURRENT_TIMESTAMP,
                   UNIQUE(todo_id, reminder_key))''')
     
-    # 插入默认用户（如果不存在）
-    c.execute('SELECT COUNT(*) FROM users')
-    if c.fetchone()[0] == 0:
-        username = 'admin'
-        password = 'admin'
-        password_hash = hash_password(password)
-        c.execute('INSERT INTO users (username, password_hash, timezone) VALUES (?, ?, ?)',
-                  (username, password_hash, 'Asia/Shanghai'))
-    
-    # 插入默认机器人（如果不存在）
-    c.execute('SELECT COUNT(*) FROM robots')
-    if c.fetchone()[0] == 0:
-        c.execute('''INSERT INTO robots (name, webhook_url, description) 
-                     VALUES (?, ?, ?)''',
-                  ('默认机器人', 
-                   'https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=[你的key]',
-                   '主要通知机器人'))
-    
-    # 插入默认提醒设置（如果不存在）
-    c.execute('SELECT COUNT(*) FROM reminder_settings')
-    if c.fetchone()[0] == 0:
-        default_reminders = [30, 7, 1, 0]  # 提前30天、7天、1天和当天开始连续提醒
-        for days in default_reminders:
-            c.execute('INSERT INTO reminder_settings (days_before) VALUES (?)', (days,))
-    
-    # 添加字段（如果不存在）
-    try:
-        c.execute('ALTER TABLE users ADD COLUMN timezone TEXT DEFAULT "Asia/Shanghai"')
-    except:
-        pass
+    # 旧版本数据库缺少的字段
+    add_column_if_missing(c, 'users', 'timezone', 'TEXT DEFAULT "Asia/Shanghai"')
+    add_column_if_missing(c, 'todos', 'timezone', 'TEXT DEFAULT "Asia/Shanghai"')
+    add_column_if_missing(c, 'reminder_logs', 'reminder_type', 'TEXT DEFAULT "daily"')
+    add_column_if_missing(c, 'reminder_logs', 'days_before', 'INTEGER DEFAULT 0')
+
+def migration_002_next_fire_at(c):
+    """提醒调度的下一次触发时间"""
+    add_column_if_missing(c, 'todos', 'next_fire_at', 'TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_next_fire_at ON todos(next_fire_at)')
+
+def migration_003_hot_query_indexes(c):
+    """常用查询的复合索引"""
+    # 首页按用户列出任务（按创建时间倒序）
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_user_created ON todos(user_id, created_at)')
+    # 按状态和截止日期筛选待处理任务
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_status_due ON todos(status, due_date)')
+    # 清理旧提醒日志
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_logs_sent_at ON reminder_logs(sent_at)')
+
+def migration_004_notification_queue(c):
+    """企业微信消息发送队列"""
+    c.execute('''CREATE TABLE IF NOT EXISTS notification_queue
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  robot_id INTEGER NOT NULL,
+                  msgtype TEXT DEFAULT 'text',
+                  content TEXT NOT NULL,
+                  status TEXT DEFAULT 'pending',
+                  attempts INTEGER DEFAULT 0,
+                  next_attempt_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  claimed_at TEXT,
+                  last_error TEXT,
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  sent_at TEXT)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_notification_queue_status ON notification_queue(status, next_attempt_at)')
+
+def migration_005_cache_versions(c):
+    """配置缓存的版本号，用于多进程间缓存失效"""
+    c.execute('''CREATE TABLE IF NOT EXISTS cache_versions
+                 (name TEXT PRIMARY KEY,
+                  version INTEGER NOT NULL DEFAULT 0)''')
+    c.executemany('INSERT OR IGNORE INTO cache_versions (name) VALUES (?)',
+                  [('robots',), ('reminder_settings',)])
+
+def migration_006_scheduler_lease(c):
+    """调度器租约，多进程部署时选出唯一的调度进程"""
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduler_lease
+                 (name TEXT PRIMARY KEY,
+                  holder TEXT NOT NULL,
+                  acquired_at TEXT,
+                  heartbeat_at TEXT,
+                  expires_at TEXT NOT NULL)''')
+
+def migration_007_notify_utc_minute(c):
+    """通知时间换算成 UTC 分钟（notify_utc_minute），按分钟直接查出本分钟要通知的任务"""
+    add_column_if_missing(c, 'todos', 'notify_utc_minute', 'INTEGER')
+    add_column_if_missing(c, 'todos', 'notify_utc_offset', 'INTEGER')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_notify_utc_minute ON todos(notify_utc_minute, status)')
     
-    try:
-        c.execute('ALTER TABLE todos ADD COLUMN timezone TEXT DEFAULT "Asia/Shanghai"')
-    except:
-        pass
+    # 已有任务按 (时区, 通知时间) 分组回填
+    c.execute("SELECT DISTINCT timezone, notification_time FROM todos WHERE status = 'pending'")
+    updates = []
+    for timezone, notification_time in c.fetchall():
+        notify_utc_minute, offset = compute_notify_utc_minute(notification_time, timezone)
+        updates.append((notify_utc_minute, offset, timezone, notification_time))
+    c.executemany('''UPDATE todos SET notify_utc_minute = ?, notify_utc_offset = ?
+                     WHERE status = 'pending' AND timezone IS ? AND notification_time IS ?''', updates)
+
+def migration_008_reminder_outbox(c):
+    """提醒发件箱：next_fire_at 写入时由触发器预先生成待发记录，错过的提醒在宽限窗口内补发"""
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  todo_id INTEGER NOT NULL,
+                  scheduled_at TEXT NOT NULL,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  processed_at TEXT,
+                  UNIQUE(todo_id, scheduled_at))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_outbox_status ON reminder_outbox(status, scheduled_at)')
+    
+    # 所有写入 next_fire_at 的路径（包括其他进程）都经过触发器；
+    # 触发点被修改到其他时间时，尚未到达的旧记录作废（改回原时间时恢复），已过去的保留等待补发
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_todos_outbox_insert AFTER INSERT ON todos
+                 WHEN NEW.next_fire_at IS NOT NULL
+                 BEGIN
+                     INSERT OR IGNORE INTO reminder_outbox (todo_id, scheduled_at) VALUES (NEW.id, NEW.next_fire_at);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_todos_outbox_update AFTER UPDATE OF next_fire_at ON todos
+                 WHEN NEW.next_fire_at IS NOT OLD.next_fire_at
+                 BEGIN
+                     UPDATE reminder_outbox SET status = 'superseded', processed_at = CURRENT_TIMESTAMP
+                     WHERE todo_id = NEW.id AND scheduled_at = OLD.next_fire_at AND status = 'pending'
+                     AND OLD.next_fire_at > strftime('%Y-%m-%d %H:%M:%S', 'now');
+                     INSERT INTO reminder_outbox (todo_id, scheduled_at)
+                     SELECT NEW.id, NEW.next_fire_at WHERE NEW.next_fire_at IS NOT NULL
+                     ON CONFLICT(todo_id, scheduled_at) DO UPDATE SET status = 'pending', processed_at = NULL
+                     WHERE status = 'superseded';
+                 END''')
+    
+    c.execute('''INSERT OR IGNORE INTO reminder_outbox (todo_id, scheduled_at)
+                 SELECT id, next_fire_at FROM todos WHERE next_fire_at IS NOT NULL''')
+
+def migration_009_reminder_log_status(c):
+    """提醒记录的投递状态（claimed/queued/sent/failed）及关联的队列消息"""
+    add_column_if_missing(c, 'reminder_logs', 'status', "TEXT DEFAULT 'sent'")
+    add_column_if_missing(c, 'reminder_logs', 'queue_id', 'INTEGER')
+    add_column_if_missing(c, 'reminder_logs', 'claim_token', 'TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_logs_queue_id ON reminder_logs(queue_id)')
+
+def migration_010_message_templates(c):
+    """消息模板（按机器人/语言覆盖内置模板）及机器人的语言"""
+    c.execute('''CREATE TABLE IF NOT EXISTS message_templates
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  name TEXT NOT NULL,
+                  robot_id INTEGER NOT NULL DEFAULT 0,
+                  locale TEXT NOT NULL DEFAULT 'zh_CN',
+                  msgtype TEXT NOT NULL DEFAULT 'text',
+                  title TEXT,
+                  body TEXT NOT NULL,
+                  url TEXT,
+                  updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                  UNIQUE(name, robot_id, locale))''')
+    add_column_if_missing(c, 'robots', 'locale', "TEXT DEFAULT 'zh_CN'")
+    c.execute("INSERT OR IGNORE INTO cache_versions (name) VALUES ('message_templates')")
+
+def migration_011_archive_tables(c):
+    """已完成任务和旧提醒记录的归档表，以及合并热表和归档表的视图"""
+    add_column_if_missing(c, 'todos', 'completed_at', 'TEXT')
+    # 真实完成时间未知，按迁移时间回填，已完成的旧任务从现在起满保留期后才归档
+    c.execute("UPDATE todos SET completed_at = CURRENT_TIMESTAMP WHERE status = 'completed' AND completed_at IS NULL")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_status_completed ON todos(status, completed_at)')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS todos_archive
+                 (id INTEGER PRIMARY KEY,
+                  title TEXT NOT NULL,
+                  description TEXT,
+                  due_date TEXT,
+                  priority TEXT,
+                  status TEXT,
+                  created_at TEXT,
+                  reminder_sent TEXT,
+                  robot_id INTEGER,
+                  notification_time TEXT,
+                  last_notification_date TEXT,
+                  user_id INTEGER,
+                  timezone TEXT,
+                  completed_at TEXT,
+                  archived_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_todos_archive_user_created ON todos_archive(user_id, created_at)')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS reminder_logs_archive
+                 (id INTEGER PRIMARY KEY,
+                  todo_id INTEGER NOT NULL,
+                  reminder_key TEXT NOT NULL,
+                  reminder_type TEXT,
+                  days_before INTEGER,
+                  sent_at TEXT,
+                  status TEXT,
+                  archived_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_logs_archive_todo ON reminder_logs_archive(todo_id)')
+    
+    c.execute('''CREATE VIEW IF NOT EXISTS todos_all AS
+                 SELECT id, title, description, due_date, priority, status, created_at, reminder_sent, robot_id,
+                        notification_time, last_notification_date, user_id, timezone, next_fire_at, completed_at,
+                        0 AS archived
+                 FROM todos
+                 UNION ALL
+                 SELECT id, title, description, due_date, priority, status, created_at, reminder_sent, robot_id,
+                        notification_time, last_notification_date, user_id, timezone, NULL, completed_at,
+                        1 AS archived
+                 FROM todos_archive''')
+    c.execute('''CREATE VIEW IF NOT EXISTS reminder_logs_all AS
+                 SELECT id, todo_id, reminder_key, reminder_type, days_before, sent_at, status, 0 AS archived
+                 FROM reminder_logs
+                 UNION ALL
+                 SELECT id, todo_id, reminder_key, reminder_type, days_before, sent_at, status, 1 AS archived
+                 FROM reminder_logs_archive''')
+
+def migration_012_archive_retention_index(c):
+    """归档提醒记录按发送时间清理"""
+    c.execute('CREATE INDEX IF NOT EXISTS idx_reminder_logs_archive_sent_at ON reminder_logs_archive(sent_at)')
+
+def migration_013_todo_search(c):
+    """任务标题和描述的 FTS5 全文索引（trigram 分词，支持中文子串匹配），由触发器与 todos 同步"""
+    create_todo_search_index(c)
+
+def create_todo_search_index(c):
+    """创建 todos_fts 全文索引和同步触发器并从 todos 重建，返回是否创建成功
     
+    SQLite 不支持时返回 False；启动时 ensure_todo_search_index 会再次尝试，升级 SQLite 后自动补建。
+    """
     try:
-        c.execute('ALTER TABLE reminder_logs ADD COLUMN reminder_type TEXT DEFAULT "daily"')
-    except:
-        pass
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts
+                     USING fts5(title, description, content='todos', content_rowid='id', tokenize='trigram')''')
+    except sqlite3.OperationalError as e:
+        # SQLite 未编译 FTS5 或低于 3.34（没有 trigram 分词器）时搜索全部使用 LIKE
+        db_logger.warning(f"SQLite 不支持 FTS5 trigram，任务搜索将使用 LIKE: {e}")
+        return False
     
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_todos_fts_insert AFTER INSERT ON todos
+                 BEGIN
+                     INSERT INTO todos_fts (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_todos_fts_delete AFTER DELETE ON todos
+                 BEGIN
+                     INSERT INTO todos_fts (todos_fts, rowid, title, description)
+                     VALUES ('delete', OLD.id, OLD.title, OLD.description);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_todos_fts_update AFTER UPDATE OF title, description ON todos
+                 BEGIN
+                     INSERT INTO todos_fts (todos_fts, rowid, title, description)
+                     VALUES ('delete', OLD.id, OLD.title, OLD.description);
+                     INSERT INTO todos_fts (rowid, title, description) VALUES (NEW.id, NEW.title, NEW.description);
+                 END''')
+    # 标题匹配的权重是描述的 10 倍
+    c.execute("INSERT INTO todos_fts (todos_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')")
+    c.execute("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+    return True
+
+def ensure_todo_search_index(conn):
+    """启动时检查全文索引，迁移 013 因 SQLite 不支持而跳过建表时补建"""
+    global todo_search_fts
+    conn.execute('BEGIN IMMEDIATE')
     try:
-        c.execute('ALTER TABLE reminder_logs ADD COLUMN days_before INTEGER DEFAULT 0')
-    except:
-        pass
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'todos_fts'").fetchone() is not None
+        if not exists and create_todo_search_index(conn.cursor()):
+            db_logger.info("已补建任务全文索引 todos_fts")
+            exists = True
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    todo_search_fts = exists
+
+# 数据库迁移列表：(版本号, 说明, 迁移函数)，只能追加，不能修改已发布的迁移
+MIGRATIONS = [
+    (1, '初始表结构', migration_001_initial_schema),
+    (2, '提醒调度字段 next_fire_at', migration_002_next_fire_at),
+    (3, '常用查询索引', migration_003_hot_query_indexes),
+    (4, '消息发送队列', migration_004_notification_queue),
+    (5, '配置缓存版本号', migration_005_cache_versions),
+    (6, '调度器租约', migration_006_scheduler_lease),
+    (7, '按 UTC 分钟索引通知时间', migration_007_notify_utc_minute),
+    (8, '提醒发件箱', migration_008_reminder_outbox),
+    (9, '提醒记录投递状态', migration_009_reminder_log_status),
+    (10, '消息模板', migration_010_message_templates),
+    (11, '归档表', migration_011_archive_tables),
+    (12, '归档提醒记录清理索引', migration_012_archive_retention_index),
+    (13, '任务全文搜索', migration_013_todo_search),
+]
+
+def run_migrations(conn):
+    """执行尚未应用的数据库迁移，每个迁移在独立事务中只执行一次"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     description TEXT,
+                     applied_at TEXT DEFAULT CURRENT_TIMESTAMP)''')
     
-    conn.commit()
-    conn.close()
+    applied = 0
+    for version, description, migrate in MIGRATIONS:
+        # IMMEDIATE 事务加写锁，多个进程同时启动时只有一个会执行迁移
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                conn.rollback()
+                continue
+            
+            migrate(conn.cursor())
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                         (version, description))
+            conn.commit()
+            applied += 1
+            db_logger.info(f"数据库迁移完成: {version:03d} {description}")
+        except Exception:
+            conn.rollback()
+            db_logger.error(f"数据库迁移失败: {version:03d} {description}")
+            raise
+    
+    return applied
 
-def get_active_robots():
-    """获取活跃的机器人列表"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
+# 热点查询及其应使用的索引，用于验证索引是否生效
+HOT_QUERIES = [
+    ('首页任务列表',
+     'SELECT * FROM todos WHERE user_id = ? ORDER BY created_at DESC',
+     (1,), 'idx_todos_user_created'),
+    ('待处理任务按截止日期',
+     "SELECT id FROM todos WHERE status = 'pending' AND due_date <= ?",
+     ('2000-01-01',), 'idx_todos_status_due'),
+    ('调度器到期触发点',
+     'SELECT next_fire_at, id FROM todos WHERE next_fire_at IS NOT NULL AND next_fire_at <= ?',
+     ('2000-01-01 00:00:00',), 'idx_todos_next_fire_at'),
+    ('本分钟通知的任务',
+     "SELECT id FROM todos WHERE notify_utc_minute = ? AND status = 'pending'",
+     (0,), 'idx_todos_notify_utc_minute'),
+    ('归档已完成任务',
+     "SELECT id FROM todos WHERE status = 'completed' AND completed_at < ? ORDER BY completed_at",
+     ('2000-01-01',), 'idx_todos_status_completed'),
+    ('清理旧提醒日志',
+     'SELECT MAX(rowid + 0) FROM reminder_logs WHERE sent_at < ?',
+     ('2000-01-01',), 'idx_reminder_logs_sent_at'),
+    ('任务提醒记录统计',
+     'SELECT todo_id, COUNT(*) FROM reminder_logs WHERE todo_id IN (?, ?) GROUP BY todo_id',
+     (1, 2), 'sqlite_autoindex_reminder_logs_1'),
+]
+
+def explain_hot_queries(conn):
+    """输出热点查询的查询计划，并检查是否使用了预期的索引"""
+    results = []
+    for name, sql, params, expected_index in HOT_QUERIES:
+        plan = [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()]
+        results.append({
+            "name": name,
+            "expected_index": expected_index,
+            "uses_index": any(expected_index in detail for detail in plan),
+            "plan": plan
+        })
+    return results
+
+def init_db():
+    """初始化数据库（执行迁移并写入默认数据）"""
+    with db_connection() as conn:
+        run_migrations(conn)
+        ensure_todo_search_index(conn)
+        
+        c = conn.cursor()
+        
+        # 插入默认用户（如果不存在）
+        c.execute('SELECT COUNT(*) FROM users')
+        if c.fetchone()[0] == 0:
+            username = 'admin'
+            password = 'admin'
+            password_hash = hash_password(password)
+            c.execute('INSERT INTO users (username, password_hash, timezone) VALUES (?, ?, ?)',
+                      (username, password_hash, 'Asia/Shanghai'))
+        
+        # 插入默认机器人（如果不存在）
+        c.execute('SELECT COUNT(*) FROM robots')
+        if c.fetchone()[0] == 0:
+            c.execute('''INSERT INTO robots (name, webhook_url, description) 
+                         VALUES (?, ?, ?)''',
+                      ('默认机器人', 
+                       'https://qyapi.weixin.qq.com/cgi-bin/webhook/send?key=[你的key]',
+                       '主要通知机器人'))
+        
+        # 插入默认提醒设置（如果不存在）
+        c.execute('SELECT COUNT(*) FROM reminder_settings')
+        if c.fetchone()[0] == 0:
+            default_reminders = [30, 7, 1, 0]  # 提前30天、7天、1天和当天开始连续提醒
+            for days in default_reminders:
+                c.execute('INSERT INTO reminder_settings (days_before) VALUES (?)', (days,))
+        
+        conn.commit()
+        
+        for check in explain_hot_queries(conn):
+            if not check['uses_index']:
+                db_logger.warning(f"查询未使用预期索引: {check['name']} ({check['expected_index']}) - {check['plan']}")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """执行数据库迁移"""
+    init_db()
+    print('数据库初始化完成')
+
+@app.cli.command('query-plans')
+def query_plans_command():
+    """检查热点查询是否使用了索引"""
+    with db_connection() as conn:
+        for check in explain_hot_queries(conn):
+            status = 'OK ' if check['uses_index'] else 'MISS'
+            print(f"[{status}] {check['name']} -> {check['expected_index']}")
+            for detail in check['plan']:
+                print(f"       {detail}")
+
+@app.cli.command('check-reminder-rules')
+def check_reminder_rules_command():
+    """验证 SQL 提醒规则与 should_send_reminder 的判断结果一致"""
+    settings_lists = reminder_rule_check_settings()
+    with db_connection() as conn:
+        current = [row[0] for row in conn.execute('SELECT days_before FROM reminder_settings WHERE is_active = 1')]
+        settings_lists.append(current)
+        mismatches = check_reminder_rule_equivalence(conn, settings_lists)
+    for settings, days, actual, expected in mismatches[:20]:
+        print(f"设置 {settings} 距离到期 {days} 天: SQL={actual} Python={expected}")
+    print(f"检查 {len(settings_lists)} 组提醒设置，不一致 {len(mismatches)} 处")
+    if mismatches:
+        sys.exit(1)
+
+@app.cli.command('run-retention')
+def run_retention_command():
+    """立即执行一次数据保留任务（归档、清理和增量 VACUUM）"""
+    report = run_retention_job()
+    for name, result in report['steps'].items():
+        status = f"错误: {result['error']}" if result['error'] else f"{result['rows']} 行"
+        print(f"{name}: {status} ({result['seconds']}s)")
+    print(f"总耗时 {report['seconds']}s")
+
+@app.cli.command('vacuum-db')
+def vacuum_db_command():
+    """把已有数据库切换为增量 auto_vacuum 并整理（会锁库，耗时与数据库大小成正比，建议停机执行）"""
+    with db_connection() as conn:
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    print(f"数据库整理完成，auto_vacuum={mode}")
+
+class VersionedCache:
+    """进程内缓存：数据变更时递增 cache_versions 表中的版本号，各进程据此失效"""
+    
+    def __init__(self, name, loader, on_change=None):
+        self.name = name
+        self.loader = loader
+        self.on_change = on_change
+        self.value = None
+        self.version = None
+        self.checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    def get(self):
+        changed = False
+        with self._lock:
+            now = time.monotonic()
+            if self.value is not None and now - self.checked_at < CACHE_VERSION_CHECK_INTERVAL:
+                self.hits += 1
+                return self.value
+            
+            with db_connection() as conn:
+                row = conn.execute('SELECT version FROM cache_versions WHERE name = ?', (self.name,)).fetchone()
+                version = row[0] if row else 0
+                self.checked_at = now
+                if self.value is not None and version == self.version:
+                    self.hits += 1
+                    return self.value
+                
+                self.misses += 1
+                changed = self.version is not None
+                self.value = self.loader(conn)
+                self.version = version
+            value = self.value
+        
+        if changed and self.on_change:
+            self.on_change()
+        return value
+    
+    def expire(self):
+        """本进程内立即重新检查版本号（写操作提交后调用）"""
+        with self._lock:
+            self.checked_at = 0.0
+    
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "version": self.version}
+
+def bump_cache_version(conn, name):
+    """递增缓存版本号（与数据修改在同一事务中提交）"""
+    conn.execute('UPDATE cache_versions SET version = version + 1 WHERE name = ?', (name,))
+
+def load_active_robots(conn):
     c = conn.cursor()
+    c.row_factory = dict_factory
     c.execute('SELECT * FROM robots WHERE is_active = 1 ORDER BY id')
     robots = c.fetchall()
-    conn.close()
-    return robots
+    return {"list": robots, "by_id": {robot['id']: robot for robot in robots}}
+
+def load_reminder_settings(conn):
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    c.execute('SELECT * FROM reminder_settings WHERE is_active = 1 ORDER BY days_before DESC')
+    return c.fetchall()
+
+def load_message_templates(conn):
+    """加载并预编译配置页面保存的模板，无效的模板记录日志后跳过（使用内置模板）"""
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    c.execute('SELECT * FROM message_templates ORDER BY name, robot_id, locale')
+    rows = c.fetchall()
+    overrides = {}
+    for row in rows:
+        try:
+            overrides[(row['name'], row['robot_id'], row['locale'])] = MessageTemplate(
+                row['name'], row['body'], row['msgtype'], row['title'], row['url'])
+        except ValueError as e:
+            notify_logger.error(f"消息模板无效，已使用内置模板: id={row['id']} {row['name']} - {e}")
+    return {"rows": rows, "overrides": overrides}
+
+robots_cache = VersionedCache('robots', load_active_robots)
+message_templates_cache = VersionedCache('message_templates', load_message_templates)
+# 提醒设置变化后所有任务的下一次触发时间都需要重新计算
+reminder_settings_cache = VersionedCache('reminder_settings', load_reminder_settings,
+                                         on_change=schedule_rebuild_requested.set)
+
+def get_active_robots():
+    """获取活跃的机器人列表"""
+    return list(robots_cache.get()['list'])
 
 def get_robot_by_id(robot_id):
     """根据ID获取机器人信息"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
-    c = conn.cursor()
-    c.execute('SELECT * FROM robots WHERE id = ? AND is_active = 1', (robot_id,))
-    robot = c.fetchone()
-    conn.close()
-    return robot
+    return robots_cache.get()['by_id'].get(robot_id)
 
 def get_reminder_settings():
     """获取提醒设置"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
-    c = conn.cursor()
-    c.execute('SELECT * FROM reminder_settings WHERE is_active = 1 ORDER BY days_before DESC')
-    settings = c.fetchall()
-    conn.close()
-    return settings
+    return list(reminder_settings_cache.get())
 
-def send_wechat_message(message, robot_id=1):
-    """发送消息到指定的企业微信机器人"""
-    robot = get_robot_by_id(robot_id)
-    if not robot:
-        logging.error(f"机器人 ID {robot_id} 不存在或未激活")
-        return False, "机器人不存在或未激活"
+# 消息模板：内置模板可在配置页面按机器人/语言覆盖，机器人的语言见 robots.locale
+DEFAULT_LOCALE = os.environ.get('TODO_DEFAULT_LOCALE', 'zh_CN')
+MESSAGE_TEMPLATE_MSGTYPES = ('text', 'markdown', 'news')
+
+# 各模板可用的占位符及示例值（保存模板时用示例值试渲染）
+REMINDER_TEMPLATE_FIELDS = {
+    'title': '示例任务', 'description': '无', 'due_date': '2024-01-08', 'priority': 'medium',
+    'days_until_due': 3, 'overdue_days': 0, 'trigger_days': 7, 'reminder_type': 'daily',
+    'local_now': '2024-01-05 10:30:00', 'timezone': 'Asia/Shanghai'
+}
+TODO_TEMPLATE_FIELDS = {
+    'username': 'admin', 'title': '示例任务', 'description': '无', 'due_date': '2024-01-08',
+    'priority': 'medium', 'notification_time': '10:30', 'china_time': '2024-01-05 10:30:00'
+}
+TEST_TEMPLATE_FIELDS = {
+    'username': 'admin', 'china_time': '2024-01-05 10:30:00', 'server_time': '2024-01-05 02:30:00', 'robot_name': '默认机器人'
+}
+
+# 内置模板：名称 -> (说明, 默认正文, 可用占位符)
+MESSAGE_TEMPLATE_DEFAULTS = {
+    'reminder_daily': ('每日提醒（距离到期 1-7 天）',
+                       "📅 待办事项每日提醒\n\n标题: {title}\n描述: {description}\n截止日期: {due_date}\n优先级: {priority}\n\n⚠️ 还有 {days_until_due} 天到期，请及时处理！\n\n⏰ 提醒时间: {local_now} ({timezone})\n💡 提醒规则: 距离到期 ≤ 7天时每日提醒 (触发设置: ≤{trigger_days}天)",
+                       REMINDER_TEMPLATE_FIELDS),
+    'reminder_due_today': ('当天到期提醒',
+                           "🚨 待办事项紧急提醒\n\n标题: {title}\n描述: {description}\n截止日期: {due_date}\n优先级: {priority}\n\n❗ 今天到期，请立即处理！\n\n⏰ 提醒时间: {local_now} ({timezone})\n💡 提醒规则: 当天每日提醒",
+                           REMINDER_TEMPLATE_FIELDS),
+    'reminder_overdue': ('逾期提醒',
+                         "⏰ 待办事项逾期提醒\n\n标题: {title}\n描述: {description}\n截止日期: {due_date}\n优先级: {priority}\n\n🔴 已逾期 {overdue_days} 天，请尽快处理！\n\n⏰ 提醒时间: {local_now} ({timezone})\n💡 提醒规则: 逾期每日提醒",
+                         REMINDER_TEMPLATE_FIELDS),
+    'reminder_once': ('单次提醒（距离到期 > 7 天）',
+                      "🔔 待办事项定时提醒\n\n标题: {title}\n描述: {description}\n截止日期: {due_date}\n优先级: {priority}\n\n📌 距离到期还有 {days_until_due} 天\n\n⏰ 提醒时间: {local_now} ({timezone})\n💡 提醒规则: 提前 {trigger_days} 天单次提醒",
+                      REMINDER_TEMPLATE_FIELDS),
+    'todo_created': ('任务创建通知',
+                     "✅ 新待办事项已创建\n\n用户: {username}\n标题: {title}\n描述: {description}\n截止日期: {due_date}\n优先级: {priority}\n通知时间: {notification_time}\n创建时间: {china_time} (中国时间)\n\n💡 提醒规则: ≤7天每日提醒，>7天单次提醒",
+                     TODO_TEMPLATE_FIELDS),
+    'todo_completed': ('任务完成通知',
+                       "🎉 待办事项已完成\n\n用户: {username}\n标题: {title}\n描述: {description}\n完成时间: {china_time} (中国时间)\n\n✅ 所有提醒已停止",
+                       TODO_TEMPLATE_FIELDS),
+    'test_message': ('测试消息',
+                     "🔔 待办事项系统测试消息\n\n用户: {username}\n中国时间: {china_time}\n服务器时间: {server_time}\n机器人: {robot_name}\n\n💡 新提醒规则:\n- ≤7天: 每日提醒\n- >7天: 单次提醒\n\n系统运行正常！",
+                     TEST_TEMPLATE_FIELDS),
+}
+
+class MessageTemplate:
+    """预编译的消息模板
     
-    webhook_url = robot['webhook_url']
-    robot_name = robot['name']
+    创建时解析占位符（只允许该模板声明的字段）并用示例值试渲染一次，
+    渲染时只调用绑定好的 str.format_map，不再解析模板。
+    news 类型的正文作为图文描述，content 为图文列表的 JSON。
+    """
     
-    data = {
-        "msgtype": "text",
-        "text": {
-            "content": message
-        }
-    }
+    def __init__(self, name, body, msgtype='text', title=None, url=None):
+        if name not in MESSAGE_TEMPLATE_DEFAULTS:
+            raise ValueError(f"未知的模板: {name}")
+        if msgtype not in MESSAGE_TEMPLATE_MSGTYPES:
+            raise ValueError(f"不支持的消息类型: {msgtype}")
+        if msgtype == 'news' and not (title and url):
+            raise ValueError("图文消息需要填写标题和链接")
+        
+        fields = MESSAGE_TEMPLATE_DEFAULTS[name][2]
+        self.name = name
+        self.msgtype = msgtype
+        self.url = url or ''
+        self._render_body = self._compile(body, fields)
+        self._render_title = self._compile(title, fields) if msgtype == 'news' else None
+    
+    @staticmethod
+    def _compile(text, fields):
+        for _, field_name, format_spec, _ in string.Formatter().parse(text):
+            if field_name is not None and field_name not in fields:
+                raise ValueError(f"未知的占位符 {{{field_name}}}，可用: {', '.join(fields)}")
+            if format_spec and '{' in format_spec:
+                raise ValueError("格式说明中不能嵌套占位符")
+        render = text.format_map
+        render(fields)  # 格式说明与字段类型不符时在保存时报错
+        return render
     
+    def render(self, context):
+        """渲染消息，返回 (msgtype, content)"""
+        body = self._render_body(context)
+        if self.msgtype == 'news':
+            article = {"title": truncate_utf8(self._render_title(context), WECOM_NEWS_TITLE_MAX_BYTES),
+                       "description": truncate_utf8(body, WECOM_NEWS_DESCRIPTION_MAX_BYTES),
+                       "url": self.url}
+            return 'news', json.dumps([article], ensure_ascii=False)
+        return self.msgtype, body
+
+BUILTIN_MESSAGE_TEMPLATES = {name: MessageTemplate(name, body) for name, (_, body, _) in MESSAGE_TEMPLATE_DEFAULTS.items()}
+
+def get_message_template(name, robot_id=None):
+    """查找模板：(机器人, 语言) → (机器人, 默认语言) → (所有机器人, 语言) → (所有机器人, 默认语言) → 内置模板"""
+    overrides = message_templates_cache.get()['overrides']
+    if overrides:
+        robot = get_robot_by_id(robot_id) if robot_id else None
+        locale = (robot or {}).get('locale') or DEFAULT_LOCALE
+        for key in ((name, robot_id or 0, locale), (name, robot_id or 0, DEFAULT_LOCALE),
+                    (name, 0, locale), (name, 0, DEFAULT_LOCALE)):
+            template = overrides.get(key)
+            if template:
+                return template
+    return BUILTIN_MESSAGE_TEMPLATES[name]
+
+def render_message(name, context, robot_id=None):
+    """按机器人对应的模板渲染消息，返回 (msgtype, content)；自定义模板渲染出错时使用内置模板"""
+    template = get_message_template(name, robot_id)
+    try:
+        return template.render(context)
+    except (KeyError, ValueError, TypeError) as e:
+        notify_logger.error(f"渲染消息模板出错，已使用内置模板: {name} - {e}")
+        return BUILTIN_MESSAGE_TEMPLATES[name].render(context)
+
+def build_wechat_payload(msgtype, content):
+    """按消息类型组装企业微信请求体（news 类型的 content 为图文列表的 JSON）"""
+    if msgtype == 'news':
+        return {"msgtype": "news", "news": {"articles": json.loads(content)}}
+    return {"msgtype": msgtype, msgtype: {"content": content}}
+
+def post_wechat_payload(robot, data):
+    """通过共享的 HTTP 会话向机器人发送消息，返回 (是否成功, 错误信息)"""
+    robot_name = robot['name']
+    outcome = 'error'
+    start = time.perf_counter()
     try:
-        response = requests.post(webhook_url, json=data, timeout=10)
+        response = http_session.post(robot['webhook_url'], json=data, timeout=10)
         if response.status_code == 200:
             result = response.json()
             if result.get('errcode') == 0:
-                logging.info(f"通过机器人 '{robot_name}' 发送成功: {message[:50]}...")
+                outcome = 'ok'
+                notify_message_logger.info("通过机器人 '%s' 发送成功: %.50s...", robot_name, data)
                 return True, "发送成功"
             else:
+                outcome = f"errcode_{result.get('errcode')}"
                 error_msg = f"企业微信API错误: {result}"
-                logging.error(f"通过机器人 '{robot_name}' 发送失败: {result}")
+                notify_logger.error(f"通过机器人 '{robot_name}' 发送失败: {result}")
                 return False, error_msg
         else:
+            outcome = f"http_{response.status_code}"
             error_msg = f"HTTP错误，状态码: {response.status_code}"
-            logging.error(error_msg)
+            notify_logger.error(error_msg)
             return False, error_msg
     except requests.exceptions.Timeout:
+        outcome = 'timeout'
         error_msg = "请求超时，请检查网络连接"
-        logging.error(error_msg)
+        notify_logger.error(error_msg)
         return False, error_msg
     except requests.exceptions.RequestException as e:
+        outcome = 'network_error'
         error_msg = f"网络请求错误: {str(e)}"
-        logging.error(error_msg)
+        notify_logger.error(error_msg)
         return False, error_msg
     except Exception as e:
         error_msg = f"发送企业微信提醒时出错: {str(e)}"
-        logging.error(error_msg)
+        notify_logger.error(error_msg)
         return False, error_msg
+    finally:
+        WEBHOOK_SECONDS.observe(time.perf_counter() - start, robot_id=robot.get('id'))
+        WEBHOOK_REQUESTS.inc(robot_id=robot.get('id'), result=outcome)
+
+def send_wechat_message(message, robot_id=1, msgtype='text'):
+    """立即发送消息到指定的企业微信机器人（同步，仅用于需要即时结果的场景）"""
+    robot = get_robot_by_id(robot_id)
+    if not robot:
+        notify_logger.error(f"机器人 ID {robot_id} 不存在或未激活")
+        return False, "机器人不存在或未激活"
+    
+    return post_wechat_payload(robot, build_wechat_payload(msgtype, message))
+
+def enqueue_wechat_message(message, robot_id=1, msgtype='text'):
+    """把消息加入发送队列，由后台工作线程异步发送，返回 (是否入队成功, 错误信息)"""
+    try:
+        with db_connection() as conn:
+            conn.execute('INSERT INTO notification_queue (robot_id, msgtype, content) VALUES (?, ?, ?)',
+                         (robot_id, msgtype, message))
+            conn.commit()
+        notification_wakeup.set()
+        return True, "已加入发送队列"
+    except Exception as e:
+        notify_logger.error(f"消息加入发送队列失败: {e}")
+        return False, f"加入发送队列失败: {e}"
+
+def utc_now_str(offset_seconds=0):
+    """UTC 时间字符串，与 SQLite 的 CURRENT_TIMESTAMP 格式一致"""
+    return (datetime.now(pytz.utc) + timedelta(seconds=offset_seconds)).strftime(FIRE_TIME_FORMAT)
+
+class TokenBucket:
+    """令牌桶限流器：capacity 为突发上限，按 rate_per_second 匀速补充令牌"""
+    
+    def __init__(self, capacity, rate_per_second):
+        self.capacity = capacity
+        self.rate_per_second = rate_per_second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+    
+    def has_tokens(self):
+        """是否有可用令牌（只查看，不消耗）"""
+        with self._lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated_at) * self.rate_per_second)
+            return tokens >= 1
+
+def get_robot_rate_limiter(robot_id):
+    """获取机器人的限流器（企业微信群机器人每分钟最多约20条消息）"""
+    with notification_state_lock:
+        limiter = robot_rate_limiters.get(robot_id)
+        if limiter is None:
+            limiter = TokenBucket(WECOM_RATE_LIMIT_PER_MINUTE, WECOM_RATE_LIMIT_PER_MINUTE / 60)
+            robot_rate_limiters[robot_id] = limiter
+        return limiter
+
+def claim_notifications():
+    """领取可发送的队列消息（考虑每个机器人的并发上限），返回消息列表"""
+    # 限流器在进程内，只由调度 leader 发送才能保证每个机器人的总频率
+    if not is_scheduler_leader:
+        return []
+    
+    with notification_state_lock:
+        free_slots = NOTIFY_MAX_INFLIGHT - sum(notification_inflight.values())
+        robot_inflight = dict(notification_inflight)
+        limiters = dict(robot_rate_limiters)
+    if free_slots <= 0:
+        return []
+    
+    # 并发已满或暂无令牌的机器人不参与本轮领取，避免其积压的消息占满候选窗口
+    blocked_robots = {robot_id for robot_id, count in robot_inflight.items() if count >= NOTIFY_PER_ROBOT_CONCURRENCY}
+    blocked_robots.update(robot_id for robot_id, limiter in limiters.items() if not limiter.has_tokens())
+    blocked_placeholders = ', '.join('?' * len(blocked_robots))
+    blocked_filter = f' AND robot_id NOT IN ({blocked_placeholders})' if blocked_robots else ''
+    
+    with db_connection() as conn:
+        # IMMEDIATE 事务保证多进程下同一条消息只会被领取一次
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # 领取后长时间未完成的消息（进程崩溃等）重新放回队列
+            conn.execute('''UPDATE notification_queue SET status = 'pending'
+                            WHERE status = 'sending' AND claimed_at < ?''',
+                         (utc_now_str(-NOTIFY_CLAIM_TIMEOUT_SECONDS),))
+            
+            c = conn.cursor()
+            c.row_factory = dict_factory
+            # 每个机器人只取最早的几条候选，一个机器人积压时其他机器人的消息仍能被领取
+            c.execute(f'''SELECT id, robot_id, msgtype, content, attempts
+                          FROM (SELECT id, robot_id, msgtype, content, attempts,
+                                       ROW_NUMBER() OVER (PARTITION BY robot_id ORDER BY id) AS robot_rank
+                                FROM notification_queue
+                                WHERE status = 'pending' AND next_attempt_at <= ?{blocked_filter})
+                          WHERE robot_rank <= ?
+                          ORDER BY id LIMIT ?''',
+                      [utc_now_str()] + list(blocked_robots) + [NOTIFY_PER_ROBOT_CONCURRENCY, free_slots * 4])
+            
+            claimed = []
+            for item in c.fetchall():
+                if len(claimed) >= free_slots:
+                    break
+                if robot_inflight.get(item['robot_id'], 0) >= NOTIFY_PER_ROBOT_CONCURRENCY:
+                    continue
+                # 超出机器人频率限制的消息留在队列中，令牌补充后再领取
+                if not get_robot_rate_limiter(item['robot_id']).try_acquire():
+                    continue
+                robot_inflight[item['robot_id']] = robot_inflight.get(item['robot_id'], 0) + 1
+                claimed.append(item)
+            
+            if claimed:
+                conn.executemany('''UPDATE notification_queue SET status = 'sending', claimed_at = ?
+                                    WHERE id = ?''', [(utc_now_str(), item['id']) for item in claimed])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    
+    with notification_state_lock:
+        for item in claimed:
+            notification_inflight[item['robot_id']] = notification_inflight.get(item['robot_id'], 0) + 1
+    return claimed
+
+def deliver_notification(item):
+    """工作线程：发送一条队列消息并记录投递结果，失败时按指数退避重试"""
+    try:
+        robot = get_robot_by_id(item['robot_id'])
+        attempts = item['attempts'] + 1
+        if not robot:
+            success, error_msg = False, "机器人不存在或未激活"
+            attempts = NOTIFY_MAX_ATTEMPTS  # 不再重试
+        else:
+            success, error_msg = post_wechat_payload(robot, build_wechat_payload(item['msgtype'], item['content']))
+        
+        with db_connection() as conn:
+            # 提醒消息的投递结果同步到关联的提醒记录（queue_id）
+            if success:
+                conn.execute('''UPDATE notification_queue SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL
+                                WHERE id = ?''', (attempts, utc_now_str(), item['id']))
+                conn.execute("UPDATE reminder_logs SET status = 'sent' WHERE queue_id = ?", (item['id'],))
+            elif attempts >= NOTIFY_MAX_ATTEMPTS:
+                conn.execute('''UPDATE notification_queue SET status = 'failed', attempts = ?, last_error = ?
+                                WHERE id = ?''', (attempts, error_msg, item['id']))
+                failed_keys = [key for key, in conn.execute('SELECT reminder_key FROM reminder_logs WHERE queue_id = ?',
+                                                            (item['id'],))]
+                conn.execute("UPDATE reminder_logs SET status = 'failed' WHERE queue_id = ?", (item['id'],))
+                for reminder_key in failed_keys:
+                    processed_reminders.discard(reminder_key)
+                notify_logger.error(f"❌ 队列消息发送失败，已放弃: id={item['id']} - {error_msg}")
+            else:
+                delay = min(NOTIFY_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), NOTIFY_BACKOFF_MAX_SECONDS)
+                conn.execute('''UPDATE notification_queue SET status = 'pending', attempts = ?, last_error = ?,
+                                next_attempt_at = ? WHERE id = ?''',
+                             (attempts, error_msg, utc_now_str(delay), item['id']))
+                notify_logger.warning(f"队列消息发送失败，{delay}秒后重试: id={item['id']} - {error_msg}")
+            conn.commit()
+    except Exception as e:
+        notify_logger.error(f"处理队列消息时出错: id={item['id']} - {e}")
+    finally:
+        with notification_state_lock:
+            notification_inflight[item['robot_id']] -= 1
+        notification_wakeup.set()
+
+def notification_dispatcher():
+    """发送队列调度线程：领取消息并交给工作线程池发送"""
+    notify_logger.info(f"通知发送队列启动 - 工作线程: {NOTIFY_WORKERS}, 每个机器人并发: {NOTIFY_PER_ROBOT_CONCURRENCY}")
+    
+    while True:
+        try:
+            notification_wakeup.clear()
+            claimed = claim_notifications()
+            for item in claimed:
+                notification_executor.submit(deliver_notification, item)
+            if claimed:
+                continue
+        except Exception as e:
+            notify_logger.error(f"领取队列消息时出错: {e}")
+        
+        # 有新消息入队或发送完成时立即唤醒，否则定期检查到期的重试
+        notification_wakeup.wait(timeout=1)
+
+def start_notification_workers():
+    """启动发送队列调度线程和工作线程池"""
+    global notification_executor
+    notification_executor = ThreadPoolExecutor(max_workers=NOTIFY_WORKERS, thread_name_prefix='notify')
+    dispatcher_thread = threading.Thread(target=notification_dispatcher, daemon=True)
+    dispatcher_thread.start()
+
+def get_notification_queue_stats():
+    """发送队列各状态的消息数量"""
+    with db_connection() as conn:
+        rows = conn.execute('SELECT status, COUNT(*) FROM notification_queue GROUP BY status').fetchall()
+    return dict(rows)
+
+def cleanup_notification_queue():
+    """清理7天前已完成（发送成功或最终失败）的队列消息，返回删除的条数"""
+    condition = "status IN ('sent', 'failed') AND created_at < ?"
+    params = (utc_now_str(-7 * 24 * 3600),)
+    deleted_count = process_rowid_batches(
+        'notification_queue', condition, params,
+        lambda conn, low, high: conn.execute(f'DELETE FROM notification_queue WHERE rowid >= ? AND rowid < ? AND {condition}',
+                                             (low, high) + params).rowcount)
+    if deleted_count > 0:
+        notify_logger.info(f"清理了 {deleted_count} 条旧的队列消息")
+    return deleted_count
 
 def is_time_to_notify(notification_time, task_timezone='Asia/Shanghai'):
     """检查当前时间是否到了通知时间（基于任务时区）- 精确匹配"""
     try:
         # 获取任务时区的当前时间
-        tz = pytz.timezone(task_timezone)
+        tz = get_timezone(task_timezone)
         now = datetime.now(tz)
         
         notify_hour, notify_minute = map(int, notification_time.split(':'))
@@ -258,11 +1576,11 @@ def is_time_to_notify(notification_time, task_timezone='Asia/Shanghai'):
         is_exact_time = (current_hour == notify_hour and current_minute == notify_minute)
         
         if is_exact_time:
-            logging.info(f"精确时间匹配: {now.strftime('%H:%M')} = {notification_time} (时区: {task_timezone})")
+            reminder_todo_logger.info("精确时间匹配: %02d:%02d = %s (时区: %s)", now.hour, now.minute, notification_time, task_timezone)
         
         return is_exact_time
     except Exception as e:
-        logging.error(f"检查通知时间时出错: {e}")
+        reminder_logger.error(f"检查通知时间时出错: {e}")
         return False
 
 def should_send_reminder(days_until_due, reminder_settings):
@@ -302,244 +1620,1213 @@ def should_send_reminder(days_until_due, reminder_settings):
     
     return False, None, None
 
-def is_reminder_already_sent(todo_id, reminder_key):
-    """检查提醒是否已经发送过（使用数据库记录）"""
-    conn = sqlite3.connect('todolist.db')
+def reminder_rule_ctes(settings=None):
+    """提醒规则的 SQL 实现（与 should_send_reminder 等价），作用于 candidates(id, days_until_due, ...)，id 需唯一
+    
+    settings 为 None 时读取 reminder_settings 表中启用的设置，否则使用给定的天数列表。
+    返回 (CTE 片段, 参数)，生成的 rules 增加 trigger_days 和 reminder_type 两列。
+    """
+    if settings is None:
+        source, params = 'SELECT DISTINCT days_before FROM reminder_settings WHERE is_active = 1', []
+    elif settings:
+        source, params = 'VALUES ' + ','.join('(?)' for _ in settings), list(settings)
+    else:
+        source, params = 'SELECT NULL WHERE 0', []
+    
+    # 精确匹配优先；否则 ≤7天时取最接近的每日设置（距离相同取较大的天数，与按天数降序遍历一致）
+    ctes = f'''active_settings(days_before) AS ({source}),
+    closest AS (
+        SELECT cand.id, s.days_before,
+               ROW_NUMBER() OVER (PARTITION BY cand.id
+                                  ORDER BY ABS(s.days_before - cand.days_until_due), s.days_before DESC) AS rn
+        FROM candidates cand
+        JOIN active_settings s ON s.days_before <= 7
+    ),
+    matched AS (
+        SELECT cand.*, exact.days_before AS exact_days, closest.days_before AS closest_days
+        FROM candidates cand
+        LEFT JOIN (SELECT DISTINCT days_before FROM active_settings) exact
+               ON exact.days_before = cand.days_until_due
+        LEFT JOIN closest ON closest.id = cand.id AND closest.rn = 1
+    ),
+    rules AS (
+        SELECT matched.*, COALESCE(exact_days, closest_days) AS trigger_days,
+               CASE WHEN COALESCE(exact_days, closest_days) <= 7 THEN 'daily' ELSE 'once' END AS reminder_type
+        FROM matched
+        WHERE exact_days IS NOT NULL
+           OR (days_until_due <= 7 AND days_until_due <= closest_days)
+    )'''
+    return ctes, params
+
+def evaluate_due_reminders(conn, today_str, now_utc=None, todo_ids=None):
+    """一次查询判断本分钟需要发送提醒的任务
+    
+    按 notify_utc_minute 索引取出本分钟通知的任务，在 SQL 中完成到期天数计算、提醒规则匹配
+    （reminder_rule_ctes），并对 reminder_logs 做反连接排除已发送的提醒，提醒key格式与逐条处理时一致。
+    各时区的当前时间在 Python 中计算一次后作为参数传入；todo_ids 不为空时只判断这些任务
+    （调度线程本批到期的任务、发件箱补发），按 REMINDER_EVALUATE_CHUNK_SIZE 分多次查询。
+    """
+    now_utc = now_utc or datetime.now(pytz.utc)
+    if todo_ids and len(todo_ids) > REMINDER_EVALUATE_CHUNK_SIZE:
+        todo_ids = list(todo_ids)
+        return [row for i in range(0, len(todo_ids), REMINDER_EVALUATE_CHUNK_SIZE)
+                for row in evaluate_due_reminders(conn, today_str, now_utc,
+                                                  todo_ids[i:i + REMINDER_EVALUATE_CHUNK_SIZE])]
+    utc_minute = now_utc.hour * 60 + now_utc.minute
+    id_filter = f"AND id IN ({','.join('?' for _ in todo_ids)})" if todo_ids else ''
+    id_params = list(todo_ids or [])
+    
+    tz_rows = []
+    for (timezone,) in conn.execute(f'''SELECT DISTINCT COALESCE(timezone, 'Asia/Shanghai') FROM todos
+                                        WHERE status = 'pending' AND notify_utc_minute = ? {id_filter}''',
+                                    [utc_minute] + id_params):
+        try:
+            local_now = now_utc.astimezone(get_timezone(timezone))
+        except pytz.UnknownTimeZoneError:
+            reminder_logger.error(f"未知时区: {timezone}")
+            continue
+        tz_rows.append((timezone, local_now.strftime('%Y-%m-%d'), f"{local_now.hour:02d}",
+                        f"{local_now.minute:02d}", local_now.strftime('%Y-%m-%d %H:%M:%S')))
+    if not tz_rows:
+        return []
+    
+    rule_ctes, rule_params = reminder_rule_ctes()
+    sql = f'''WITH tz_now(timezone, local_date, local_hour, local_min, local_now) AS (
+        VALUES {','.join('(?, ?, ?, ?, ?)' for _ in tz_rows)}
+    ),
+    candidates AS (
+        SELECT t.id, t.title, t.description, t.due_date, t.priority, t.robot_id,
+               z.timezone, z.local_hour, z.local_min, z.local_now,
+               CAST(julianday(t.due_date) - julianday(z.local_date) AS INTEGER) AS days_until_due
+        FROM todos t
+        JOIN tz_now z ON z.timezone = COALESCE(t.timezone, 'Asia/Shanghai')
+        WHERE t.notify_utc_minute = ? AND t.status = 'pending' AND t.due_date IS NOT NULL
+        {id_filter.replace('id IN', 't.id IN')}
+    ),
+    {rule_ctes},
+    keyed AS (
+        SELECT rules.*,
+               CASE WHEN reminder_type = 'daily'
+                    THEN id || '_' || ? || '_' || local_hour || '_' || local_min || '_daily_' || trigger_days
+                    ELSE id || '_once_' || days_until_due || 'days' END AS reminder_key
+        FROM rules
+    )
+    SELECT keyed.* FROM keyed
+    LEFT JOIN reminder_logs l ON l.todo_id = keyed.id AND l.reminder_key = keyed.reminder_key
+    WHERE l.id IS NULL OR l.status = 'failed'
+    ORDER BY keyed.id'''
+    params = [value for row in tz_rows for value in row] + [utc_minute] + id_params + rule_params + [today_str]
+    
     c = conn.cursor()
-    c.execute('SELECT id FROM reminder_logs WHERE todo_id = ? AND reminder_key = ?', 
-              (todo_id, reminder_key))
-    result = c.fetchone()
-    conn.close()
-    return result is not None
+    c.row_factory = dict_factory
+    c.execute(sql, params)
+    return c.fetchall()
+
+def reminder_rule_check_settings(count=200, seed=42):
+    """规则一致性检查用的提醒设置组合：每日（≤7天）、单次（>7天）及混合的边界情况，加上随机组合"""
+    import random
+    rng = random.Random(seed)
+    settings_lists = [[], [0], [7], [8], [1, 3], [2, 4], [0, 1, 3, 7, 15, 30], [5, 9, 10], [3, 7, 8, 14]]
+    settings_lists += [rng.sample(range(0, 40), rng.randint(1, 6)) for _ in range(count)]
+    return settings_lists
+
+def check_reminder_rule_equivalence(conn, settings_lists, days_range=range(-30, 400)):
+    """对比 SQL 规则与 should_send_reminder 的判断结果，返回不一致的 (设置, 天数, SQL结果, Python结果)"""
+    mismatches = []
+    days = list(days_range)
+    for settings in settings_lists:
+        rule_ctes, rule_params = reminder_rule_ctes(settings)
+        rows = conn.execute(f'''WITH candidates(id, days_until_due) AS (
+                                   VALUES {','.join('(?, ?)' for _ in days)}
+                               ),
+                               {rule_ctes}
+                               SELECT days_until_due, reminder_type, trigger_days FROM rules''',
+                            [value for d in days for value in (d, d)] + rule_params).fetchall()
+        sql_results = {d: (True, reminder_type, trigger_days) for d, reminder_type, trigger_days in rows}
+        
+        ordered = [{"days_before": d} for d in sorted(settings, reverse=True)]
+        for d in days:
+            expected = should_send_reminder(d, ordered)
+            actual = sql_results.get(d, (False, None, None))
+            if actual != expected:
+                mismatches.append((sorted(settings), d, actual, expected))
+    return mismatches
+
+class ReminderDedupCache:
+    """按天分桶的已处理提醒缓存，只保留最近几天的桶，内存占用有上限"""
+    
+    def __init__(self, retention_days=2):
+        self.retention_days = retention_days
+        self.buckets = {}  # 日期(中国时间) -> 当天处理过的提醒key
+        self._lock = threading.Lock()
+    
+    def _current_bucket(self):
+        today = get_china_time().strftime('%Y-%m-%d')
+        bucket = self.buckets.get(today)
+        if bucket is None:
+            bucket = self.buckets[today] = set()
+            # 跨天时淘汰过期的桶
+            for day in sorted(self.buckets)[:-self.retention_days]:
+                del self.buckets[day]
+        return bucket
+    
+    def add(self, reminder_key):
+        with self._lock:
+            self._current_bucket().add(reminder_key)
+    
+    def discard(self, reminder_key):
+        with self._lock:
+            for bucket in self.buckets.values():
+                bucket.discard(reminder_key)
+    
+    def __contains__(self, reminder_key):
+        with self._lock:
+            return any(reminder_key in bucket for bucket in self.buckets.values())
+    
+    def __len__(self):
+        with self._lock:
+            return sum(len(bucket) for bucket in self.buckets.values())
+    
+    def warm_load(self):
+        """启动时从 reminder_logs 加载今天（中国时间）已发送的提醒"""
+        today_start = CHINA_TZ.localize(datetime.combine(get_china_time().date(), datetime.min.time()))
+        with db_connection() as conn:
+            rows = conn.execute("SELECT reminder_key FROM reminder_logs WHERE sent_at >= ? AND status != 'failed'",
+                                (today_start.astimezone(pytz.utc).strftime(FIRE_TIME_FORMAT),)).fetchall()
+        with self._lock:
+            self._current_bucket().update(key for key, in rows)
+        reminder_logger.info(f"已加载今日提醒记录到内存缓存: {len(rows)} 条")
+    
+    def stats(self):
+        """各桶的大小和估算的内存占用（字节）"""
+        with self._lock:
+            memory = sum(sys.getsizeof(bucket) + sum(sys.getsizeof(key) for key in bucket)
+                         for bucket in self.buckets.values())
+            return {
+                "buckets": {day: len(bucket) for day, bucket in sorted(self.buckets.items())},
+                "retention_days": self.retention_days,
+                "memory_bytes": memory
+            }
+
+# 已处理提醒的内存缓存（数据库 reminder_logs 之前的第一道防重复检查）
+processed_reminders = ReminderDedupCache()
 
 def record_reminder_sent(todo_id, reminder_key, reminder_type, days_before):
     """记录已发送的提醒（使用数据库记录）"""
-    conn = sqlite3.connect('todolist.db')
-    c = conn.cursor()
+    with db_connection() as conn:
+        c = conn.cursor()
+        try:
+            c.execute('INSERT INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before) VALUES (?, ?, ?, ?)', 
+                      (todo_id, reminder_key, reminder_type, days_before))
+            conn.commit()
+            reminder_todo_logger.info("记录提醒发送: todo_id=%s, key=%s, type=%s, days=%s", todo_id, reminder_key, reminder_type, days_before)
+            return True
+        except sqlite3.IntegrityError:
+            # 如果已存在，说明已经发送过
+            conn.rollback()
+            reminder_logger.warning(f"提醒已存在: todo_id={todo_id}, key={reminder_key}")
+            return False
+        except Exception as e:
+            conn.rollback()
+            reminder_logger.error(f"记录提醒发送失败: {e}")
+            return False
+
+def claim_reminders(todos):
+    """在一个事务内批量占用提醒，返回本批占用成功的 (todo_id, reminder_key)
+    
+    INSERT OR IGNORE 语义写入 reminder_logs（唯一约束保证并发时只有一方发送），之前入队或发送失败
+    （status='failed'）的提醒可以重新占用；写入时带上本批的 claim_token，提交前读回占用成功的记录。
+    """
+    claim_token = uuid.uuid4().hex
+    rows = [(todo['id'], todo['reminder_key'], todo['reminder_type'], todo['days_until_due'], claim_token)
+            for todo in todos]
+    todo_ids = sorted({todo['id'] for todo in todos})
+    won = set()
+    with db_connection() as conn:
+        try:
+            conn.executemany("""INSERT INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before, status, claim_token)
+                                VALUES (?, ?, ?, ?, 'claimed', ?)
+                                ON CONFLICT(todo_id, reminder_key) DO UPDATE
+                                SET status = 'claimed', claim_token = excluded.claim_token, queue_id = NULL,
+                                    sent_at = CURRENT_TIMESTAMP
+                                WHERE status = 'failed'""", rows)
+            for i in range(0, len(todo_ids), 500):
+                chunk = todo_ids[i:i + 500]
+                won.update(conn.execute(f'''SELECT todo_id, reminder_key FROM reminder_logs
+                                            WHERE todo_id IN ({','.join('?' * len(chunk))}) AND claim_token = ?''',
+                                        chunk + [claim_token]).fetchall())
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return won
+
+def mark_reminder_claims_failed(claims):
+    """消息未能入队或最终发送失败时把提醒记录标记为失败并清理内存缓存，之后的补发可以重新占用"""
     try:
-        c.execute('INSERT INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before) VALUES (?, ?, ?, ?)', 
-                  (todo_id, reminder_key, reminder_type, days_before))
-        conn.commit()
-        logging.info(f"记录提醒发送: todo_id={todo_id}, key={reminder_key}, type={reminder_type}, days={days_before}")
-        return True
-    except sqlite3.IntegrityError:
-        # 如果已存在，说明已经发送过
-        logging.warning(f"提醒已存在: todo_id={todo_id}, key={reminder_key}")
-        return False
+        with db_connection() as conn:
+            conn.executemany("UPDATE reminder_logs SET status = 'failed' WHERE todo_id = ? AND reminder_key = ?", claims)
+            conn.commit()
+        for _, reminder_key in claims:
+            processed_reminders.discard(reminder_key)
+            reminder_logger.warning(f"发送失败，提醒记录已标记失败: {reminder_key}")
     except Exception as e:
-        logging.error(f"记录提醒发送失败: {e}")
-        return False
-    finally:
-        conn.close()
+        reminder_logger.error(f"标记失败提醒记录时出错: {e}")
+
+def enqueue_reminder_messages(entries):
+    """在一个事务内把提醒消息加入发送队列，并把对应的提醒记录标记为已入队、关联队列消息 id
+    
+    entries 为 [(robot_id, msgtype, content, [(todo_id, reminder_key), ...])]；
+    队列消息发送成功或最终失败时，发送线程按 queue_id 更新提醒记录的状态。
+    """
+    claims = [claim for _, _, _, entry_claims in entries for claim in entry_claims]
+    try:
+        with db_connection() as conn:
+            try:
+                links = []
+                for robot_id, msgtype, content, entry_claims in entries:
+                    c = conn.execute('INSERT INTO notification_queue (robot_id, msgtype, content) VALUES (?, ?, ?)',
+                                     (robot_id, msgtype, content))
+                    links.extend((c.lastrowid, todo_id, reminder_key) for todo_id, reminder_key in entry_claims)
+                conn.executemany('''UPDATE reminder_logs SET status = 'queued', queue_id = ?
+                                    WHERE todo_id = ? AND reminder_key = ?''', links)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    except Exception as e:
+        notify_logger.error(f"提醒消息加入发送队列失败: {e}")
+        mark_reminder_claims_failed(claims)
+        return False, f"加入发送队列失败: {e}"
+    
+    notification_wakeup.set()
+    return True, "已加入发送队列"
 
-def process_single_todo_reminder(todo, reminder_settings, today_str, china_now):
-    """处理单个任务的提醒 - 新提醒规则版本"""
+def build_reminder_message(todo):
+    """根据 evaluate_due_reminders 返回的行渲染提醒消息，返回 (msgtype, content)"""
+    days_until_due = todo['days_until_due']
+    if todo['reminder_type'] == "daily":
+        if days_until_due > 0:
+            name = 'reminder_daily'
+        elif days_until_due == 0:
+            name = 'reminder_due_today'
+        else:
+            name = 'reminder_overdue'
+    else:  # once
+        name = 'reminder_once'
+    
+    # 提醒时间 local_now 由 evaluate_due_reminders 按时区每分钟格式化一次
+    context = {
+        'title': todo['title'],
+        'description': todo['description'] or '无',
+        'due_date': todo['due_date'],
+        'priority': todo['priority'],
+        'days_until_due': days_until_due,
+        'overdue_days': abs(days_until_due) if days_until_due < 0 else 0,
+        'trigger_days': todo['trigger_days'],
+        'reminder_type': todo['reminder_type'],
+        'local_now': todo['local_now'],
+        'timezone': todo['timezone'],
+    }
+    return render_message(name, context, todo['robot_id'] or 1)
+
+def send_reminder_batch(todos, digests=None):
+    """发送一批任务的提醒 - todos 为 evaluate_due_reminders 返回的行（已判定本分钟需要提醒），返回占用成功的提醒数
+    
+    先批量占用提醒（claim_reminders），只为占用成功的任务生成消息；传入 digests（robot_id -> 待合并提醒列表）
+    时只收集消息，由调用方合并后统一入队，否则本批消息在一个事务内入队。
+    """
+    # 内存级别的防重复检查（数据库中已发送的提醒在查询时已排除）
+    todos = [todo for todo in todos if todo['reminder_key'] not in processed_reminders]
+    if not todos:
+        return 0
+    
     try:
-        # 使用任务的时区
-        task_tz = pytz.timezone(todo['timezone'])
-        task_now = datetime.now(task_tz)
+        won = claim_reminders(todos)
+    except Exception as e:
+        reminder_logger.error(f"占用提醒记录失败: {e}")
+        return 0
+    
+    entries = []
+    for todo in todos:
+        reminder_key = todo['reminder_key']
+        # 未占用成功的提醒已由其他进程或之前的周期处理
+        processed_reminders.add(reminder_key)
+        if (todo['id'], reminder_key) not in won:
+            continue
         
-        due_date = datetime.strptime(todo['due_date'], '%Y-%m-%d')
-        days_until_due = (due_date.date() - task_now.date()).days
+        reminder_todo_logger.info("准备发送提醒: %s - %s - 类型: %s - 距离到期: %s天",
+                                  todo['title'], reminder_key, todo['reminder_type'], todo['days_until_due'])
+        msgtype, message = build_reminder_message(todo)
+        if digests is not None:
+            digests.setdefault(todo['robot_id'] or 1, []).append((todo['id'], reminder_key, msgtype, message))
+        else:
+            entries.append((todo['robot_id'] or 1, msgtype, message, [(todo['id'], reminder_key)]))
+    
+    if entries:
+        success, error_msg = enqueue_reminder_messages(entries)
+        if not success:
+            reminder_logger.error(f"❌ 提醒入队失败: {len(entries)} 条 - {error_msg}")
+            return 0
+        reminder_todo_logger.info("✅ 提醒已加入发送队列: %s 条", len(entries))
+    return len(won)
+
+def truncate_utf8(text, max_bytes):
+    """按 UTF-8 字节数截断文本，不会截断半个字符"""
+    encoded = text.encode('utf-8')
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes - 3].decode('utf-8', errors='ignore') + '...'
+
+def build_digest_messages(messages, msgtype='text'):
+    """把同一机器人的多条提醒合并为若干条汇总消息，每条不超过企业微信的长度限制
+    
+    返回 [(汇总消息, 包含的提醒在 messages 中的下标)]；news 类型按图文条数上限合并图文列表
+    """
+    if msgtype == 'news':
+        articles = [(position, article) for position, message in enumerate(messages) for article in json.loads(message)]
+        return [(json.dumps([article for _, article in articles[i:i + WECOM_NEWS_MAX_ARTICLES]], ensure_ascii=False),
+                 sorted({position for position, _ in articles[i:i + WECOM_NEWS_MAX_ARTICLES]}))
+                for i in range(0, len(articles), WECOM_NEWS_MAX_ARTICLES)]
+    
+    if len(messages) == 1:
+        return [(truncate_utf8(messages[0], WECOM_MESSAGE_MAX_BYTES[msgtype]), [0])]
+    
+    separator = '\n\n────────────\n\n'
+    # 预留标题的长度，标题在分组完成后才知道总页数
+    limit = WECOM_MESSAGE_MAX_BYTES[msgtype] - 96
+    separator_bytes = len(separator.encode('utf-8'))
+    
+    chunks = []
+    current, current_bytes = [], 0
+    for position, message in enumerate(messages):
+        message = truncate_utf8(message, limit)
+        size = len(message.encode('utf-8'))
+        if current and current_bytes + separator_bytes + size > limit:
+            chunks.append(current)
+            current, current_bytes = [], 0
+        current_bytes += size + (separator_bytes if current else 0)
+        current.append((position, message))
+    if current:
+        chunks.append(current)
+    
+    digests = []
+    for index, chunk in enumerate(chunks, 1):
+        page = f" ({index}/{len(chunks)})" if len(chunks) > 1 else ""
+        if msgtype == 'markdown':
+            title = f"### 📋 待办事项提醒汇总{page}\n共 {len(chunk)} 条提醒\n\n"
+        else:
+            title = f"📋 待办事项提醒汇总{page}\n共 {len(chunk)} 条提醒\n\n"
+        digests.append((title + separator.join(message for _, message in chunk),
+                        [position for position, _ in chunk]))
+    return digests
+
+def flush_reminder_digests(digests):
+    """把本分钟收集到的提醒按机器人合并后在一个事务内入队，返回入队的消息条数"""
+    entries = []
+    for robot_id, items in digests.items():
+        # 不同模板的消息类型可能不同，按消息类型分别合并；文本提醒按 REMINDER_DIGEST_MSGTYPE 合并
+        by_msgtype = {}
+        for item in items:
+            by_msgtype.setdefault(item[2], []).append(item)
+        for msgtype, group in by_msgtype.items():
+            digest_msgtype = REMINDER_DIGEST_MSGTYPE if msgtype == 'text' else msgtype
+            for message, positions in build_digest_messages([item[3] for item in group], digest_msgtype):
+                entries.append((robot_id, digest_msgtype, message,
+                                [(group[position][0], group[position][1]) for position in positions]))
+    if not entries:
+        return 0
+    
+    success, error_msg = enqueue_reminder_messages(entries)
+    if not success:
+        reminder_logger.error(f"❌ 合并提醒入队失败: {error_msg}")
+        return 0
+    for robot_id, items in digests.items():
+        reminder_logger.info(f"✅ 合并提醒已加入发送队列: 机器人 {robot_id} - 提醒 {len(items)} 条, "
+                             f"消息 {sum(1 for entry in entries if entry[0] == robot_id)} 条")
+    return len(entries)
+
+ARCHIVE_TODO_COLUMNS = ('id, title, description, due_date, priority, status, created_at, reminder_sent, robot_id, '
+                        'notification_time, last_notification_date, user_id, timezone, completed_at')
+ARCHIVE_LOG_COLUMNS = 'id, todo_id, reminder_key, reminder_type, days_before, sent_at, status'
+
+def process_rowid_batches(table, condition, params, action):
+    """按 rowid 范围分批处理 table 中满足 condition 的行，返回处理的总行数
+    
+    先取满足条件的最大 rowid 作为上界，再从最小 rowid 开始每次处理 ARCHIVE_BATCH_SIZE 个 rowid 的范围：
+    每批一个只做主键范围扫描的短 IMMEDIATE 事务，action(conn, 下界, 上界) 返回该批处理的行数，
+    批次之间暂停让出写锁，网页请求和提醒调度不会被长时间阻塞。
+    """
+    with db_connection() as conn:
+        # rowid + 0 关闭 MAX(rowid) 从表尾倒序扫描的优化，改走条件列上的索引，只扫描待处理的旧行
+        high = conn.execute(f'SELECT MAX(rowid + 0) FROM {table} WHERE {condition}', params).fetchone()[0]
+        low = conn.execute(f'SELECT MIN(rowid) FROM {table}').fetchone()[0]
+    total = 0
+    while high is not None and low is not None and low <= high:
+        upper = min(low + ARCHIVE_BATCH_SIZE, high + 1)
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                total += action(conn, low, upper)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            # 跳过 rowid 空洞
+            low = conn.execute(f'SELECT MIN(rowid) FROM {table} WHERE rowid >= ?', (upper,)).fetchone()[0]
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+    return total
+
+def archive_in_batches(select_sql, params, move):
+    """分批归档：每批在一个 IMMEDIATE 事务里选出 id 并调用 move(conn, 占位符, ids)，批次之间让出写锁"""
+    total = 0
+    while True:
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                ids = [row[0] for row in conn.execute(select_sql, params + (ARCHIVE_BATCH_SIZE,))]
+                if ids:
+                    move(conn, ','.join('?' * len(ids)), ids)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        total += len(ids)
+        if len(ids) < ARCHIVE_BATCH_SIZE:
+            return total
+        time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+def archive_old_reminder_logs():
+    """把7天前的提醒记录按 rowid 范围分批移到 reminder_logs_archive，返回归档的条数"""
+    params = (utc_now_str(-REMINDER_LOG_RETENTION_DAYS * 86400),)
+    
+    def move(conn, low, high):
+        conn.execute(f'''INSERT OR IGNORE INTO reminder_logs_archive ({ARCHIVE_LOG_COLUMNS})
+                         SELECT {ARCHIVE_LOG_COLUMNS} FROM reminder_logs
+                         WHERE rowid >= ? AND rowid < ? AND sent_at < ?''', (low, high) + params)
+        return conn.execute('DELETE FROM reminder_logs WHERE rowid >= ? AND rowid < ? AND sent_at < ?',
+                            (low, high) + params).rowcount
+    
+    archived_count = process_rowid_batches('reminder_logs', 'sent_at < ?', params, move)
+    if archived_count > 0:
+        reminder_logger.info(f"归档了 {archived_count} 条旧的提醒日志")
+    return archived_count
+
+def purge_archived_reminder_logs():
+    """删除超过 REMINDER_LOG_ARCHIVE_RETENTION_DAYS 天的归档提醒记录，返回删除的条数"""
+    if REMINDER_LOG_ARCHIVE_RETENTION_DAYS <= 0:
+        return 0
+    params = (utc_now_str(-REMINDER_LOG_ARCHIVE_RETENTION_DAYS * 86400),)
+    deleted_count = process_rowid_batches(
+        'reminder_logs_archive', 'sent_at < ?', params,
+        lambda conn, low, high: conn.execute('DELETE FROM reminder_logs_archive WHERE rowid >= ? AND rowid < ? AND sent_at < ?',
+                                             (low, high) + params).rowcount)
+    if deleted_count > 0:
+        reminder_logger.info(f"删除了 {deleted_count} 条过期的归档提醒日志")
+    return deleted_count
+
+def archive_completed_todos():
+    """把完成超过 ARCHIVE_TODOS_AFTER_DAYS 天的任务连同提醒记录分批移到归档表，返回归档的任务数"""
+    def move(conn, placeholders, ids):
+        conn.execute(f'''INSERT OR IGNORE INTO todos_archive ({ARCHIVE_TODO_COLUMNS})
+                         SELECT {ARCHIVE_TODO_COLUMNS} FROM todos WHERE id IN ({placeholders})''', ids)
+        conn.execute(f'''INSERT OR IGNORE INTO reminder_logs_archive ({ARCHIVE_LOG_COLUMNS})
+                         SELECT {ARCHIVE_LOG_COLUMNS} FROM reminder_logs WHERE todo_id IN ({placeholders})''', ids)
+        conn.execute(f'DELETE FROM reminder_logs WHERE todo_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM reminder_outbox WHERE todo_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM todos WHERE id IN ({placeholders})', ids)
+    
+    archived_count = archive_in_batches('''SELECT id FROM todos WHERE status = 'completed' AND completed_at < ?
+                                           ORDER BY completed_at LIMIT ?''',
+                                        (utc_now_str(-ARCHIVE_TODOS_AFTER_DAYS * 86400),), move)
+    if archived_count > 0:
+        reminder_logger.info(f"归档了 {archived_count} 个已完成任务")
+    return archived_count
+
+def cleanup_reminder_outbox():
+    """超过宽限窗口仍未处理的发件箱记录标记为过期，删除7天前的已处理记录，返回删除的条数"""
+    with db_connection() as conn:
+        c = conn.execute('''UPDATE reminder_outbox SET status = 'expired', processed_at = ?
+                            WHERE status = 'pending' AND scheduled_at < ?''',
+                         (utc_now_str(), utc_now_str(-REMINDER_GRACE_MINUTES * 60)))
+        expired_count = c.rowcount
+        conn.commit()
+    if expired_count:
+        reminder_logger.warning(f"发件箱中 {expired_count} 条提醒超过宽限窗口（{REMINDER_GRACE_MINUTES} 分钟）未发送，已标记过期")
+    
+    condition = "status != 'pending' AND scheduled_at < ?"
+    params = (utc_now_str(-7 * 86400),)
+    deleted_count = process_rowid_batches(
+        'reminder_outbox', condition, params,
+        lambda conn, low, high: conn.execute(f'DELETE FROM reminder_outbox WHERE rowid >= ? AND rowid < ? AND {condition}',
+                                             (low, high) + params).rowcount)
+    if deleted_count:
+        reminder_logger.info(f"清理了 {deleted_count} 条旧的发件箱记录")
+    return deleted_count
+
+def incremental_vacuum():
+    """auto_vacuum=INCREMENTAL 时分批归还空闲页，返回归还的页数（未启用时返回 None）"""
+    with db_connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            return None
+        initial_pages = free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        while free_pages:
+            # incremental_vacuum 每执行一步释放一页，executescript 会一直执行到结束
+            conn.executescript(f'PRAGMA incremental_vacuum({INCREMENTAL_VACUUM_PAGES});')
+            remaining = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
+            time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+        return initial_pages - free_pages
+
+# 数据保留任务的步骤：(名称, 函数)，按顺序执行，单个步骤失败不影响后续步骤
+RETENTION_STEPS = [
+    ('reminder_logs_archived', archive_old_reminder_logs),
+    ('todos_archived', archive_completed_todos),
+    ('archived_logs_purged', purge_archived_reminder_logs),
+    ('notification_queue_purged', cleanup_notification_queue),
+    ('reminder_outbox_purged', cleanup_reminder_outbox),
+    ('vacuum_pages', incremental_vacuum),
+]
+
+def run_retention_job():
+    """执行一次数据保留任务，返回各步骤处理的行数和耗时"""
+    global last_retention_report
+    report = {"started_at": utc_now_str(), "steps": {}}
+    start = time.perf_counter()
+    for name, step in RETENTION_STEPS:
+        step_start = time.perf_counter()
+        try:
+            rows, error = step(), None
+        except Exception as e:
+            rows, error = None, str(e)
+            db_logger.error(f"数据保留任务步骤 {name} 出错: {e}")
+        seconds = round(time.perf_counter() - step_start, 3)
+        report['steps'][name] = {"rows": rows, "seconds": seconds, "error": error}
+        RETENTION_SECONDS.set(seconds, step=name)
+        if rows:
+            RETENTION_ROWS.inc(rows, step=name)
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    last_retention_report = report
+    
+    summary = ', '.join(f"{name}={result['rows']}" for name, result in report['steps'].items())
+    db_logger.info(f"数据保留任务完成，耗时 {report['seconds']}s: {summary}")
+    return report
+
+def run_maintenance():
+    """数据保留维护线程：只在调度 leader 上每小时执行一次数据保留任务"""
+    db_logger.info("数据保留维护线程启动")
+    time.sleep(MAINTENANCE_START_DELAY_SECONDS)
+    while True:
+        if is_scheduler_leader:
+            try:
+                run_retention_job()
+            except Exception as e:
+                db_logger.error(f"数据保留任务出错: {e}")
+        time.sleep(MAINTENANCE_INTERVAL_SECONDS)
+
+def compute_next_fire_at(todo, reminder_settings, after=None):
+    """计算任务下一次提醒的触发时间（UTC，整分钟），无需再提醒时返回 None"""
+    if not todo.get('due_date') or todo.get('status', 'pending') != 'pending' or not reminder_settings:
+        return None
+    
+    try:
+        tz = get_timezone(todo.get('timezone') or 'Asia/Shanghai')
+        due = datetime.strptime(todo['due_date'], '%Y-%m-%d').date()
+        notify_hour, notify_minute = map(int, (todo.get('notification_time') or '10:30').split(':'))
+    except (ValueError, pytz.UnknownTimeZoneError) as e:
+        reminder_logger.error(f"计算下一次提醒时间出错: todo_id={todo.get('id')} - {e}")
+        return None
+    
+    after = (after or datetime.now(pytz.utc)).replace(second=0, microsecond=0)
+    local_today = after.astimezone(tz).date()
+    max_days = (due - local_today).days
+    
+    # 只有精确匹配的设置天数和 ≤7 天的每日提醒范围可能触发，逾期后每天的结果相同，多看一天即可
+    candidates = {s['days_before'] for s in reminder_settings if s['days_before'] <= max_days}
+    candidates.update(range(min(max_days, 7), min(max_days, 0) - 2, -1))
+    
+    for days_until_due in sorted(candidates, reverse=True):
+        should_remind, _, _ = should_send_reminder(days_until_due, reminder_settings)
+        if not should_remind:
+            continue
         
-        notification_time = todo['notification_time'] or '10:30'
+        fire_day = due - timedelta(days=days_until_due)
+        fire_local = tz.localize(datetime(fire_day.year, fire_day.month, fire_day.day, notify_hour, notify_minute))
+        fire_utc = fire_local.astimezone(pytz.utc)
+        if fire_utc >= after:
+            return fire_utc
+    
+    return None
+
+def push_reminder_heap(todo_id, next_fire_at):
+    """把触发点加入内存堆（仅限已加载的时间窗口内）"""
+    if next_fire_at is None:
+        return
+    with reminder_heap_lock:
+        if reminder_heap_window_end and next_fire_at <= reminder_heap_window_end:
+            heapq.heappush(reminder_heap, (next_fire_at, todo_id))
+    
+    # 新触发点早于调度线程的睡眠目标时提前唤醒
+    if scheduler_next_wakeup and next_fire_at < scheduler_next_wakeup:
+        scheduler_wakeup.set()
+
+def reschedule_todo(todo_id, reminder_settings=None):
+    """任务新增/修改/完成后重新计算并保存下一次触发时间和通知时间对应的 UTC 分钟"""
+    try:
+        if reminder_settings is None:
+            reminder_settings = get_reminder_settings()
         
-        # 检查是否到了通知时间（精确匹配）
-        if not is_time_to_notify(notification_time, todo['timezone']):
-            return False, "不是通知时间"
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.row_factory = dict_factory
+            c.execute('''SELECT id, due_date, status, notification_time,
+                         COALESCE(timezone, 'Asia/Shanghai') as timezone
+                         FROM todos WHERE id = ?''', (todo_id,))
+            todo = c.fetchone()
+            if not todo:
+                return None
+            
+            fire_utc = compute_next_fire_at(todo, reminder_settings)
+            next_fire_at = fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None
+            notify_utc_minute, offset = compute_notify_utc_minute(todo['notification_time'], todo['timezone'])
+            c.execute('UPDATE todos SET next_fire_at = ?, notify_utc_minute = ?, notify_utc_offset = ? WHERE id = ?',
+                      (next_fire_at, notify_utc_minute, offset, todo_id))
+            conn.commit()
         
-        logging.info(f"处理任务提醒: {todo['title']} - 距离到期: {days_until_due}天")
+        push_reminder_heap(todo_id, next_fire_at)
+        return next_fire_at
+    except Exception as e:
+        reminder_logger.error(f"更新任务调度时出错: todo_id={todo_id} - {e}")
+        return None
+
+def rebuild_reminder_schedule(reminder_settings, batch_size=1000, require_lease=True):
+    """重新计算所有待处理任务的下一次触发时间（启动时及提醒设置变化后执行）
+    
+    调度线程调用时每批检查租约，失去租约即停止；基准测试等不运行调度线程的离线调用传 require_lease=False。
+    """
+    start = time.time()
+    now_utc = datetime.now(pytz.utc)
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = dict_factory
         
-        # 使用新的提醒规则判断是否应该提醒
-        should_remind, reminder_type, trigger_days = should_send_reminder(days_until_due, reminder_settings)
+        # 已完成或没有截止日期的任务不再调度
+        c.execute('''UPDATE todos SET next_fire_at = NULL
+                     WHERE next_fire_at IS NOT NULL
+                     AND (status != 'pending' OR due_date IS NULL OR due_date = "")''')
         
-        if not should_remind:
-            return False, f"不在提醒范围内 (距离到期{days_until_due}天，无匹配的提醒设置)"
-        
-        # 根据提醒类型生成不同的提醒key
-        if reminder_type == "daily":
-            # 每日提醒：使用日期+时间作为key
-            reminder_key = f"{todo['id']}_{today_str}_{task_now.hour:02d}_{task_now.minute:02d}_daily_{trigger_days}"
-        else:  # once
-            # 单次提醒：使用天数作为key（不包含具体时间）
-            reminder_key = f"{todo['id']}_once_{days_until_due}days"
-        
-        # 三重防重复检查
-        # 1. 内存级别的防重复检查
-        if reminder_key in processed_reminders:
-            return False, f"内存中已处理: {reminder_key}"
-        
-        # 2. 数据库级别的防重复检查
-        if is_reminder_already_sent(todo['id'], reminder_key):
-            processed_reminders.add(reminder_key)  # 同步到内存
-            return False, f"数据库中已发送: {reminder_key}"
-        
-        # 3. 使用数据库事务确保原子性操作
-        conn = sqlite3.connect('todolist.db')
-        c = conn.cursor()
-        try:
-            # 在事务中再次检查并插入记录
-            c.execute('SELECT id FROM reminder_logs WHERE todo_id = ? AND reminder_key = ?', 
-                      (todo['id'], reminder_key))
-            if c.fetchone():
-                processed_reminders.add(reminder_key)
-                return False, f"事务检查中已发送: {reminder_key}"
+        last_id = 0
+        total = 0
+        while True:
+            # 失去租约后立即停止，由新的 leader 重新执行完整的重建
+            if require_lease and not is_scheduler_leader:
+                reminder_logger.warning(f"提醒调度重建中止（已失去租约）- 已处理任务数: {total}")
+                return
+            c.execute('''SELECT id, due_date, status, notification_time,
+                         COALESCE(timezone, 'Asia/Shanghai') as timezone
+                         FROM todos
+                         WHERE id > ? AND status = 'pending'
+                         AND due_date IS NOT NULL AND due_date != ""
+                         ORDER BY id LIMIT ?''', (last_id, batch_size))
+            todos = c.fetchall()
+            if not todos:
+                break
             
-            # 先插入记录，如果成功则继续发送
-            c.execute('INSERT INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before) VALUES (?, ?, ?, ?)', 
-                      (todo['id'], reminder_key, reminder_type, days_until_due))
+            updates = []
+            for todo in todos:
+                fire_utc = compute_next_fire_at(todo, reminder_settings, now_utc)
+                notify_utc_minute, offset = compute_notify_utc_minute(todo['notification_time'], todo['timezone'], now_utc)
+                updates.append((fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None,
+                                notify_utc_minute, offset, todo['id']))
+            c.executemany('UPDATE todos SET next_fire_at = ?, notify_utc_minute = ?, notify_utc_offset = ? WHERE id = ?',
+                          updates)
             conn.commit()
             
-            # 记录到内存缓存
-            processed_reminders.add(reminder_key)
-            
-        except sqlite3.IntegrityError:
-            # 如果插入失败，说明已经存在
-            processed_reminders.add(reminder_key)
-            return False, f"数据库约束检查已发送: {reminder_key}"
-        except Exception as e:
-            logging.error(f"数据库操作失败: {e}")
-            return False, f"数据库操作失败: {e}"
-        finally:
-            conn.close()
-        
-        # 生成提醒消息
-        if reminder_type == "daily":
-            # 每日提醒消息
-            if days_until_due > 0:
-                reminder_message = f"📅 待办事项每日提醒\n\n标题: {todo['title']}\n描述: {todo['description'] or '无'}\n截止日期: {todo['due_date']}\n优先级: {todo['priority']}\n\n⚠️ 还有 {days_until_due} 天到期，请及时处理！\n\n⏰ 提醒时间: {task_now.strftime('%Y-%m-%d %H:%M:%S')} ({todo['timezone']})\n💡 提醒规则: 距离到期 ≤ 7天时每日提醒 (触发设置: ≤{trigger_days}天)"
-            elif days_until_due == 0:
-                reminder_message = f"🚨 待办事项紧急提醒\n\n标题: {todo['title']}\n描述: {todo['description'] or '无'}\n截止日期: {todo['due_date']}\n优先级: {todo['priority']}\n\n❗ 今天到期，请立即处理！\n\n⏰ 提醒时间: {task_now.strftime('%Y-%m-%d %H:%M:%S')} ({todo['timezone']})\n💡 提醒规则: 当天每日提醒"
-            else:
-                # 逾期提醒
-                overdue_days = abs(days_until_due)
-                reminder_message = f"⏰ 待办事项逾期提醒\n\n标题: {todo['title']}\n描述: {todo['description'] or '无'}\n截止日期: {todo['due_date']}\n优先级: {todo['priority']}\n\n🔴 已逾期 {overdue_days} 天，请尽快处理！\n\n⏰ 提醒时间: {task_now.strftime('%Y-%m-%d %H:%M:%S')} ({todo['timezone']})\n💡 提醒规则: 逾期每日提醒"
-        else:  # once
-            # 单次提醒消息
-            reminder_message = f"🔔 待办事项定时提醒\n\n标题: {todo['title']}\n描述: {todo['description'] or '无'}\n截止日期: {todo['due_date']}\n优先级: {todo['priority']}\n\n📌 距离到期还有 {days_until_due} 天\n\n⏰ 提醒时间: {task_now.strftime('%Y-%m-%d %H:%M:%S')} ({todo['timezone']})\n💡 提醒规则: 提前 {trigger_days} 天单次提醒"
-        
-        logging.info(f"准备发送提醒: {todo['title']} - {reminder_key} - 类型: {reminder_type}")
-        success, error_msg = send_wechat_message(reminder_message, todo['robot_id'] or 1)
+            last_id = todos[-1]['id']
+            total += len(todos)
+    
+    reminder_logger.info(f"提醒调度重建完成 - 任务数: {total}, 耗时: {time.time() - start:.2f}秒")
+
+def refresh_notify_utc_minutes(force=False):
+    """时区的 UTC 偏移变化（夏令时切换）后重新换算该时区任务的 notify_utc_minute
+    
+    偏移每次调用都在内存中比较，时区列表每小时从数据库刷新一次；
+    每行记录了换算时使用的偏移，写入时已按新偏移换算的任务不会被重复调整。
+    """
+    global notify_timezones_loaded_at
+    now_utc = datetime.now(pytz.utc)
+    with db_connection() as conn:
+        if (force or notify_timezones_loaded_at is None
+                or time.monotonic() - notify_timezones_loaded_at > NOTIFY_TIMEZONE_RELOAD_SECONDS):
+            for (timezone,) in conn.execute("SELECT DISTINCT COALESCE(timezone, 'Asia/Shanghai') FROM todos WHERE status = 'pending'"):
+                notify_timezone_offsets.setdefault(timezone, None)
+            notify_timezones_loaded_at = time.monotonic()
         
-        if success:
-            logging.info(f"✅ 提醒发送成功: {todo['title']} ({reminder_key}) - 类型: {reminder_type}")
-            return True, f"发送成功 - {reminder_type}"
-        else:
-            # 如果发送失败，删除数据库记录和内存缓存
+        for timezone, applied_offset in list(notify_timezone_offsets.items()):
             try:
-                conn = sqlite3.connect('todolist.db')
-                c = conn.cursor()
-                c.execute('DELETE FROM reminder_logs WHERE todo_id = ? AND reminder_key = ?', 
-                          (todo['id'], reminder_key))
-                conn.commit()
-                conn.close()
-                processed_reminders.discard(reminder_key)
-                logging.warning(f"发送失败，已清理记录: {reminder_key}")
-            except Exception as cleanup_error:
-                logging.error(f"清理失败记录时出错: {cleanup_error}")
-            
-            logging.error(f"❌ 提醒发送失败: {todo['title']} - {error_msg}")
-            return False, f"发送失败: {error_msg}"
+                offset = get_timezone_offset(timezone, now_utc)
+            except pytz.UnknownTimeZoneError:
+                del notify_timezone_offsets[timezone]
+                continue
+            if offset == applied_offset and not force:
+                continue
             
-    except ValueError as e:
-        logging.error(f"日期格式错误: {todo.get('due_date', 'Unknown')} - {e}")
-        return False, f"日期格式错误: {e}"
-    except Exception as e:
-        logging.error(f"处理任务提醒时出错: {todo.get('title', 'Unknown')} - {e}")
-        return False, f"处理出错: {e}"
+            c = conn.execute('''UPDATE todos
+                                SET notify_utc_minute = ((notify_utc_minute + notify_utc_offset - ?) % 1440 + 1440) % 1440,
+                                    notify_utc_offset = ?
+                                WHERE COALESCE(timezone, 'Asia/Shanghai') = ? AND status = 'pending'
+                                AND notify_utc_offset != ?''', (offset, offset, timezone, offset))
+            conn.commit()
+            notify_timezone_offsets[timezone] = offset
+            if c.rowcount:
+                reminder_logger.info(f"时区 {timezone} 的 UTC 偏移变为 {offset} 分钟，已重新换算 {c.rowcount} 个任务的通知时间")
 
-def cleanup_old_reminder_logs():
-    """清理7天前的提醒日志"""
-    try:
-        conn = sqlite3.connect('todolist.db')
+def load_reminder_heap(now_utc):
+    """从 next_fire_at 索引加载近期窗口内的触发点到内存堆"""
+    global reminder_heap, reminder_heap_window_end
+    window_end = (now_utc + REMINDER_HEAP_WINDOW).strftime(FIRE_TIME_FORMAT)
+    
+    # 持锁查询，避免加载期间其他线程写入的触发点丢失
+    with reminder_heap_lock:
+        with db_connection() as conn:
+            c = conn.cursor()
+            c.execute('''SELECT next_fire_at, id FROM todos
+                         WHERE next_fire_at IS NOT NULL AND next_fire_at <= ?''', (window_end,))
+            entries = c.fetchall()
+        
+        heapq.heapify(entries)
+        reminder_heap = entries
+        reminder_heap_window_end = window_end
+    reminder_logger.info(f"加载提醒调度堆 - 触发点: {len(entries)}, 窗口截止: {window_end} (UTC)")
+
+def pop_due_reminders(minute_end):
+    """弹出触发时间早于 minute_end 的所有触发点"""
+    due = []
+    with reminder_heap_lock:
+        while reminder_heap and reminder_heap[0][0] < minute_end:
+            due.append(heapq.heappop(reminder_heap))
+    return due
+
+def get_reminder_executor():
+    """提醒分片线程池（仅调度线程调用，延迟创建）"""
+    global reminder_executor
+    if reminder_executor is None:
+        reminder_executor = ThreadPoolExecutor(max_workers=REMINDER_SHARDS, thread_name_prefix='reminder')
+    return reminder_executor
+
+def process_reminder_shard(shard_index, todos, deadline):
+    """处理一个分片内的到期任务，按批占用并发送提醒，到达截止时间后剩余任务不再处理"""
+    started = time.monotonic()
+    digests = {} if REMINDER_COALESCE else None
+    processed_count = 0
+    sent_count = 0
+    for i in range(0, len(todos), REMINDER_CLAIM_BATCH_SIZE):
+        if time.monotonic() >= deadline:
+            break
+        batch = todos[i:i + REMINDER_CLAIM_BATCH_SIZE]
+        sent_count += send_reminder_batch(batch, digests)
+        processed_count += len(batch)
+    
+    return {
+        "shard": shard_index,
+        "todos": len(todos),
+        "processed": processed_count,
+        "sent": sent_count,
+        "deferred": len(todos) - processed_count,
+        "duration_ms": round((time.monotonic() - started) * 1000, 1),
+        "digests": digests,
+        "deferred_ids": [todo['id'] for todo in todos[processed_count:]]
+    }
+
+def run_reminder_shards(todos, deadline):
+    """按任务 id 取模分片并行处理，返回各分片结果（只有一个分片有任务时直接在当前线程处理）"""
+    shards = [[] for _ in range(max(REMINDER_SHARDS, 1))]
+    for todo in todos:
+        shards[todo['id'] % len(shards)].append(todo)
+    busy = [(index, shard) for index, shard in enumerate(shards) if shard]
+    
+    if len(busy) <= 1:
+        return [process_reminder_shard(index, shard, deadline) for index, shard in busy]
+    
+    executor = get_reminder_executor()
+    futures = [executor.submit(process_reminder_shard, index, shard, deadline) for index, shard in busy]
+    results = []
+    for (index, shard), future in zip(busy, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            reminder_logger.error(f"提醒分片 {index} 处理出错: {e}")
+            results.append({"shard": index, "todos": len(shard), "processed": 0, "sent": 0,
+                            "deferred": len(shard), "duration_ms": 0.0, "digests": None,
+                            "deferred_ids": [todo['id'] for todo in shard]})
+    return results
+
+def flush_shard_digests(results, to_send):
+    """合并各分片收集的提醒，保持任务原有顺序后加入发送队列"""
+    if not REMINDER_COALESCE:
+        return
+    order = {todo['id']: index for index, todo in enumerate(to_send)}
+    digests = {}
+    for result in results:
+        for robot_id, items in (result['digests'] or {}).items():
+            digests.setdefault(robot_id, []).extend(items)
+    for items in digests.values():
+        items.sort(key=lambda item: order[item[0]])
+    if digests:
+        flush_reminder_digests(digests)
+
+def record_scheduler_cycle(minute_start, due_count, results, cycle_started, catch_up=False):
+    """记录本次调度周期的耗时、分片大小和分片倾斜度（最慢分片耗时 / 平均耗时）"""
+    global scheduler_stats
+    durations = [r['duration_ms'] for r in results]
+    mean_duration = sum(durations) / len(durations) if durations else 0
+    deferred = sum(r['deferred'] for r in results)
+    scheduler_stats = {
+        **scheduler_stats,
+        "cycles": scheduler_stats['cycles'] + 1,
+        "catch_up_cycles": scheduler_stats['catch_up_cycles'] + (1 if catch_up else 0),
+        "deferred_total": scheduler_stats['deferred_total'] + deferred,
+        "last_cycle": {
+            "minute": minute_start,
+            "catch_up": catch_up,
+            "duration_ms": round((time.monotonic() - cycle_started) * 1000, 1),
+            "due": due_count,
+            "processed": sum(r['processed'] for r in results),
+            "sent": sum(r['sent'] for r in results),
+            "deferred": deferred,
+            "shard_skew": round(max(durations) / mean_duration, 2) if mean_duration else 1.0,
+            "shards": [{k: v for k, v in r.items() if k not in ('digests', 'deferred_ids')} for r in results]
+        }
+    }
+
+def get_earliest_fire_at():
+    """数据库中最早的触发点（走 next_fire_at 索引），包含其他进程写入的任务"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT MIN(next_fire_at) FROM todos WHERE next_fire_at IS NOT NULL').fetchone()
+    return row[0] if row else None
+
+def run_due_reminders(minute_start_utc, reminder_settings, catch_up=False):
+    """处理触发时间不晚于指定分钟的触发点，并为处理过的任务计算下一次触发时间
+    
+    catch_up 为 True 时表示补处理已经过去的分钟（线程停顿、进程重启或上一轮超时），
+    提醒规则按该分钟的时间判断，提醒key与准时处理时一致，已发送的不会重复发送。
+    """
+    cycle_started = time.monotonic()
+    minute_start = minute_start_utc.strftime(FIRE_TIME_FORMAT)
+    minute_end_utc = minute_start_utc + timedelta(minutes=1)
+    minute_end = minute_end_utc.strftime(FIRE_TIME_FORMAT)
+    pop_due_reminders(minute_end)
+    
+    if catch_up:
+        deadline = cycle_started + REMINDER_CATCHUP_CYCLE_SECONDS
+    else:
+        # 截止时间设在本分钟结束前，避免拖延下一分钟的提醒；分钟末尾才开始时保证最少处理时间
+        seconds_left = (minute_end_utc - datetime.now(pytz.utc)).total_seconds() - REMINDER_DEADLINE_MARGIN_SECONDS
+        deadline = cycle_started + max(seconds_left, REMINDER_MIN_CYCLE_SECONDS)
+    
+    # 堆只用于唤醒调度线程，到期任务以数据库中的 next_fire_at 为准（其他进程写入的任务也能取到）
+    with db_connection() as conn:
         c = conn.cursor()
+        c.row_factory = dict_factory
+        c.execute('''SELECT id, title, description, due_date, priority, robot_id, status,
+                     reminder_sent, notification_time, last_notification_date, user_id, next_fire_at,
+                     COALESCE(timezone, 'Asia/Shanghai') as timezone
+                     FROM todos
+                     WHERE next_fire_at IS NOT NULL AND next_fire_at < ?
+                     ORDER BY next_fire_at LIMIT ?''', (minute_end, REMINDER_DUE_BATCH_SIZE))
+        todos = c.fetchall()
+        if not todos:
+            return 0, 0
         
-        # 删除7天前的记录
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-        c.execute('DELETE FROM reminder_logs WHERE sent_at < ?', (seven_days_ago,))
-        deleted_count = c.rowcount
+        # 只判断本批取出的、触发点在本分钟的任务（一分钟内超过一批时每批只判断自己的任务）；
+        # 早于本分钟（补发窗口之外）的触发点直接计算下一次
+        due_todos = [todo for todo in todos if todo['next_fire_at'] >= minute_start]
+        today_str = minute_start_utc.astimezone(CHINA_TZ).strftime('%Y-%m-%d')
+        to_send = evaluate_due_reminders(conn, today_str, minute_start_utc,
+                                         [todo['id'] for todo in due_todos]) if due_todos else []
+    
+    results = run_reminder_shards(to_send, deadline)
+    processed_count = sum(r['processed'] for r in results)
+    sent_count = sum(r['sent'] for r in results)
+    
+    # 超时未处理的任务保留原触发点，由下一轮补处理
+    deferred_ids = {todo_id for r in results for todo_id in r['deferred_ids']}
+    updates = []
+    for todo in todos:
+        if todo['id'] in deferred_ids:
+            continue
+        fire_utc = compute_next_fire_at(todo, reminder_settings, minute_end_utc)
+        updates.append((fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None, todo))
+    
+    # 本分钟的触发点已处理，对应的发件箱记录标记完成；更早的触发点（补发窗口之外）留给发件箱补发
+    processed_at = utc_now_str()
+    outbox_done = [(processed_at, todo['id'], todo['next_fire_at']) for todo in due_todos
+                   if todo['id'] not in deferred_ids]
+    
+    # 只在任务仍是读取时的状态时写入（比较 next_fire_at 及计算它用到的字段）：处理期间任务被修改或完成时，
+    # reschedule_todo 已写入新的触发点，不能用旧快照计算的值覆盖，否则会错过修改后的提醒
+    applied = []
+    with db_connection() as conn:
+        for next_fire_at, todo in updates:
+            c = conn.execute('''UPDATE todos SET next_fire_at = ?
+                                WHERE id = ? AND next_fire_at = ? AND status = ?
+                                AND due_date IS ? AND notification_time IS ?
+                                AND COALESCE(timezone, 'Asia/Shanghai') = ?''',
+                             (next_fire_at, todo['id'], todo['next_fire_at'], todo['status'],
+                              todo['due_date'], todo['notification_time'], todo['timezone']))
+            if c.rowcount:
+                applied.append((next_fire_at, todo['id']))
+        conn.executemany('''UPDATE reminder_outbox SET status = 'done', processed_at = ?
+                            WHERE status = 'pending' AND todo_id = ? AND scheduled_at = ?''', outbox_done)
         conn.commit()
-        conn.close()
+    
+    flush_shard_digests(results, to_send)
+    
+    for next_fire_at, todo_id in applied:
+        push_reminder_heap(todo_id, next_fire_at)
+    
+    record_scheduler_cycle(minute_start, len(due_todos), results, cycle_started, catch_up)
+    deferred = scheduler_stats['last_cycle']['deferred']
+    REMINDER_CYCLE_SECONDS.observe(time.monotonic() - cycle_started)
+    REMINDER_TODOS.inc(len(due_todos), stage='due')
+    REMINDER_TODOS.inc(sent_count, stage='sent')
+    REMINDER_TODOS.inc(deferred, stage='deferred')
+    if deferred:
+        reminder_logger.warning(f"⏱️ 本分钟处理超时，{deferred} 个任务的提醒留到下一轮补处理")
+    
+    return processed_count, sent_count
+
+def replay_reminder_outbox(now_utc=None):
+    """补发宽限窗口内已过触发时间、仍未处理的发件箱记录，返回是否还有积压
+    
+    每次最多取 REMINDER_OUTBOX_BATCH_SIZE 条，按触发分钟分组后以该分钟的时间判断提醒规则，
+    reminder_logs 中已有记录的不会重复发送；任务修改后规则不再匹配的记录直接标记完成。
+    """
+    global reminder_outbox_backlog
+    minute_start_utc = (now_utc or datetime.now(pytz.utc)).replace(second=0, microsecond=0)
+    grace_start_utc = minute_start_utc - timedelta(minutes=REMINDER_GRACE_MINUTES)
+    
+    with db_connection() as conn:
+        # 发送队列积压时暂停补发，避免短时间内向机器人堆积大量消息
+        queued = conn.execute("SELECT COUNT(*) FROM notification_queue WHERE status = 'pending'").fetchone()[0]
+        if queued >= REMINDER_OUTBOX_MAX_QUEUED:
+            reminder_outbox_backlog = True
+            return True
+        rows = conn.execute('''SELECT id, todo_id, scheduled_at FROM reminder_outbox
+                               WHERE status = 'pending' AND scheduled_at >= ? AND scheduled_at < ?
+                               ORDER BY scheduled_at LIMIT ?''',
+                            (grace_start_utc.strftime(FIRE_TIME_FORMAT), minute_start_utc.strftime(FIRE_TIME_FORMAT),
+                             REMINDER_OUTBOX_BATCH_SIZE)).fetchall()
+    if not rows:
+        reminder_outbox_backlog = False
+        return False
+    
+    by_minute = {}
+    for outbox_id, todo_id, scheduled_at in rows:
+        by_minute.setdefault(scheduled_at, []).append((outbox_id, todo_id))
+    
+    sent_count = 0
+    deferred_count = 0
+    done = []
+    for scheduled_at, entries in by_minute.items():
+        # 失去租约后停止补发，未处理的记录保持 pending，由新的 leader 补发
+        if not is_scheduler_leader:
+            break
+        fire_minute = pytz.utc.localize(datetime.strptime(scheduled_at, FIRE_TIME_FORMAT))
+        today_str = fire_minute.astimezone(CHINA_TZ).strftime('%Y-%m-%d')
+        with db_connection() as conn:
+            to_send = evaluate_due_reminders(conn, today_str, fire_minute, [todo_id for _, todo_id in entries])
+        
+        results = run_reminder_shards(to_send, time.monotonic() + REMINDER_CATCHUP_CYCLE_SECONDS)
+        flush_shard_digests(results, to_send)
+        deferred_ids = {todo_id for r in results for todo_id in r['deferred_ids']}
+        sent_count += sum(r['sent'] for r in results)
+        deferred_count += len(deferred_ids)
+        processed_at = utc_now_str()
+        done.extend((processed_at, outbox_id) for outbox_id, todo_id in entries if todo_id not in deferred_ids)
+    
+    with db_connection() as conn:
+        conn.executemany("UPDATE reminder_outbox SET status = 'done', processed_at = ? WHERE id = ?", done)
+        conn.commit()
+    
+    REMINDER_TODOS.inc(sent_count, stage='replayed')
+    reminder_logger.info(f"📮 发件箱补发 - 记录: {len(rows)}, 发送提醒: {sent_count}, 未处理完: {deferred_count}")
+    reminder_outbox_backlog = len(rows) == REMINDER_OUTBOX_BATCH_SIZE or deferred_count > 0
+    return reminder_outbox_backlog
+
+def get_scheduler_holder_id():
+    """当前进程的租约持有者标识（fork 后的子进程 pid 不同）"""
+    return f"{socket.gethostname()}:{os.getpid()}:{SCHEDULER_INSTANCE_TOKEN}"
+
+def renew_scheduler_lease():
+    """获取或续约调度器租约，返回当前进程是否为调度 leader"""
+    global is_scheduler_leader, reminder_heap_window_end
+    holder = get_scheduler_holder_id()
+    now = utc_now_str()
+    try:
+        with db_connection() as conn:
+            conn.execute('''INSERT OR IGNORE INTO scheduler_lease (name, holder, acquired_at, heartbeat_at, expires_at)
+                            VALUES (?, ?, ?, ?, ?)''',
+                         (SCHEDULER_LEASE_NAME, holder, now, now, utc_now_str(SCHEDULER_LEASE_TTL_SECONDS)))
+            # 自己持有则续约，其他进程的租约过期则接管
+            c = conn.execute('''UPDATE scheduler_lease
+                                SET acquired_at = CASE WHEN holder = ? THEN acquired_at ELSE ? END,
+                                    holder = ?, heartbeat_at = ?, expires_at = ?
+                                WHERE name = ? AND (holder = ? OR expires_at < ?)''',
+                             (holder, now, holder, now, utc_now_str(SCHEDULER_LEASE_TTL_SECONDS),
+                              SCHEDULER_LEASE_NAME, holder, now))
+            conn.commit()
+            acquired = c.rowcount == 1
+    except sqlite3.Error as e:
+        reminder_logger.error(f"续约调度器租约失败: {e}")
+        acquired = False
+    
+    if acquired and not is_scheduler_leader:
+        reminder_logger.info(f"成为提醒调度 leader: {holder}")
+        # 其他进程期间可能修改过任务，接管后重新计算并加载当天的防重复记录
+        schedule_rebuild_requested.set()
+        try:
+            processed_reminders.warm_load()
+        except Exception as e:
+            reminder_logger.error(f"加载今日提醒记录失败: {e}")
+        is_scheduler_leader = acquired
+        scheduler_wakeup.set()
+    elif not acquired and is_scheduler_leader:
+        reminder_logger.warning(f"失去提醒调度 leader 租约: {holder}")
+        with reminder_heap_lock:
+            reminder_heap_window_end = None
+    
+    is_scheduler_leader = acquired
+    return acquired
+
+def run_lease_heartbeat():
+    """租约心跳线程：独立于调度线程定期续约，长时间的重建或补发不会让租约过期"""
+    while True:
+        try:
+            renew_scheduler_lease()
+        except Exception as e:
+            reminder_logger.error(f"租约心跳出错: {e}")
+        time.sleep(SCHEDULER_LEASE_RENEW_SECONDS)
+
+def release_scheduler_lease():
+    """进程退出时主动释放租约，其他进程无需等待过期即可接管"""
+    if not is_scheduler_leader:
+        return
+    try:
+        with db_connection() as conn:
+            conn.execute('UPDATE scheduler_lease SET expires_at = ? WHERE name = ? AND holder = ?',
+                         (utc_now_str(-1), SCHEDULER_LEASE_NAME, get_scheduler_holder_id()))
+            conn.commit()
+    except Exception as e:
+        reminder_logger.error(f"释放调度器租约失败: {e}")
+
+def get_scheduler_lease_info():
+    """当前租约状态（调试用）"""
+    with db_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = dict_factory
+        c.execute('SELECT holder, acquired_at, heartbeat_at, expires_at FROM scheduler_lease WHERE name = ?',
+                  (SCHEDULER_LEASE_NAME,))
+        lease = c.fetchone() or {}
+    lease['is_leader'] = is_scheduler_leader
+    lease['this_process'] = get_scheduler_holder_id()
+    return lease
+
+def run_scheduler_iteration():
+    """调度线程的一次唤醒：补处理错过的分钟并处理当前分钟到期的触发点"""
+    global last_check_minute
+    now_utc = datetime.now(pytz.utc)
+    minute_start_utc = now_utc.replace(second=0, microsecond=0)
+    minute_end = (minute_start_utc + timedelta(minutes=1)).strftime(FIRE_TIME_FORMAT)
+    
+    # 获取提醒设置
+    reminder_settings = get_reminder_settings()
+    if not reminder_settings:
+        reminder_logger.warning("没有配置提醒设置")
+        return
+    
+    # 夏令时切换后重新换算通知时间对应的 UTC 分钟
+    refresh_notify_utc_minutes()
+    
+    if reminder_heap_window_end is None or reminder_heap_window_end < minute_end:
+        load_reminder_heap(minute_start_utc)
+    
+    # 按触发时间顺序处理到期的分钟：早于当前分钟的是错过的触发点，补处理窗口之外的只计算下一次
+    # （提醒由发件箱补发）；重建调度前先补处理，避免重启后错过的触发点被直接跳过
+    catch_up_start = minute_start_utc - timedelta(minutes=SCHEDULER_CATCHUP_MINUTES)
+    for _ in range(SCHEDULER_MAX_CYCLES_PER_WAKE):
+        earliest = get_earliest_fire_at()
+        if earliest is None or earliest >= minute_end:
+            break
+        fire_minute = pytz.utc.localize(datetime.strptime(earliest, FIRE_TIME_FORMAT)).replace(second=0)
+        fire_minute = max(fire_minute, catch_up_start)
+        catch_up = fire_minute < minute_start_utc
         
-        if deleted_count > 0:
-            logging.info(f"清理了 {deleted_count} 条旧的提醒日志")
-    except Exception as e:
-        logging.error(f"清理提醒日志时出错: {e}")
+        processed_count, sent_count = run_due_reminders(fire_minute, reminder_settings, catch_up)
+        china_minute = fire_minute.astimezone(CHINA_TZ).strftime('%Y-%m-%d %H:%M')
+        last_check_minute = china_minute
+        if processed_count:
+            reminder_logger.info(f"本轮检查完成 - 中国时间: {china_minute}{' (补处理)' if catch_up else ''}, 处理任务: {processed_count}, 发送提醒: {sent_count}, 内存缓存: {len(processed_reminders)}")
+        if scheduler_stats['last_cycle'] and scheduler_stats['last_cycle']['deferred']:
+            break
+    
+    # 当前分钟处理完后再补发发件箱中错过的提醒（如停机期间到期的任务）
+    replay_reminder_outbox(now_utc)
+    
+    # 提醒设置变化后重新计算全部任务
+    if schedule_rebuild_requested.is_set():
+        schedule_rebuild_requested.clear()
+        rebuild_reminder_schedule(reminder_settings)
+        load_reminder_heap(minute_start_utc)
+
+def seconds_until_next_wakeup():
+    """计算调度线程下一次唤醒前的睡眠时间：最早的触发点、下一个整点清理和堆窗口到期中最早的一个"""
+    global scheduler_next_wakeup
+    now_utc = datetime.now(pytz.utc)
+    candidates = [now_utc + timedelta(seconds=SCHEDULER_MAX_SLEEP_SECONDS),
+                  now_utc.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)]
+    
+    earliest = get_earliest_fire_at()
+    with reminder_heap_lock:
+        if reminder_heap and (earliest is None or reminder_heap[0][0] < earliest):
+            earliest = reminder_heap[0][0]
+        window_end = reminder_heap_window_end
+    for fire_at in (earliest, window_end):
+        if fire_at:
+            candidates.append(pytz.utc.localize(datetime.strptime(fire_at, FIRE_TIME_FORMAT)))
+    
+    if reminder_outbox_backlog:
+        candidates.append(now_utc + timedelta(seconds=REMINDER_OUTBOX_RETRY_SECONDS))
+    
+    wakeup = min(candidates)
+    scheduler_next_wakeup = wakeup.strftime(FIRE_TIME_FORMAT)
+    seconds = (wakeup - now_utc).total_seconds()
+    # 触发点已过期（上一轮超时未处理完）时稍后重试，避免空转
+    return seconds if seconds > 0 else SCHEDULER_RETRY_SECONDS
 
 def check_reminders():
-    """检查需要提醒的待办事项（定时检查）- 新提醒规则版本"""
-    global last_check_minute
-    logging.info("提醒检查线程启动 - 新提醒规则版本")
+    """提醒调度线程 - 睡到下一个触发点，任务变化时提前唤醒"""
+    reminder_logger.info("提醒检查线程启动 - 事件唤醒版本")
     
     while True:
+        scheduler_wakeup.clear()
+        timeout = SCHEDULER_MAX_SLEEP_SECONDS
         try:
-            # 获取当前时间
-            current_time = datetime.now()
-            current_minute_key = f"{current_time.hour:02d}:{current_time.minute:02d}"
-            
-            # 防止同一分钟内多次执行
-            if last_check_minute == current_minute_key:
-                time.sleep(10)  # 等待10秒再检查
+            # 多进程部署时只有持有租约的进程执行调度（租约由心跳线程维护，获得租约时唤醒本线程）
+            if not is_scheduler_leader:
+                scheduler_wakeup.wait(SCHEDULER_LEASE_RENEW_SECONDS)
                 continue
             
             # 使用全局锁防止并发执行
             with reminder_lock:
-                # 更新检查时间
-                last_check_minute = current_minute_key
-                
-                # 每小时清理一次旧日志
-                if current_time.minute == 0:  # 每小时的0分钟执行清理
-                    cleanup_old_reminder_logs()
-                
-                conn = sqlite3.connect('todolist.db')
-                conn.row_factory = dict_factory
-                c = conn.cursor()
-                
-                # 获取提醒设置
-                reminder_settings = get_reminder_settings()
-                if not reminder_settings:
-                    logging.warning("没有配置提醒设置")
-                    conn.close()
-                    time.sleep(30)  # 等待30秒再检查
-                    continue
-                
-                # 获取中国时间
-                china_now = get_china_time()
-                today_str = china_now.strftime('%Y-%m-%d')
-                
-                logging.info(f"开始检查提醒 - 中国时间: {china_now.strftime('%Y-%m-%d %H:%M:%S')} - 检查key: {current_minute_key}")
-                
-                # 获取所有待处理的任务
-                c.execute('''SELECT id, title, description, due_date, priority, robot_id, 
-                            reminder_sent, notification_time, last_notification_date, user_id,
-                            COALESCE(timezone, 'Asia/Shanghai') as timezone
-                            FROM todos 
-                            WHERE status = 'pending' 
-                            AND due_date IS NOT NULL 
-                            AND due_date != ""''')
-                
-                todos = c.fetchall()
-                conn.close()
-                
-                logging.info(f"找到 {len(todos)} 个待处理任务")
-                
-                # 处理每个任务
-                processed_count = 0
-                sent_count = 0
-                
-                for todo in todos:
-                    success, message = process_single_todo_reminder(todo, reminder_settings, today_str, china_now)
-                    processed_count += 1
-                    if success:
-                        sent_count += 1
-                
-                logging.info(f"本轮检查完成 - 处理任务: {processed_count}, 发送提醒: {sent_count}, 内存缓存: {len(processed_reminders)}")
-            
+                run_scheduler_iteration()
+            timeout = seconds_until_next_wakeup()
         except Exception as e:
-            logging.error(f"检查提醒时出错: {e}")
+            reminder_logger.error(f"检查提醒时出错: {e}")
         
-        # 等待30秒再进行下一次检查
-        time.sleep(30)
+        scheduler_wakeup.wait(timeout)
 
 # 登录相关路由
 @app.route('/login', methods=['GET', 'POST'])
@@ -550,9 +2837,9 @@ def login():
         password = request.form['password']
         password_hash = hash_password(password)
         
-        conn = sqlite3.connect('todolist.db')
-        conn.row_factory = dict_factory
+        conn = get_db()
         c = conn.cursor()
+        c.row_factory = dict_factory
         c.execute('SELECT * FROM users WHERE username = ? AND password_hash = ?', 
                   (username, password_hash))
         user = c.fetchone()
@@ -567,12 +2854,10 @@ def login():
             c.execute('UPDATE users SET last_login = ? WHERE id = ?', 
                       (china_time.strftime('%Y-%m-%d %H:%M:%S'), user['id']))
             conn.commit()
-            conn.close()
             
             flash(f'欢迎回来，{username}！', 'success')
             return redirect(url_for('index'))
         else:
-            conn.close()
             flash('用户名或密码错误！', 'error')
     
     return render_template('login.html')
@@ -585,24 +2870,114 @@ def logout():
     flash(f'再见，{username}！', 'info')
     return redirect(url_for('login'))
 
+def encode_page_cursor(todo):
+    """把 (created_at, id) 编码为翻页游标"""
+    raw = f"{todo['created_at'] or ''}|{todo['id']}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_page_cursor(cursor):
+    """解析翻页游标，格式错误时返回 None"""
+    try:
+        created_at, todo_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return created_at, int(todo_id)
+    except (ValueError, UnicodeError):
+        return None
+
+def build_todo_filters(user_id, args):
+    """根据查询参数构造任务列表的筛选条件，返回 (条件SQL, 参数, 生效的筛选项)"""
+    conditions = ['t.user_id = ?']
+    params = [user_id]
+    filters = {}
+    
+    status = args.get('status', '')
+    if status in ('pending', 'completed'):
+        conditions.append('t.status = ?')
+        params.append(status)
+        filters['status'] = status
+    
+    priority = args.get('priority', '')
+    if priority in ('low', 'medium', 'high'):
+        conditions.append('t.priority = ?')
+        params.append(priority)
+        filters['priority'] = priority
+    
+    for key, operator in (('due_from', '>='), ('due_to', '<=')):
+        value = args.get(key, '')
+        try:
+            datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            continue
+        conditions.append(f't.due_date {operator} ?')
+        params.append(value)
+        filters[key] = value
+    
+    # 包含已归档的任务时查询 todos_all 视图
+    if args.get('archived') == '1':
+        filters['archived'] = '1'
+    
+    return ' AND '.join(conditions), params, filters
+
+def todo_list_source(filters, where, params, limit):
+    """任务列表查询的数据源，返回 (FROM 子句, 参数)
+    
+    默认只查热表；archived=1 时热表和归档表各按索引取一页再合并，避免对 todos_all 视图整体排序。
+    """
+    if not filters.get('archived'):
+        return 'todos t', []
+    page = 'ORDER BY t.created_at DESC, t.id DESC LIMIT ?'
+    return (f'''(SELECT * FROM (SELECT {ARCHIVE_TODO_COLUMNS}, next_fire_at, 0 AS archived
+                                FROM todos t WHERE {where} {page})
+                 UNION ALL
+                 SELECT * FROM (SELECT {ARCHIVE_TODO_COLUMNS}, NULL, 1
+                                FROM todos_archive t WHERE {where} {page})) t''',
+            params + [limit] + params + [limit])
+
+def estimate_todo_count(conn, where, params, source='todos'):
+    """估算符合条件的任务数，超过上限时不再精确计数"""
+    count = conn.execute(f'''SELECT COUNT(*) FROM
+                             (SELECT 1 FROM {source} t WHERE {where} LIMIT ?)''',
+                         params + [TODO_COUNT_ESTIMATE_LIMIT + 1]).fetchone()[0]
+    if count > TODO_COUNT_ESTIMATE_LIMIT:
+        return f"{TODO_COUNT_ESTIMATE_LIMIT}+"
+    return str(count)
+
 # 主要功能路由（需要登录）
 @app.route('/')
 @login_required
 def index():
-    """主页 - 显示任务列表"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
+    """主页 - 显示任务列表（按创建时间倒序，游标翻页）"""
+    conn = get_db()
     c = conn.cursor()
+    c.row_factory = dict_factory
     
     # 只显示当前用户的任务
     user_id = session['user_id']
-    c.execute('''SELECT t.*, COALESCE(r.name, '默认机器人') as robot_name 
-                 FROM todos t 
-                 LEFT JOIN robots r ON t.robot_id = r.id 
-                 WHERE t.user_id = ?
-                 ORDER BY t.created_at DESC''', (user_id,))
+    where, params, filters = build_todo_filters(user_id, request.args)
+    per_page = min(max(request.args.get('per_page', TODO_PAGE_SIZE, type=int), 1), TODO_PAGE_SIZE_MAX)
+    
+    # 游标翻页：只取比上一页最后一条更早的任务，页码再大也只扫描一页的索引
+    page_where, page_params = where, list(params)
+    cursor = request.args.get('cursor', '')
+    position = decode_page_cursor(cursor) if cursor else None
+    if position:
+        page_where += ' AND (t.created_at < ? OR (t.created_at = ? AND t.id < ?))'
+        page_params += [position[0], position[0], position[1]]
+    
+    source, source_params = todo_list_source(filters, page_where, page_params, per_page + 1)
+    c.execute(f'''SELECT t.*, COALESCE(r.name, '默认机器人') as robot_name 
+                  FROM {source} 
+                  LEFT JOIN robots r ON t.robot_id = r.id 
+                  WHERE {page_where}
+                  ORDER BY t.created_at DESC, t.id DESC
+                  LIMIT ?''', source_params + page_params + [per_page + 1])
     todos = c.fetchall()
-    conn.close()
+    
+    next_cursor = None
+    if len(todos) > per_page:
+        todos = todos[:per_page]
+        next_cursor = encode_page_cursor(todos[-1])
+    
+    total_estimate = estimate_todo_count(conn, where, params, 'todos_all' if filters.get('archived') else 'todos')
     
     robots = get_active_robots()
     
@@ -611,7 +2986,112 @@ def index():
     server_time = get_server_time()
     
     return render_template('index.html', todos=todos, robots=robots, 
-                         china_time=china_time, server_time=server_time)
+                         china_time=china_time, server_time=server_time,
+                         filters=filters, per_page=per_page, is_first_page=position is None,
+                         next_cursor=next_cursor, total_estimate=total_estimate)
+
+def todo_search_uses_fts(conn):
+    """数据库中是否有 todos_fts 全文索引（SQLite 不支持 FTS5 trigram 时迁移会跳过建表）"""
+    global todo_search_fts
+    if todo_search_fts is None:
+        todo_search_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'todos_fts'").fetchone() is not None
+    return todo_search_fts
+
+def parse_search_terms(query):
+    """把搜索框输入按空白拆成去重后的搜索词"""
+    terms = [term[:SEARCH_TERM_MAX_CHARS] for term in (query or '').split()]
+    return list(dict.fromkeys(terms))[:SEARCH_MAX_TERMS]
+
+def mark_search_terms(text, terms):
+    """给文本中出现的搜索词加高亮标记字符（LIKE 检索时在 Python 中标记，不区分大小写）"""
+    if not text or not terms:
+        return text
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    return pattern.sub(lambda match: SEARCH_MARK_START + match.group(0) + SEARCH_MARK_END, text)
+
+def render_search_highlight(text):
+    """把带标记字符的高亮文本转义为 HTML，标记替换为 <mark>"""
+    if not text:
+        return ''
+    return str(escape(text)).replace(SEARCH_MARK_START, '<mark>').replace(SEARCH_MARK_END, '</mark>')
+
+def search_todos(conn, user_id, query, args, page, per_page):
+    """按标题和描述搜索用户的任务，返回 (结果列表, 是否还有下一页, 检索方式, 生效的筛选项)
+    
+    不少于 3 个字符的词用 FTS5 trigram 索引匹配，按 bm25 排序（标题权重更高）；更短的词 trigram
+    无法索引，作为 LIKE 条件附加在同一查询上，全部是短词时按创建时间倒序。筛选参数与任务列表相同。
+    结果中的 title_highlight / description_highlight 是已转义的 HTML，匹配部分用 <mark> 标出。
+    全文索引只覆盖热表，archived=1 由调用方拒绝，这里不作为筛选项。
+    """
+    where, params, filters = build_todo_filters(user_id, args)
+    filters.pop('archived', None)
+    terms = parse_search_terms(query)
+    if not terms:
+        return [], False, None, filters
+    
+    fts_terms = [term for term in terms if len(term) >= SEARCH_MIN_TERM_CHARS] if todo_search_uses_fts(conn) else []
+    like_terms = [term for term in terms if term not in fts_terms]
+    for term in like_terms:
+        pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where += " AND (t.title LIKE ? ESCAPE '\\' OR t.description LIKE ? ESCAPE '\\')"
+        params += [pattern, pattern]
+    
+    columns = 't.id, t.title, t.description, t.due_date, t.priority, t.status, t.robot_id, t.notification_time, t.created_at'
+    offset = (page - 1) * per_page
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    if fts_terms:
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in fts_terms)
+        c.execute(f'''SELECT {columns},
+                      highlight(todos_fts, 0, ?, ?) AS title_highlight,
+                      snippet(todos_fts, 1, ?, ?, '…', ?) AS description_highlight,
+                      todos_fts.rank AS rank
+                      FROM todos_fts JOIN todos t ON t.id = todos_fts.rowid
+                      WHERE todos_fts MATCH ? AND {where}
+                      ORDER BY todos_fts.rank LIMIT ? OFFSET ?''',
+                  [SEARCH_MARK_START, SEARCH_MARK_END, SEARCH_MARK_START, SEARCH_MARK_END, SEARCH_SNIPPET_TOKENS,
+                   match] + params + [per_page + 1, offset])
+        mode = 'fts'
+    else:
+        c.execute(f'''SELECT {columns} FROM todos t WHERE {where}
+                      ORDER BY t.created_at DESC, t.id DESC LIMIT ? OFFSET ?''', params + [per_page + 1, offset])
+        mode = 'like'
+    todos = c.fetchall()
+    
+    has_next = len(todos) > per_page and offset + per_page < SEARCH_MAX_RESULTS
+    todos = todos[:per_page]
+    for todo in todos:
+        if mode == 'like':
+            todo['title_highlight'] = mark_search_terms(todo['title'], like_terms)
+            todo['description_highlight'] = mark_search_terms(todo['description'], like_terms)
+            todo['rank'] = None
+        todo['title_highlight'] = render_search_highlight(todo['title_highlight'])
+        todo['description_highlight'] = render_search_highlight(todo['description_highlight'])
+    return todos, has_next, mode, filters
+
+def get_search_page_args(args):
+    """读取搜索的页码和每页条数，结果总数不超过 SEARCH_MAX_RESULTS"""
+    per_page = min(max(args.get('per_page', SEARCH_PAGE_SIZE, type=int), 1), TODO_PAGE_SIZE_MAX)
+    max_page = max(SEARCH_MAX_RESULTS // per_page, 1)
+    page = min(max(args.get('page', 1, type=int), 1), max_page)
+    return page, per_page
+
+@app.route('/search')
+@login_required
+def search():
+    """搜索任务标题和描述"""
+    query = request.args.get('q', '').strip()
+    page, per_page = get_search_page_args(request.args)
+    # 与 API 一致，拒绝搜索已归档的任务（表单中保留其他筛选项，重新提交即搜索未归档的任务）
+    if request.args.get('archived') == '1':
+        flash(SEARCH_ARCHIVED_ERROR, 'error')
+        filters = build_todo_filters(session['user_id'], request.args)[2]
+        filters.pop('archived', None)
+        return render_template('search.html', query=query, todos=[], page=page, per_page=per_page,
+                               has_next=False, mode=None, filters=filters, rejected=True), 400
+    todos, has_next, mode, filters = search_todos(get_db(), session['user_id'], query, request.args, page, per_page)
+    return render_template('search.html', query=query, todos=todos, page=page, per_page=per_page,
+                           has_next=has_next, mode=mode, filters=filters)
 
 @app.route('/config')
 @login_required
@@ -619,7 +3099,15 @@ def config():
     """配置页面"""
     robots = get_active_robots()
     reminder_settings = get_reminder_settings()
-    return render_template('config.html', robots=robots, reminder_settings=reminder_settings)
+    robot_names = {robot['id']: robot['name'] for robot in robots}
+    message_templates = [dict(row, description=MESSAGE_TEMPLATE_DEFAULTS.get(row['name'], (row['name'],))[0],
+                              robot_name=robot_names.get(row['robot_id'], '所有机器人'))
+                         for row in message_templates_cache.get()['rows']]
+    template_defaults = [{"name": name, "description": description, "body": body, "fields": list(fields)}
+                         for name, (description, body, fields) in MESSAGE_TEMPLATE_DEFAULTS.items()]
+    return render_template('config.html', robots=robots, reminder_settings=reminder_settings,
+                           message_templates=message_templates, template_defaults=template_defaults,
+                           template_msgtypes=MESSAGE_TEMPLATE_MSGTYPES, default_locale=DEFAULT_LOCALE)
 
 @app.route('/add_robot', methods=['POST'])
 @login_required
@@ -628,13 +3116,15 @@ def add_robot():
     name = request.form['name']
     webhook_url = request.form['webhook_url']
     description = request.form.get('description', '')
+    locale = request.form.get('locale', '').strip() or DEFAULT_LOCALE
     
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
-    c.execute('INSERT INTO robots (name, webhook_url, description) VALUES (?, ?, ?)',
-              (name, webhook_url, description))
+    c.execute('INSERT INTO robots (name, webhook_url, description, locale) VALUES (?, ?, ?, ?)',
+              (name, webhook_url, description, locale))
+    bump_cache_version(conn, 'robots')
     conn.commit()
-    conn.close()
+    robots_cache.expire()
     
     flash(f'机器人 "{name}" 添加成功！', 'success')
     return redirect(url_for('config'))
@@ -643,22 +3133,71 @@ def add_robot():
 @login_required
 def delete_robot(robot_id):
     """删除机器人"""
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE robots SET is_active = 0 WHERE id = ?', (robot_id,))
+    bump_cache_version(conn, 'robots')
     conn.commit()
-    conn.close()
+    robots_cache.expire()
     
     flash('机器人已删除！', 'info')
     return redirect(url_for('config'))
 
+@app.route('/save_template', methods=['POST'])
+@login_required
+def save_template():
+    """保存消息模板（同一模板、机器人和语言只保留一条）"""
+    name = request.form.get('name', '')
+    robot_id = request.form.get('robot_id', 0, type=int)
+    locale = request.form.get('locale', '').strip() or DEFAULT_LOCALE
+    msgtype = request.form.get('msgtype', 'text')
+    title = request.form.get('title', '').strip() or None
+    body = request.form.get('body', '').replace('\r\n', '\n')
+    url = request.form.get('url', '').strip() or None
+    
+    # 先编译一次，占位符或格式错误时不保存
+    try:
+        if not body.strip():
+            raise ValueError("模板内容不能为空")
+        MessageTemplate(name, body, msgtype, title, url)
+    except ValueError as e:
+        flash(f'模板保存失败: {e}', 'error')
+        return redirect(url_for('config'))
+    
+    conn = get_db()
+    conn.execute('''INSERT INTO message_templates (name, robot_id, locale, msgtype, title, body, url)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(name, robot_id, locale) DO UPDATE
+                    SET msgtype = excluded.msgtype, title = excluded.title, body = excluded.body,
+                        url = excluded.url, updated_at = CURRENT_TIMESTAMP''',
+                 (name, robot_id, locale, msgtype, title, body, url))
+    bump_cache_version(conn, 'message_templates')
+    conn.commit()
+    message_templates_cache.expire()
+    
+    flash(f'消息模板 "{MESSAGE_TEMPLATE_DEFAULTS[name][0]}" 已保存！', 'success')
+    return redirect(url_for('config'))
+
+@app.route('/delete_template/<int:template_id>')
+@login_required
+def delete_template(template_id):
+    """删除消息模板，恢复使用内置模板"""
+    conn = get_db()
+    conn.execute('DELETE FROM message_templates WHERE id = ?', (template_id,))
+    bump_cache_version(conn, 'message_templates')
+    conn.commit()
+    message_templates_cache.expire()
+    
+    flash('消息模板已删除，恢复使用内置模板！', 'info')
+    return redirect(url_for('config'))
+
 @app.route('/add_reminder', methods=['POST'])
 @login_required
 def add_reminder():
     """添加提醒设置"""
     days_before = int(request.form['days_before'])
     
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     
     # 检查是否已存在
@@ -667,7 +3206,10 @@ def add_reminder():
         flash(f'提前 {days_before} 天的提醒设置已存在！', 'warning')
     else:
         c.execute('INSERT INTO reminder_settings (days_before) VALUES (?)', (days_before,))
+        bump_cache_version(conn, 'reminder_settings')
         conn.commit()
+        reminder_settings_cache.expire()
+        scheduler_wakeup.set()  # 调度线程尽快按新设置重建
         
         # 根据天数给出不同的提示
         if days_before <= 7:
@@ -675,18 +3217,19 @@ def add_reminder():
         else:
             flash(f'提前 {days_before} 天单次提醒的设置添加成功！', 'success')
     
-    conn.close()
     return redirect(url_for('config'))
 
 @app.route('/delete_reminder/<int:reminder_id>')
 @login_required
 def delete_reminder(reminder_id):
     """删除提醒设置"""
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('UPDATE reminder_settings SET is_active = 0 WHERE id = ?', (reminder_id,))
+    bump_cache_version(conn, 'reminder_settings')
     conn.commit()
-    conn.close()
+    reminder_settings_cache.expire()
+    scheduler_wakeup.set()
     
     flash('提醒设置已删除！', 'info')
     return redirect(url_for('config'))
@@ -704,40 +3247,42 @@ def add_todo():
     user_id = session['user_id']
     user_timezone = session.get('timezone', 'Asia/Shanghai')
     
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     c.execute('''INSERT INTO todos (title, description, due_date, priority, robot_id, notification_time, user_id, timezone) 
                  VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
               (title, description, due_date if due_date else None, priority, robot_id, notification_time, user_id, user_timezone))
+    todo_id = c.lastrowid
     conn.commit()
+    reschedule_todo(todo_id)
     
     # 发送创建通知到指定机器人
-    username = session['username']
-    china_time = get_china_time()
-    message = f"✅ 新待办事项已创建\n\n用户: {username}\n标题: {title}\n描述: {description or '无'}\n截止日期: {due_date or '无'}\n优先级: {priority}\n通知时间: {notification_time}\n创建时间: {china_time.strftime('%Y-%m-%d %H:%M:%S')} (中国时间)\n\n💡 提醒规则: ≤7天每日提醒，>7天单次提醒"
-    success, error_msg = send_wechat_message(message, robot_id)
+    msgtype, message = render_message('todo_created', {
+        'username': session['username'], 'title': title, 'description': description or '无',
+        'due_date': due_date or '无', 'priority': priority, 'notification_time': notification_time,
+        'china_time': get_china_time().strftime('%Y-%m-%d %H:%M:%S')
+    }, robot_id)
+    success, error_msg = enqueue_wechat_message(message, robot_id, msgtype)
     
     if success:
-        flash('任务创建成功，已发送微信通知！', 'success')
+        flash('任务创建成功，微信通知已加入发送队列！', 'success')
     else:
         flash(f'任务创建成功，但微信通知发送失败: {error_msg}', 'warning')
     
-    conn.close()
     return redirect(url_for('index'))
 
 @app.route('/edit/<int:todo_id>')
 @login_required
 def edit_todo(todo_id):
     """编辑任务页面"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
+    conn = get_db()
     c = conn.cursor()
+    c.row_factory = dict_factory
     
     # 确保只能编辑自己的任务
     user_id = session['user_id']
     c.execute('SELECT * FROM todos WHERE id = ? AND user_id = ?', (todo_id, user_id))
     todo = c.fetchone()
-    conn.close()
     
     if not todo:
         flash('任务不存在或无权限访问！', 'error')
@@ -759,7 +3304,7 @@ def update_todo(todo_id):
     user_id = session['user_id']
     user_timezone = session.get('timezone', 'Asia/Shanghai')
     
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     
     # 清理相关的提醒日志（因为任务已修改）
@@ -774,57 +3319,58 @@ def update_todo(todo_id):
     
     if c.rowcount > 0:
         conn.commit()
+        reschedule_todo(todo_id)
         flash('任务更新成功！提醒状态已重置。', 'success')
     else:
         flash('任务不存在或无权限修改！', 'error')
     
-    conn.close()
     return redirect(url_for('index'))
 
 @app.route('/complete/<int:todo_id>')
 @login_required
 def complete_todo(todo_id):
     """完成任务"""
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     
     # 获取待办事项信息（确保是当前用户的任务）
     user_id = session['user_id']
-    c.execute('SELECT title, description, robot_id FROM todos WHERE id = ? AND user_id = ?', 
+    c.execute('SELECT title, description, robot_id, due_date, priority, notification_time FROM todos WHERE id = ? AND user_id = ?', 
               (todo_id, user_id))
     todo = c.fetchone()
     
     if todo:
-        title, description, robot_id = todo
+        title, description, robot_id, due_date, priority, notification_time = todo
         
         # 清理相关的提醒日志
         c.execute('DELETE FROM reminder_logs WHERE todo_id = ?', (todo_id,))
         
-        c.execute('UPDATE todos SET status = "completed" WHERE id = ? AND user_id = ?', 
+        c.execute('UPDATE todos SET status = "completed", next_fire_at = NULL, completed_at = CURRENT_TIMESTAMP WHERE id = ? AND user_id = ?', 
                   (todo_id, user_id))
         conn.commit()
         
         # 发送完成通知到指定机器人
-        username = session['username']
-        china_time = get_china_time()
-        message = f"🎉 待办事项已完成\n\n用户: {username}\n标题: {title}\n描述: {description or '无'}\n完成时间: {china_time.strftime('%Y-%m-%d %H:%M:%S')} (中国时间)\n\n✅ 所有提醒已停止"
-        success, error_msg = send_wechat_message(message, robot_id or 1)
+        msgtype, message = render_message('todo_completed', {
+            'username': session['username'], 'title': title, 'description': description or '无',
+            'due_date': due_date or '无', 'priority': priority, 'notification_time': notification_time,
+            'china_time': get_china_time().strftime('%Y-%m-%d %H:%M:%S')
+        }, robot_id or 1)
+        success, error_msg = enqueue_wechat_message(message, robot_id or 1, msgtype)
         
         if success:
-            flash('任务已完成，已发送微信通知！', 'success')
+            flash('任务已完成，微信通知已加入发送队列！', 'success')
         else:
             flash(f'任务已完成，但微信通知发送失败: {error_msg}', 'warning')
     else:
         flash('任务不存在或无权限操作！', 'error')
     
-    conn.close()
     return redirect(url_for('index'))
 
 @app.route('/delete/<int:todo_id>')
 @login_required
 def delete_todo(todo_id):
     """删除任务"""
-    conn = sqlite3.connect('todolist.db')
+    conn = get_db()
     c = conn.cursor()
     
     # 清理相关的提醒日志
@@ -840,7 +3386,6 @@ def delete_todo(todo_id):
     else:
         flash('任务不存在或无权限删除！', 'error')
     
-    conn.close()
     return redirect(url_for('index'))
 
 @app.route('/test_wechat')
@@ -860,8 +3405,12 @@ def test_wechat():
     else:
         china_time = get_china_time()
         server_time = get_server_time()
-        message = f"🔔 待办事项系统测试消息\n\n用户: {username}\n中国时间: {china_time.strftime('%Y-%m-%d %H:%M:%S')}\n服务器时间: {server_time.strftime('%Y-%m-%d %H:%M:%S')}\n机器人: {robot['name']}\n\n💡 新提醒规则:\n- ≤7天: 每日提醒\n- >7天: 单次提醒\n\n系统运行正常！"
-        success, error_msg = send_wechat_message(message, robot_id)
+        msgtype, message = render_message('test_message', {
+            'username': username, 'robot_name': robot['name'],
+            'china_time': china_time.strftime('%Y-%m-%d %H:%M:%S'),
+            'server_time': server_time.strftime('%Y-%m-%d %H:%M:%S')
+        }, robot_id)
+        success, error_msg = send_wechat_message(message, robot_id, msgtype)
         
         response_data = {
             "success": success,
@@ -880,30 +3429,39 @@ def test_wechat():
     )
     return response
 
-@app.route('/debug_reminders')
-@login_required
-def debug_reminders():
-    """调试提醒功能 - 显示当前任务状态"""
-    conn = sqlite3.connect('todolist.db')
-    conn.row_factory = dict_factory
-    c = conn.cursor()
-    
-    user_id = session['user_id']
-    c.execute('''SELECT id, title, due_date, notification_time, reminder_sent, 
-                 last_notification_date, status, priority, COALESCE(timezone, 'Asia/Shanghai') as timezone
-                 FROM todos 
-                 WHERE user_id = ? AND status = 'pending'
-                 ORDER BY due_date''', (user_id,))
-    todos = c.fetchall()
+def collect_runtime_metrics():
+    """抓取时采集缓存大小、调度堆、连接池和发送队列等状态"""
+    dedup_stats = processed_reminders.stats()
+    pool_stats = get_db_pool().stats()
+    RUNTIME_GAUGES.set(len(processed_reminders), name='processed_reminders')
+    RUNTIME_GAUGES.set(dedup_stats['memory_bytes'], name='processed_reminders_bytes')
+    RUNTIME_GAUGES.set(len(reminder_heap), name='scheduler_heap_size')
+    RUNTIME_GAUGES.set(1 if is_scheduler_leader else 0, name='scheduler_leader')
+    RUNTIME_GAUGES.set(pool_stats['created'], name='db_pool_connections')
+    RUNTIME_GAUGES.set(pool_stats['idle'], name='db_pool_idle')
+    RUNTIME_GAUGES.set(log_queue_handler.dropped, name='log_records_dropped')
+    queue_stats = get_notification_queue_stats()
+    for status in ('pending', 'sending', 'sent', 'failed'):
+        NOTIFICATION_QUEUE_DEPTH.set(queue_stats.get(status, 0), status=status)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 文本格式的指标（设置 TODO_METRICS_TOKEN 后需要 Bearer 令牌）"""
+    if METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+        return app.response_class('unauthorized\n', status=401, mimetype='text/plain')
     
+    collect_runtime_metrics()
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return app.response_class('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def get_reminder_debug_summary(conn):
+    """调试接口的全局状态（调度器、缓存、队列等）"""
     reminder_settings = get_reminder_settings()
-    
-    china_time = get_china_time()
-    server_time = get_server_time()
-    
-    debug_info = {
-        "china_time": china_time.strftime('%Y-%m-%d %H:%M:%S'),
-        "server_time": server_time.strftime('%Y-%m-%d %H:%M:%S'),
+    return {
+        "china_time": get_china_time().strftime('%Y-%m-%d %H:%M:%S'),
+        "server_time": get_server_time().strftime('%Y-%m-%d %H:%M:%S'),
         "reminder_rule": "新提醒规则: ≤7天每日提醒，>7天单次提醒",
         "reminder_settings": [
             {
@@ -912,73 +3470,846 @@ def debug_reminders():
             } for s in reminder_settings
         ],
         "memory_cache_size": len(processed_reminders),
+        "memory_cache": processed_reminders.stats(),
         "last_check_minute": last_check_minute,
-        "todos": []
+        "scheduler_next_wakeup": scheduler_next_wakeup,
+        "scheduler_lease": get_scheduler_lease_info(),
+        "scheduler_heap_size": len(reminder_heap),
+        "scheduler_heap_window_end": reminder_heap_window_end,
+        "scheduler_stats": scheduler_stats,
+        "db_pool": get_db_pool().stats(),
+        "notification_queue": get_notification_queue_stats(),
+        "reminder_outbox": dict(conn.execute('SELECT status, COUNT(*) FROM reminder_outbox GROUP BY status').fetchall()),
+        "reminder_outbox_backlog": reminder_outbox_backlog,
+        "retention": last_retention_report,
+        "config_cache": {
+            "robots": robots_cache.stats(),
+            "reminder_settings": reminder_settings_cache.stats()
+        }
     }
+
+def build_todo_debug_info(todo, counts, reminder_settings, today_str, tz_now):
+    """单个任务的提醒诊断信息，tz_now 按时区缓存任务时区的当前时间"""
+    timezone = todo['timezone']
+    if timezone not in tz_now:
+        tz_now[timezone] = datetime.now(get_timezone(timezone))
+    task_now = tz_now[timezone]
     
-    for todo in todos:
-        if todo['due_date']:
+    due_date = datetime.strptime(todo['due_date'], '%Y-%m-%d')
+    days_until_due = (due_date.date() - task_now.date()).days
+    
+    # 判断是否应该提醒
+    should_remind, reminder_type, trigger_days = should_send_reminder(days_until_due, reminder_settings)
+    
+    # 生成当前的提醒key
+    if reminder_type == "daily":
+        current_reminder_key = f"{todo['id']}_{today_str}_{task_now.hour:02d}_{task_now.minute:02d}_daily_{trigger_days}"
+    elif reminder_type == "once":
+        current_reminder_key = f"{todo['id']}_once_{days_until_due}days"
+    else:
+        current_reminder_key = "N/A"
+    
+    total_sent_count, today_sent_count = counts.get(todo['id'], (0, 0))
+    
+    todo_info = dict(todo)
+    todo_info['days_until_due'] = days_until_due
+    todo_info['task_current_time'] = task_now.strftime('%Y-%m-%d %H:%M:%S')
+    todo_info['is_notification_time'] = task_now.strftime('%H:%M') == (todo['notification_time'] or '10:30')
+    todo_info['should_remind'] = should_remind
+    todo_info['reminder_type'] = reminder_type or "无"
+    todo_info['trigger_rule'] = f"{trigger_days}天-{reminder_type}" if trigger_days is not None else "不在提醒范围"
+    todo_info['current_reminder_key'] = current_reminder_key
+    todo_info['today_sent_count'] = today_sent_count
+    todo_info['total_sent_count'] = total_sent_count
+    todo_info['in_memory_cache'] = current_reminder_key in processed_reminders
+    return todo_info
+
+@app.route('/debug_reminders')
+@login_required
+def debug_reminders():
+    """调试提醒功能 - 显示当前任务状态
+    
+    按任务 id 分页（after_id/limit），可用 todo_id 只看单个任务，summary=0 跳过全局状态，
+    archived=1 时提醒记录数包含已归档的记录。
+    提醒记录数用一条 GROUP BY 聚合查询统计整页任务，结果以流式 JSON 输出。
+    """
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    
+    user_id = session['user_id']
+    limit = min(max(request.args.get('limit', DEBUG_REMINDERS_PAGE_SIZE, type=int), 1), DEBUG_REMINDERS_PAGE_SIZE_MAX)
+    conditions = ["user_id = ?", "status = 'pending'", "due_date IS NOT NULL"]
+    params = [user_id]
+    todo_id = request.args.get('todo_id', type=int)
+    if todo_id is not None:
+        conditions.append('id = ?')
+        params.append(todo_id)
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        conditions.append('id > ?')
+        params.append(after_id)
+    
+    c.execute(f'''SELECT id, title, due_date, notification_time, reminder_sent, next_fire_at, notify_utc_minute,
+                  last_notification_date, status, priority, COALESCE(timezone, 'Asia/Shanghai') as timezone
+                  FROM todos 
+                  WHERE {' AND '.join(conditions)}
+                  ORDER BY id LIMIT ?''', params + [limit + 1])
+    todos = c.fetchall()
+    
+    next_after_id = None
+    if len(todos) > limit:
+        todos = todos[:limit]
+        next_after_id = todos[-1]['id']
+    
+    # 整页任务的提醒记录数：一次聚合查询代替每个任务两次 LIKE 计数
+    today_str = get_china_time().strftime('%Y-%m-%d')
+    counts = {}
+    logs_source = 'reminder_logs_all' if request.args.get('archived') == '1' else 'reminder_logs'
+    if todos:
+        placeholders = ','.join('?' * len(todos))
+        rows = conn.execute(f'''SELECT l.todo_id, COUNT(*),
+                               SUM(substr(l.reminder_key, length(l.todo_id) + 2, 11) = ?)
+                               FROM {logs_source} l JOIN todos t ON t.id = l.todo_id
+                               WHERE t.user_id = ? AND l.todo_id IN ({placeholders})
+                               GROUP BY l.todo_id''',
+                            [today_str + '_', user_id] + [todo['id'] for todo in todos]).fetchall()
+        counts = {todo_id: (total, today) for todo_id, total, today in rows}
+    
+    reminder_settings = get_reminder_settings()
+    summary = get_reminder_debug_summary(conn) if request.args.get('summary', '1') != '0' else None
+    
+    def generate():
+        head = dict(summary or {}, next_after_id=next_after_id)
+        yield json.dumps(head, ensure_ascii=False)[:-1] + ', "todos": ['
+        tz_now = {}
+        first = True
+        for todo in todos:
             try:
-                # 使用任务的时区
-                task_tz = pytz.timezone(todo['timezone'])
-                task_now = datetime.now(task_tz)
-                
-                due_date = datetime.strptime(todo['due_date'], '%Y-%m-%d')
-                days_until_due = (due_date.date() - task_now.date()).days
-                
-                # 判断是否应该提醒
-                should_remind, reminder_type, trigger_days = should_send_reminder(days_until_due, reminder_settings)
-                
-                # 生成当前的提醒key
-                today_str = china_time.strftime('%Y-%m-%d')
-                if reminder_type == "daily":
-                    current_reminder_key = f"{todo['id']}_{today_str}_{task_now.hour:02d}_{task_now.minute:02d}_daily_{trigger_days}"
-                elif reminder_type == "once":
-                    current_reminder_key = f"{todo['id']}_once_{days_until_due}days"
-                else:
-                    current_reminder_key = "N/A"
-                
-                # 检查数据库中的提醒记录
-                c.execute('SELECT COUNT(*) FROM reminder_logs WHERE todo_id = ? AND reminder_key LIKE ?', 
-                         (todo['id'], f"{todo['id']}_%"))
-                total_sent_count = c.fetchone()[0]
-                
-                # 检查今日发送记录
-                c.execute('SELECT COUNT(*) FROM reminder_logs WHERE todo_id = ? AND reminder_key LIKE ?', 
-                         (todo['id'], f"{todo['id']}_{today_str}_%"))
-                today_sent_count = c.fetchone()[0]
-                
-                todo_info = dict(todo)
-                todo_info['days_until_due'] = days_until_due
-                todo_info['task_current_time'] = task_now.strftime('%Y-%m-%d %H:%M:%S')
-                todo_info['is_notification_time'] = is_time_to_notify(todo['notification_time'] or '10:30', todo['timezone'])
-                todo_info['should_remind'] = should_remind
-                todo_info['reminder_type'] = reminder_type or "无"
-                todo_info['trigger_rule'] = f"{trigger_days}天-{reminder_type}" if trigger_days is not None else "不在提醒范围"
-                todo_info['current_reminder_key'] = current_reminder_key
-                todo_info['today_sent_count'] = today_sent_count
-                todo_info['total_sent_count'] = total_sent_count
-                todo_info['in_memory_cache'] = current_reminder_key in processed_reminders
-                
-                debug_info["todos"].append(todo_info)
+                todo_info = build_todo_debug_info(todo, counts, reminder_settings, today_str, tz_now)
             except Exception as e:
-                logging.error(f"处理调试信息时出错: {e}")
-                pass
+                web_logger.error(f"处理调试信息时出错: {e}")
+                continue
+            yield ('' if first else ', ') + json.dumps(todo_info, ensure_ascii=False)
+            first = False
+        yield ']}'
+    
+    return app.response_class(generate(), status=200, mimetype='application/json; charset=utf-8')
+
+# 数据导出/导入（网页和命令行共用）
+def iter_export_rows(conn, user_id, table):
+    """逐行产出用户的任务或提醒记录（fetchmany 分块读取）"""
+    columns = EXPORT_COLUMNS[table]
+    if table == 'todos':
+        cursor = conn.execute(f'''SELECT {', '.join(columns)} FROM todos
+                                 WHERE user_id = ? ORDER BY id''', (user_id,))
+    else:
+        cursor = conn.execute(f'''SELECT {', '.join('l.' + column for column in columns)}
+                                 FROM reminder_logs l JOIN todos t ON t.id = l.todo_id
+                                 WHERE t.user_id = ? ORDER BY l.id''', (user_id,))
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def iter_export_chunks(user_id, table, fmt):
+    """导出内容的文本块生成器
     
-    conn.close()
+    csv 每次只能导出一张表；jsonl 的 table=all 依次写出任务和提醒记录，每行带 table 字段，
+    两张表在同一个读事务里导出，保证提醒记录引用的任务都在文件中。
+    """
+    tables = list(EXPORT_COLUMNS) if table == 'all' else [table]
+    buffer = io.StringIO()
+    with db_connection() as conn:
+        conn.execute('BEGIN')
+        if fmt == 'csv':
+            writer = csv.DictWriter(buffer, fieldnames=EXPORT_COLUMNS[table])
+            writer.writeheader()
+        for name in tables:
+            for row in iter_export_rows(conn, user_id, name):
+                if fmt == 'csv':
+                    writer.writerow(row)
+                else:
+                    if table == 'all':
+                        row = {"table": name, **row}
+                    buffer.write(json.dumps(row, ensure_ascii=False))
+                    buffer.write('\n')
+                if buffer.tell() >= EXPORT_FLUSH_BYTES:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+        conn.rollback()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def check_export_options(table, fmt):
+    """校验导出/导入的表和格式，返回错误信息"""
+    if fmt not in EXPORT_FORMATS:
+        return f"format 只能是 {'/'.join(EXPORT_FORMATS)}"
+    if table != 'all' and table not in EXPORT_COLUMNS:
+        return f"table 只能是 all/{'/'.join(EXPORT_COLUMNS)}"
+    if fmt == 'csv' and table == 'all':
+        return "csv 每次只能导出或导入一张表"
+    return None
+
+def check_import_options(table, fmt):
+    """校验导入的表和格式，返回错误信息
     
-    response = app.response_class(
-        response=json.dumps(debug_info, ensure_ascii=False, indent=2),
-        status=200,
+    提醒记录按同一份数据中任务的旧 id 关联到新导入的任务，单独导入提醒记录时找不到对应的任务。
+    """
+    error = check_export_options(table, fmt)
+    if error:
+        return error
+    if table == 'reminder_logs':
+        return "提醒记录不能单独导入，请使用包含任务和提醒记录的 JSONL 全部数据导出文件"
+    return None
+
+def parse_import_records(stream, fmt, table):
+    """把 csv/jsonl 文本流逐行解析为 (表名, 字典)"""
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield table, row
+        return
+    for line_no, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise ValueError(f"第 {line_no} 行不是有效的 JSON")
+        if not isinstance(row, dict):
+            raise ValueError(f"第 {line_no} 行应为 JSON 对象")
+        yield row.pop('table', table), row
+
+def normalize_import_todo(row, user, reminder_settings):
+    """把导入的任务行转换为插入参数，返回 (参数, 错误信息)"""
+    item = {key: (None if value == '' else value) for key, value in row.items()}
+    try:
+        item['robot_id'] = int(item.get('robot_id') or 1)
+    except (TypeError, ValueError):
+        item['robot_id'] = 1
+    # 目标系统没有对应机器人时改用默认机器人
+    if not get_robot_by_id(item['robot_id']):
+        item['robot_id'] = 1
+    fields, error = validate_todo_fields(item)
+    if error:
+        return None, error
+    
+    status = item.get('status') or 'pending'
+    if status not in ('pending', 'completed'):
+        return None, "status 只能是 pending/completed"
+    timezone = item.get('timezone') or user['timezone']
+    try:
+        get_timezone(timezone)
+    except pytz.UnknownTimeZoneError:
+        return None, f"未知时区: {timezone}"
+    fields.update(status=status, timezone=timezone)
+    
+    fire_utc = compute_next_fire_at(fields, reminder_settings)
+    notify_utc_minute, notify_offset = compute_notify_utc_minute(fields['notification_time'], timezone)
+    return (fields['title'], fields['description'], fields['due_date'], fields['priority'], status,
+            item.get('created_at'), item.get('reminder_sent') or '', fields['robot_id'],
+            fields['notification_time'], item.get('last_notification_date') or '', user['id'], timezone,
+            fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None, notify_utc_minute, notify_offset,
+            item.get('completed_at') or (utc_now_str() if status == 'completed' else None)), None
+
+def normalize_import_log(row):
+    """把导入的提醒记录行转换为插入参数，返回 (参数, 错误信息)"""
+    try:
+        old_id = int(row.get('todo_id'))
+        days_before = int(row.get('days_before') or 0)
+    except (TypeError, ValueError):
+        return None, "todo_id/days_before 必须是整数"
+    reminder_key = row.get('reminder_key') or ''
+    if not reminder_key.startswith(f"{old_id}_"):
+        return None, "reminder_key 与 todo_id 不匹配"
+    # 未确认送达的记录导入为 failed，调度器可以重新评估
+    status = 'sent' if (row.get('status') or 'sent') == 'sent' else 'failed'
+    return (reminder_key, row.get('reminder_type') or 'daily', days_before, row.get('sent_at') or None,
+            status, old_id), None
+
+def import_records(user, records):
+    """分批事务导入任务和提醒记录，返回统计信息
+    
+    任务总是以新 id 插入，旧 id 到新 id 的映射保存在连接的临时表里；提醒记录只导入同一份数据中
+    已导入任务的记录，reminder_key 的任务 id 前缀改写为新 id。已提交的批次在后续出错时保留。
+    """
+    reminder_settings = get_reminder_settings()
+    stats = {"todos": 0, "reminder_logs": 0, "skipped": 0, "error_count": 0, "errors": []}
+    
+    def record_error(index, table, error):
+        stats['error_count'] += 1
+        if len(stats['errors']) < IMPORT_MAX_ERRORS:
+            stats['errors'].append({"index": index, "table": table, "error": error})
+    
+    with db_connection() as conn:
+        conn.execute('''CREATE TEMP TABLE IF NOT EXISTS import_todo_ids
+                        (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)''')
+        conn.execute('DELETE FROM import_todo_ids')
+        conn.commit()
+        
+        def flush(todos, logs):
+            # IMMEDIATE 事务持有写锁，AUTOINCREMENT 保证这一批 id 连续
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if todos:
+                    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'todos'").fetchone()
+                    first_id = (row[0] if row else 0) + 1
+                    conn.executemany('''INSERT INTO todos (title, description, due_date, priority, status, created_at,
+                                        reminder_sent, robot_id, notification_time, last_notification_date, user_id,
+                                        timezone, next_fire_at, notify_utc_minute, notify_utc_offset, completed_at)
+                                        VALUES (?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                                     [params for _, params in todos])
+                    last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'todos'").fetchone()[0]
+                    if last_id - first_id + 1 != len(todos):
+                        raise RuntimeError("批量插入的任务 id 不连续")
+                    conn.executemany('INSERT OR REPLACE INTO import_todo_ids (old_id, new_id) VALUES (?, ?)',
+                                     [(old_id, first_id + offset) for offset, (old_id, _) in enumerate(todos)
+                                      if old_id is not None])
+                if logs:
+                    inserted = conn.executemany('''INSERT INTO reminder_logs
+                                                   (todo_id, reminder_key, reminder_type, days_before, sent_at, status)
+                                                   SELECT m.new_id, m.new_id || substr(?, length(m.old_id) + 1), ?, ?,
+                                                          COALESCE(?, CURRENT_TIMESTAMP), ?
+                                                   FROM import_todo_ids m WHERE m.old_id = ?
+                                                   ON CONFLICT(todo_id, reminder_key) DO NOTHING''', logs).rowcount
+                    stats['reminder_logs'] += inserted
+                    stats['skipped'] += len(logs) - inserted
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            stats['todos'] += len(todos)
+        
+        todos, logs = [], []
+        for index, (table, row) in enumerate(records):
+            if table == 'todos':
+                params, error = normalize_import_todo(row, user, reminder_settings)
+                if not error:
+                    try:
+                        old_id = int(row['id']) if row.get('id') not in (None, '') else None
+                    except (TypeError, ValueError):
+                        old_id = None
+                    todos.append((old_id, params))
+            elif table == 'reminder_logs':
+                params, error = normalize_import_log(row)
+                if not error:
+                    logs.append(params)
+            else:
+                error = f"未知的表: {table}"
+            if error:
+                record_error(index, table, error)
+            if len(todos) + len(logs) >= IMPORT_BATCH_SIZE:
+                flush(todos, logs)
+                todos, logs = [], []
+        if todos or logs:
+            flush(todos, logs)
+    
+    # 新任务的触发点可能早于调度线程的睡眠目标
+    scheduler_wakeup.set()
+    return stats
+
+def format_import_stats(stats):
+    """导入结果的摘要文字"""
+    return (f"任务 {stats['todos']} 条，提醒记录 {stats['reminder_logs']} 条，"
+            f"跳过 {stats['skipped']} 条，错误 {stats['error_count']} 条")
+
+@app.route('/export')
+@login_required
+def export_data():
+    """流式导出当前用户的任务和提醒记录（table=all/todos/reminder_logs，format=jsonl/csv）"""
+    table = request.args.get('table', 'all')
+    fmt = request.args.get('format', 'jsonl')
+    error = check_export_options(table, fmt)
+    if error:
+        return json_response({"success": False, "error": error}, 400)
+    
+    filename = f"{table}-{session['username']}-{get_china_time().strftime('%Y%m%d%H%M%S')}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return app.response_class(iter_export_chunks(session['user_id'], table, fmt),
+                              mimetype=f'{mimetype}; charset=utf-8',
+                              headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.route('/import', methods=['POST'])
+@login_required
+def import_data():
+    """从上传的 jsonl/csv 文件导入任务和提醒记录（任务分配新 id，归属当前用户）"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('请选择要导入的文件', 'error')
+        return redirect(url_for('config'))
+    
+    fmt = request.form.get('format') or ('csv' if upload.filename.lower().endswith('.csv') else 'jsonl')
+    table = request.form.get('table') or ('todos' if fmt == 'csv' else 'all')
+    error = check_import_options(table, fmt)
+    if error:
+        flash(f'导入失败: {error}', 'error')
+        return redirect(url_for('config'))
+    
+    user = {"id": session['user_id'], "timezone": session.get('timezone', 'Asia/Shanghai')}
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    try:
+        stats = import_records(user, parse_import_records(stream, fmt, table))
+    except (ValueError, sqlite3.Error, RuntimeError) as e:
+        web_logger.error(f"导入数据失败: {e}")
+        flash(f'导入失败: {e}', 'error')
+        return redirect(url_for('config'))
+    
+    web_logger.info(f"导入数据完成: 用户={session['username']} {format_import_stats(stats)}")
+    flash(f"导入完成：{format_import_stats(stats)}", 'warning' if stats['error_count'] else 'success')
+    return redirect(url_for('config'))
+
+def get_cli_user(username):
+    """命令行导出/导入时按用户名查找用户"""
+    with db_connection() as conn:
+        row = conn.execute('SELECT id, username, timezone FROM users WHERE username = ?', (username,)).fetchone()
+    if not row:
+        raise click.ClickException(f"用户不存在: {username}")
+    return {"id": row[0], "username": row[1], "timezone": row[2] or 'Asia/Shanghai'}
+
+@app.cli.command('export-data')
+@click.option('--user', 'username', default='admin', help='导出哪个用户的数据')
+@click.option('--table', default='all', help='all/todos/reminder_logs')
+@click.option('--format', 'fmt', default='jsonl', help='jsonl/csv')
+@click.option('--output', default='-', help='输出文件，默认标准输出')
+def export_data_command(username, table, fmt, output):
+    """流式导出用户的任务和提醒记录"""
+    error = check_export_options(table, fmt)
+    if error:
+        raise click.UsageError(error)
+    user = get_cli_user(username)
+    out = sys.stdout if output == '-' else open(output, 'w', encoding='utf-8', newline='')
+    try:
+        for chunk in iter_export_chunks(user['id'], table, fmt):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+@app.cli.command('import-data')
+@click.argument('path')
+@click.option('--user', 'username', default='admin', help='导入到哪个用户')
+@click.option('--table', default=None, help='csv 文件对应的表（todos），jsonl 默认 all')
+@click.option('--format', 'fmt', default=None, help='jsonl/csv，默认按扩展名判断')
+def import_data_command(path, username, table, fmt):
+    """分批导入任务和提醒记录（PATH 为 - 时读取标准输入）"""
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+    table = table or ('todos' if fmt == 'csv' else 'all')
+    error = check_import_options(table, fmt)
+    if error:
+        raise click.UsageError(error)
+    user = get_cli_user(username)
+    stream = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+    try:
+        stats = import_records(user, parse_import_records(stream, fmt, table))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print(f"导入完成：{format_import_stats(stats)}")
+    for item in stats['errors']:
+        print(f"  第 {item['index'] + 1} 条 ({item['table']}): {item['error']}")
+
+# JSON API（/api/v1），支持批量操作
+def json_response(data, status=200):
+    """返回 JSON 响应（保留中文）"""
+    return app.response_class(
+        response=json.dumps(data, ensure_ascii=False),
+        status=status,
         mimetype='application/json; charset=utf-8'
     )
-    return response
 
-if __name__ == '__main__':
-    init_db()
+def api_login_required(f):
+    """API 登录验证：支持浏览器会话或 HTTP Basic 认证，失败返回 401"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' in session:
+            g.api_user = {
+                "id": session['user_id'],
+                "username": session['username'],
+                "timezone": session.get('timezone', 'Asia/Shanghai')
+            }
+            return f(*args, **kwargs)
+        
+        auth = request.authorization
+        if auth and auth.username and auth.password:
+            c = get_db().cursor()
+            c.row_factory = dict_factory
+            c.execute('SELECT id, username, timezone FROM users WHERE username = ? AND password_hash = ?',
+                      (auth.username, hash_password(auth.password)))
+            user = c.fetchone()
+            if user:
+                g.api_user = {
+                    "id": user['id'],
+                    "username": user['username'],
+                    "timezone": user['timezone'] or 'Asia/Shanghai'
+                }
+                return f(*args, **kwargs)
+        
+        return json_response({"success": False, "error": "未登录或认证失败"}, 401)
+    return decorated_function
+
+def get_api_items(key):
+    """读取批量请求体：{key: [...]} 或直接是数组，返回 (列表, 错误信息)"""
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get(key)
+    if not isinstance(payload, list) or not payload:
+        return None, f"请求体应为非空数组或 {{\"{key}\": [...]}}"
+    if len(payload) > API_BATCH_MAX:
+        return None, f"单次最多处理 {API_BATCH_MAX} 条"
+    return payload, None
+
+def is_api_int(value):
+    """JSON 中的整数（bool 是 int 的子类，true/false 不算整数）"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def validate_todo_fields(item, partial=False):
+    """校验任务字段，返回 (规范化后的字段, 错误信息)"""
+    if not isinstance(item, dict):
+        return None, "每一项都必须是对象"
+    
+    fields = {}
+    if 'title' in item or not partial:
+        title = item.get('title')
+        if not isinstance(title, str) or not title.strip():
+            return None, "title 不能为空"
+        fields['title'] = title.strip()
+    if 'description' in item or not partial:
+        fields['description'] = str(item.get('description') or '')
+    if 'due_date' in item or not partial:
+        due_date = item.get('due_date') or None
+        if due_date is not None:
+            try:
+                due_date = datetime.strptime(due_date, '%Y-%m-%d').strftime('%Y-%m-%d')
+            except (TypeError, ValueError):
+                return None, "due_date 格式应为 YYYY-MM-DD"
+        fields['due_date'] = due_date
+    if 'priority' in item or not partial:
+        priority = item.get('priority') or 'medium'
+        if priority not in ('low', 'medium', 'high'):
+            return None, "priority 只能是 low/medium/high"
+        fields['priority'] = priority
+    if 'notification_time' in item or not partial:
+        notification_time = item.get('notification_time') or '10:30'
+        try:
+            datetime.strptime(notification_time, '%H:%M')
+        except (TypeError, ValueError):
+            return None, "notification_time 格式应为 HH:MM"
+        fields['notification_time'] = notification_time
+    if 'robot_id' in item or not partial:
+        robot_id = item.get('robot_id') or 1
+        if not is_api_int(robot_id):
+            return None, "robot_id 必须是整数"
+        if not get_robot_by_id(robot_id):
+            return None, "robot_id 对应的机器人不存在或未激活"
+        fields['robot_id'] = robot_id
+    
+    return fields, None
+
+def get_api_ids():
+    """读取 {"ids": [...]} 或直接的 id 数组，返回 (去重后的列表, 错误信息)"""
+    ids, error = get_api_items('ids')
+    if error:
+        return None, error
+    if not all(is_api_int(todo_id) for todo_id in ids):
+        return None, "ids 必须是整数数组"
+    return list(dict.fromkeys(ids)), None
+
+def fetch_owned_todos(c, user_id, todo_ids):
+    """分批查询属于该用户的任务，返回 id -> 任务"""
+    owned = {}
+    for i in range(0, len(todo_ids), 500):
+        chunk = todo_ids[i:i + 500]
+        c.execute(f'''SELECT * FROM todos
+                      WHERE user_id = ? AND id IN ({','.join('?' * len(chunk))})''', [user_id] + chunk)
+        owned.update((todo['id'], todo) for todo in c.fetchall())
+    return owned
+
+def enqueue_batch_summaries(title, todos_by_robot, lines):
+    """批量操作后每个机器人只发送一条汇总通知"""
+    china_time = get_china_time()
+    for robot_id, todos in todos_by_robot.items():
+        message = f"{title}\n\n用户: {g.api_user['username']}\n数量: {len(todos)}\n时间: {china_time.strftime('%Y-%m-%d %H:%M:%S')} (中国时间)\n\n"
+        message += '\n'.join(lines(todo) for todo in todos)
+        enqueue_wechat_message(truncate_utf8(message, WECOM_MESSAGE_MAX_BYTES['text']), robot_id)
+
+@app.route('/api/v1/todos', methods=['GET'])
+@api_login_required
+def api_list_todos():
+    """分页列出任务（与首页相同的筛选参数和游标，archived=1 时包含已归档任务）"""
+    c = get_db().cursor()
+    c.row_factory = dict_factory
+    where, params, filters = build_todo_filters(g.api_user['id'], request.args)
+    per_page = min(max(request.args.get('per_page', TODO_PAGE_SIZE, type=int), 1), TODO_PAGE_SIZE_MAX)
+    
+    cursor = request.args.get('cursor', '')
+    position = decode_page_cursor(cursor) if cursor else None
+    if position:
+        where += ' AND (t.created_at < ? OR (t.created_at = ? AND t.id < ?))'
+        params += [position[0], position[0], position[1]]
+    
+    source, source_params = todo_list_source(filters, where, params, per_page + 1)
+    columns = 't.completed_at, t.archived' if filters.get('archived') else 't.completed_at'
+    c.execute(f'''SELECT t.id, t.title, t.description, t.due_date, t.priority, t.status, t.robot_id,
+                  t.notification_time, t.timezone, t.created_at, t.next_fire_at, {columns}
+                  FROM {source} WHERE {where}
+                  ORDER BY t.created_at DESC, t.id DESC LIMIT ?''', source_params + params + [per_page + 1])
+    todos = c.fetchall()
+    
+    next_cursor = None
+    if len(todos) > per_page:
+        todos = todos[:per_page]
+        next_cursor = encode_page_cursor(todos[-1])
+    
+    return json_response({"success": True, "todos": todos, "next_cursor": next_cursor})
+
+@app.route('/api/v1/todos/search', methods=['GET'])
+@api_login_required
+def api_search_todos():
+    """全文搜索任务（q 为搜索词，page/per_page 分页，筛选参数与列表相同），按相关度排序并返回高亮"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return json_response({"success": False, "error": "q 不能为空"}, 400)
+    if request.args.get('archived') == '1':
+        return json_response({"success": False, "error": SEARCH_ARCHIVED_ERROR}, 400)
+    page, per_page = get_search_page_args(request.args)
+    todos, has_next, mode, _ = search_todos(get_db(), g.api_user['id'], query, request.args, page, per_page)
+    return json_response({"success": True, "todos": todos, "mode": mode, "page": page,
+                          "next_page": page + 1 if has_next else None})
+
+@app.route('/api/v1/todos', methods=['POST'])
+@api_login_required
+def api_create_todos():
+    """批量创建任务（单个事务），每个机器人发送一条汇总通知"""
+    items, error = get_api_items('todos')
+    if error:
+        return json_response({"success": False, "error": error}, 400)
+    
+    user = g.api_user
+    reminder_settings = get_reminder_settings()
+    results = [None] * len(items)
+    rows = []
+    valid = []
+    for index, item in enumerate(items):
+        fields, error = validate_todo_fields(item)
+        if error:
+            results[index] = {"index": index, "success": False, "error": error}
+            continue
+        fields.update(status='pending', timezone=user['timezone'])
+        fire_utc = compute_next_fire_at(fields, reminder_settings)
+        fields['next_fire_at'] = fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None
+        notify_utc_minute, notify_offset = compute_notify_utc_minute(fields['notification_time'], user['timezone'])
+        rows.append((fields['title'], fields['description'], fields['due_date'], fields['priority'],
+                     fields['robot_id'], fields['notification_time'], user['id'], user['timezone'],
+                     fields['next_fire_at'], notify_utc_minute, notify_offset))
+        valid.append((index, fields))
+    
+    if rows:
+        conn = get_db()
+        # IMMEDIATE 事务持有写锁，AUTOINCREMENT 保证这一批 id 连续
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'todos'").fetchone()
+            first_id = (row[0] if row else 0) + 1
+            conn.executemany('''INSERT INTO todos (title, description, due_date, priority, robot_id,
+                                notification_time, user_id, timezone, next_fire_at, notify_utc_minute, notify_utc_offset)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            last_id = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'todos'").fetchone()[0]
+            if last_id - first_id + 1 != len(rows):
+                raise RuntimeError("批量插入的任务 id 不连续")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            web_logger.error(f"批量创建任务失败: {e}")
+            return json_response({"success": False, "error": f"批量创建失败: {e}"}, 500)
+        
+        todos_by_robot = {}
+        for offset, (index, fields) in enumerate(valid):
+            todo_id = first_id + offset
+            fields['id'] = todo_id
+            results[index] = {"index": index, "success": True, "id": todo_id}
+            push_reminder_heap(todo_id, fields['next_fire_at'])
+            todos_by_robot.setdefault(fields['robot_id'], []).append(fields)
+        
+        enqueue_batch_summaries("✅ 批量创建待办事项", todos_by_robot,
+                                lambda todo: f"• {todo['title']} (截止: {todo['due_date'] or '无'}, 优先级: {todo['priority']})")
+    
+    created = len(rows)
+    return json_response({"success": created == len(items), "created": created, "results": results},
+                         201 if created else 400)
+
+@app.route('/api/v1/todos', methods=['PATCH'])
+@api_login_required
+def api_update_todos():
+    """批量更新任务（只修改提供的字段），提醒状态随之重置"""
+    items, error = get_api_items('todos')
+    if error:
+        return json_response({"success": False, "error": error}, 400)
+    
+    user = g.api_user
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    todo_ids = [item['id'] for item in items if isinstance(item, dict) and is_api_int(item.get('id'))]
+    owned = fetch_owned_todos(c, user['id'], todo_ids)
+    
+    reminder_settings = get_reminder_settings()
+    results = []
+    updates = {}
+    for index, item in enumerate(items):
+        todo_id = item.get('id') if isinstance(item, dict) else None
+        if not is_api_int(todo_id):
+            results.append({"index": index, "success": False, "id": None, "error": "id 必须是整数"})
+            continue
+        if todo_id not in owned:
+            results.append({"index": index, "success": False, "id": todo_id, "error": "任务不存在或无权限修改"})
+            continue
+        fields, error = validate_todo_fields(item, partial=True)
+        if error:
+            results.append({"index": index, "success": False, "id": todo_id, "error": error})
+            continue
+        todo = dict(owned[todo_id], **fields)
+        fire_utc = compute_next_fire_at(todo, reminder_settings)
+        todo['next_fire_at'] = fire_utc.strftime(FIRE_TIME_FORMAT) if fire_utc else None
+        todo['notify_utc_minute'], todo['notify_utc_offset'] = compute_notify_utc_minute(todo['notification_time'], todo['timezone'])
+        owned[todo_id] = todo
+        updates[todo_id] = todo
+        results.append({"index": index, "success": True, "id": todo_id})
+    
+    if updates:
+        try:
+            c.executemany('DELETE FROM reminder_logs WHERE todo_id = ?', [(todo_id,) for todo_id in updates])
+            c.executemany('''UPDATE todos SET title = ?, description = ?, due_date = ?, priority = ?,
+                             robot_id = ?, notification_time = ?, reminder_sent = '', next_fire_at = ?,
+                             notify_utc_minute = ?, notify_utc_offset = ?
+                             WHERE id = ? AND user_id = ?''',
+                          [(t['title'], t['description'], t['due_date'], t['priority'], t['robot_id'],
+                            t['notification_time'], t['next_fire_at'], t['notify_utc_minute'],
+                            t['notify_utc_offset'], t['id'], user['id'])
+                           for t in updates.values()])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            web_logger.error(f"批量更新任务失败: {e}")
+            return json_response({"success": False, "error": f"批量更新失败: {e}"}, 500)
+        
+        for todo in updates.values():
+            push_reminder_heap(todo['id'], todo['next_fire_at'])
+    
+    return json_response({"success": len(updates) == len(items), "updated": len(updates), "results": results})
+
+@app.route('/api/v1/todos/complete', methods=['POST'])
+@api_login_required
+def api_complete_todos():
+    """批量完成任务，每个机器人发送一条汇总通知"""
+    todo_ids, error = get_api_ids()
+    if error:
+        return json_response({"success": False, "error": error}, 400)
+    
+    user = g.api_user
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    owned = fetch_owned_todos(c, user['id'], todo_ids)
+    completed = [owned[todo_id] for todo_id in todo_ids
+                 if todo_id in owned and owned[todo_id]['status'] != 'completed']
+    
+    if completed:
+        try:
+            c.executemany('DELETE FROM reminder_logs WHERE todo_id = ?', [(todo['id'],) for todo in completed])
+            c.executemany('''UPDATE todos SET status = 'completed', next_fire_at = NULL, completed_at = CURRENT_TIMESTAMP
+                             WHERE id = ? AND user_id = ?''', [(todo['id'], user['id']) for todo in completed])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            web_logger.error(f"批量完成任务失败: {e}")
+            return json_response({"success": False, "error": f"批量完成失败: {e}"}, 500)
+        
+        todos_by_robot = {}
+        for todo in completed:
+            todos_by_robot.setdefault(todo['robot_id'] or 1, []).append(todo)
+        enqueue_batch_summaries("🎉 批量完成待办事项", todos_by_robot, lambda todo: f"• {todo['title']}")
+    
+    results = []
+    for todo_id in todo_ids:
+        if todo_id not in owned:
+            results.append({"id": todo_id, "success": False, "error": "任务不存在或无权限操作"})
+        else:
+            results.append({"id": todo_id, "success": True})
+    return json_response({"success": len(owned) == len(todo_ids), "completed": len(completed), "results": results})
+
+@app.route('/api/v1/todos', methods=['DELETE'])
+@api_login_required
+def api_delete_todos():
+    """批量删除任务"""
+    todo_ids, error = get_api_ids()
+    if error:
+        return json_response({"success": False, "error": error}, 400)
+    
+    user = g.api_user
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = dict_factory
+    owned = fetch_owned_todos(c, user['id'], todo_ids)
     
-    # 启动提醒检查线程
+    if owned:
+        try:
+            c.executemany('DELETE FROM reminder_logs WHERE todo_id = ?', [(todo_id,) for todo_id in owned])
+            c.executemany('DELETE FROM todos WHERE id = ? AND user_id = ?', [(todo_id, user['id']) for todo_id in owned])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            web_logger.error(f"批量删除任务失败: {e}")
+            return json_response({"success": False, "error": f"批量删除失败: {e}"}, 500)
+    
+    results = []
+    for todo_id in todo_ids:
+        if todo_id not in owned:
+            results.append({"id": todo_id, "success": False, "error": "任务不存在或无权限删除"})
+        else:
+            results.append({"id": todo_id, "success": True})
+    return json_response({"success": len(owned) == len(todo_ids), "deleted": len(owned), "results": results})
+
+def start_background_workers():
+    """启动提醒调度线程和消息发送队列（每个进程调用一次）
+    
+    多进程部署（如 gunicorn）时在每个 worker 中调用，例如 gunicorn.conf.py：
+        def post_fork(server, worker):
+            import app
+            app.init_db()
+            app.start_background_workers()
+    所有进程都处理 HTTP 请求，只有获得调度器租约的进程执行提醒调度。
+    多个 worker 写同一个日志文件时设置 TODO_LOG_ROTATION=external 并由 logrotate 轮转，
+    或设置 TODO_LOG_FILE=app.{pid}.log 让每个进程写自己的文件。
+    """
+    global background_workers_started
+    if background_workers_started:
+        return
+    background_workers_started = True
+    
+    # 启动租约心跳线程和提醒检查线程
+    heartbeat_thread = threading.Thread(target=run_lease_heartbeat, daemon=True)
+    heartbeat_thread.start()
     reminder_thread = threading.Thread(target=check_reminders, daemon=True)
     reminder_thread.start()
     
+    # 启动消息发送队列
+    start_notification_workers()
+    
+    # 启动数据保留维护线程
+    maintenance_thread = threading.Thread(target=run_maintenance, daemon=True)
+    maintenance_thread.start()
+    
+    atexit.register(release_scheduler_lease)
+
+if __name__ == '__main__':
+    init_db()
+    
+    start_background_workers()
+    
     app.run(host='0.0.0.0', port=8081, debug=True)
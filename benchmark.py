@@ -0,0 +1,475 @@
+"""提醒引擎基准测试
+
+生成合成数据（用户、机器人、任务、提醒日志，混合时区和截止日期），用本地 HTTP 服务模拟企业微信 webhook，
+测量调度周期耗时、每周期 SQL 语句数、消息发送速率以及 / 和 /debug_reminders 的 p50/p99 延迟。
+结果写入 JSON 文件，可以和其他提交的结果对比。
+
+用法:
+    python benchmark.py --todos 10000
+    python benchmark.py --todos 1000000 --cycles 3 --output before.json
+    python benchmark.py --todos 100000 --compare before.json
+
+数据库和 app.log 写在临时目录中（--workdir 可指定），不会影响当前目录下的数据。
+
+支持的提交范围：从“按 UTC 分钟索引通知时间”（todos.notify_utc_minute，ddbf74f）开始的提交。
+基准直接调用 run_due_reminders、push_reminder_heap、compute_notify_utc_minute 等调度接口并写入
+迁移 001-013 增加的列，更早的提交缺少这些接口，启动时检查后报错退出。接口签名的后续变化按签名适配：
+run_due_reminders 早期需要 today_str 参数，rebuild_reminder_schedule 后来增加了 require_lease 参数。
+只在某些提交上存在的指标（如 shard_skew）在其他提交上记为 null，对比时跳过。
+"""
+import argparse
+import inspect
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytz
+
+# 任务时区分布：(时区, 权重)
+TIMEZONES = [
+    ('Asia/Shanghai', 60),
+    ('America/New_York', 12),
+    ('Europe/London', 10),
+    ('Asia/Tokyo', 10),
+    ('Australia/Sydney', 5),
+    ('America/Los_Angeles', 3),
+]
+NOTIFICATION_TIMES = ['09:00', '09:30', '10:00', '10:30', '14:00', '17:30']
+PRIORITIES = ['low', 'medium', 'high']
+INSERT_BATCH = 10000
+
+todo_app = None  # 设置好环境变量后再导入 app
+
+# 基准依赖的 app 接口，缺少任何一个说明提交早于支持范围
+REQUIRED_APIS = ('db_connection', 'init_db', 'get_reminder_settings', 'rebuild_reminder_schedule', 'load_reminder_heap',
+                 'run_due_reminders', 'push_reminder_heap', 'compute_next_fire_at', 'compute_notify_utc_minute',
+                 'get_timezone', 'scheduler_stats', 'renew_scheduler_lease', 'start_notification_workers',
+                 'enqueue_wechat_message', 'get_notification_queue_stats', 'ConnectionPool')
+
+
+def check_supported_commit():
+    """检查当前提交的 app 是否提供基准需要的接口，返回缺少的接口名"""
+    return [name for name in REQUIRED_APIS if not hasattr(todo_app, name)]
+
+
+def accepts_parameter(func, name):
+    return name in inspect.signature(func).parameters
+
+
+def run_due_cycle(minute_start_utc, reminder_settings):
+    """执行一个调度周期，兼容 run_due_reminders 需要 today_str 参数的早期提交"""
+    if accepts_parameter(todo_app.run_due_reminders, 'today_str'):
+        today_str = todo_app.get_china_time().strftime('%Y-%m-%d')
+        return todo_app.run_due_reminders(minute_start_utc, reminder_settings, today_str)
+    return todo_app.run_due_reminders(minute_start_utc, reminder_settings)
+
+
+def rebuild_schedule(reminder_settings):
+    """重建调度；基准测试不启动调度线程，支持 require_lease 的提交上不检查调度器租约"""
+    if accepts_parameter(todo_app.rebuild_reminder_schedule, 'require_lease'):
+        return todo_app.rebuild_reminder_schedule(reminder_settings, require_lease=False)
+    return todo_app.rebuild_reminder_schedule(reminder_settings)
+
+
+class StubWeComHandler(BaseHTTPRequestHandler):
+    """模拟企业微信机器人 webhook：等待 latency 秒后返回 errcode 0"""
+    latency = 0.0
+    received = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.latency:
+            time.sleep(self.latency)
+        with StubWeComHandler.lock:
+            StubWeComHandler.received += 1
+        body = b'{"errcode": 0, "errmsg": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StatementCounter:
+    """通过 sqlite3 trace 回调统计执行的 SQL 语句数"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, statement):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+def install_statement_counter(counter):
+    """连接池新建的每个连接都挂上语句计数回调"""
+    original_connect = todo_app.ConnectionPool._connect
+
+    def connect(pool):
+        conn = original_connect(pool)
+        conn.set_trace_callback(counter)
+        return conn
+
+    todo_app.ConnectionPool._connect = connect
+
+
+def start_stub_server(latency_ms):
+    StubWeComHandler.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubWeComHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, pct):
+    """最近秩百分位数"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def latency_summary(samples_ms):
+    return {
+        "count": len(samples_ms),
+        "mean_ms": round(sum(samples_ms) / len(samples_ms), 3) if samples_ms else None,
+        "p50_ms": round(percentile(samples_ms, 50), 3) if samples_ms else None,
+        "p99_ms": round(percentile(samples_ms, 99), 3) if samples_ms else None,
+        "max_ms": round(max(samples_ms), 3) if samples_ms else None,
+    }
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def generate_dataset(args, rng, stub_url):
+    """生成用户、机器人、任务和历史提醒日志，返回 (用户列表, 待处理任务 id 列表, 耗时)"""
+    start = time.perf_counter()
+    weights = [w for _, w in TIMEZONES]
+    zones = [tz for tz, _ in TIMEZONES]
+    today = datetime.now(pytz.utc).date()
+
+    with todo_app.db_connection() as conn:
+        c = conn.cursor()
+        user_count = max(1, args.todos // args.todos_per_user)
+        users = [(f'bench_user_{i}', todo_app.hash_password('bench'), rng.choices(zones, weights)[0])
+                 for i in range(user_count)]
+        c.executemany('INSERT INTO users (username, password_hash, timezone) VALUES (?, ?, ?)', users)
+        c.execute("SELECT id, username, timezone FROM users WHERE username LIKE 'bench_user_%' ORDER BY id")
+        users = c.fetchall()
+
+        c.execute('UPDATE robots SET webhook_url = ?', (f'{stub_url}/robot/1',))
+        c.executemany('INSERT INTO robots (name, webhook_url, description) VALUES (?, ?, ?)',
+                      [(f'压测机器人{i}', f'{stub_url}/robot/{i}', 'benchmark') for i in range(2, args.robots + 1)])
+        c.execute('SELECT id FROM robots WHERE is_active = 1')
+        robot_ids = [row[0] for row in c.fetchall()]
+        conn.commit()
+
+        created_base = datetime.now() - timedelta(days=90)
+        for offset in range(0, args.todos, INSERT_BATCH):
+            rows = []
+            for i in range(offset, min(offset + INSERT_BATCH, args.todos)):
+                user_id, _, timezone = users[i % len(users)]
+                due = today + timedelta(days=rng.randint(-10, 60))
+                rows.append((
+                    f'压测任务 {i}',
+                    '合成数据' * rng.randint(0, 20),
+                    due.strftime('%Y-%m-%d') if rng.random() < 0.95 else None,
+                    rng.choice(PRIORITIES),
+                    'pending' if rng.random() < 0.8 else 'completed',
+                    rng.choice(robot_ids),
+                    rng.choice(NOTIFICATION_TIMES) if rng.random() < 0.8 else f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}',
+                    user_id,
+                    timezone,
+                    (created_base + timedelta(seconds=i * 7)).strftime('%Y-%m-%d %H:%M:%S'),
+                ))
+            c.executemany('''INSERT INTO todos (title, description, due_date, priority, status, robot_id,
+                             notification_time, user_id, timezone, created_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+            conn.commit()
+
+        c.execute("SELECT id FROM todos WHERE status = 'pending' AND due_date IS NOT NULL")
+        pending_ids = [row[0] for row in c.fetchall()]
+
+        # 约 10% 的待处理任务带有最近 7 天的历史提醒记录
+        logs = []
+        for todo_id in rng.sample(pending_ids, len(pending_ids) // 10):
+            for _ in range(rng.randint(1, 3)):
+                sent = datetime.now() - timedelta(days=rng.randint(0, 6), minutes=rng.randint(0, 1439))
+                key = f"{todo_id}_{sent.strftime('%Y-%m-%d')}_{sent.hour:02d}_{sent.minute:02d}_daily_7"
+                logs.append((todo_id, key, 'daily', rng.randint(0, 7), sent.strftime('%Y-%m-%d %H:%M:%S')))
+        c.executemany('''INSERT OR IGNORE INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before, sent_at)
+                         VALUES (?, ?, ?, ?, ?)''', logs)
+        conn.commit()
+
+    return users, pending_ids, time.perf_counter() - start
+
+
+def wait_for_minute_headroom(seconds):
+    """本分钟剩余时间不足时等到下一分钟，避免调度周期跨分钟"""
+    now = datetime.now(pytz.utc)
+    if 60 - now.second - now.microsecond / 1e6 < seconds:
+        time.sleep(60 - now.second - now.microsecond / 1e6 + 0.05)
+
+
+def schedule_batch_for_minute(todo_ids, minute_start_utc, reminder_settings, rng):
+    """把一批任务的截止日期放进每日提醒范围，通知时间改为本分钟（各自时区的本地时间）"""
+    with todo_app.db_connection() as conn:
+        c = conn.cursor()
+        c.row_factory = todo_app.dict_factory
+        updates = []
+        for i in range(0, len(todo_ids), 500):
+            chunk = todo_ids[i:i + 500]
+            c.execute(f'''SELECT id, status, COALESCE(timezone, 'Asia/Shanghai') AS timezone
+                          FROM todos WHERE id IN ({','.join('?' * len(chunk))})''', chunk)
+            for todo in c.fetchall():
+                local = minute_start_utc.astimezone(todo_app.get_timezone(todo['timezone']))
+                todo['notification_time'] = local.strftime('%H:%M')
+                todo['due_date'] = (local.date() + timedelta(days=rng.randint(0, 7))).strftime('%Y-%m-%d')
+                fire_utc = todo_app.compute_next_fire_at(todo, reminder_settings, minute_start_utc)
+                next_fire_at = fire_utc.strftime(todo_app.FIRE_TIME_FORMAT) if fire_utc else None
+                notify_utc_minute, offset = todo_app.compute_notify_utc_minute(todo['notification_time'], todo['timezone'])
+                updates.append((todo['notification_time'], todo['due_date'], next_fire_at,
+                                notify_utc_minute, offset, todo['id']))
+        c.executemany('''UPDATE todos SET notification_time = ?, due_date = ?, next_fire_at = ?,
+                         notify_utc_minute = ?, notify_utc_offset = ? WHERE id = ?''', updates)
+        conn.commit()
+
+    for _, _, next_fire_at, _, _, todo_id in updates:
+        todo_app.push_reminder_heap(todo_id, next_fire_at)
+
+
+def queue_depth():
+    stats = todo_app.get_notification_queue_stats()
+    return stats.get('pending', 0) + stats.get('sending', 0)
+
+
+def bench_cycles(args, rng, pending_ids, counter):
+    """每个周期挑一批任务放到本分钟触发，测量 run_due_reminders 的耗时和 SQL 语句数"""
+    reminder_settings = todo_app.get_reminder_settings()
+    candidates = rng.sample(pending_ids, min(len(pending_ids), args.due_per_cycle * args.cycles))
+    cycles = []
+    for cycle in range(args.cycles):
+        batch = candidates[cycle * args.due_per_cycle:(cycle + 1) * args.due_per_cycle]
+        if not batch:
+            break
+        wait_for_minute_headroom(args.minute_headroom)
+        minute_start_utc = datetime.now(pytz.utc).replace(second=0, microsecond=0)
+        schedule_batch_for_minute(batch, minute_start_utc, reminder_settings, rng)
+
+        counter.reset()
+        start = time.perf_counter()
+        processed, sent = run_due_cycle(minute_start_utc, reminder_settings)
+        elapsed = time.perf_counter() - start
+        last_cycle = todo_app.scheduler_stats.get('last_cycle') or {}
+        cycles.append({
+            "due": len(batch),
+            "processed": processed,
+            "sent": sent,
+            "duration_ms": round(elapsed * 1000, 3),
+            "queries": counter.count,
+            "deferred": last_cycle.get('deferred'),
+            "shard_skew": last_cycle.get('shard_skew'),
+        })
+
+    durations = [cycle['duration_ms'] for cycle in cycles]
+    return {
+        "cycles": cycles,
+        "duration": latency_summary(durations),
+        "queries_per_cycle": round(sum(c['queries'] for c in cycles) / len(cycles), 1) if cycles else None,
+        "reminders_per_sec": round(sum(c['sent'] for c in cycles) / (sum(durations) / 1000), 1) if durations and sum(durations) else None,
+    }
+
+
+def bench_routes(args, users, counter):
+    """用 Flask 测试客户端测量页面延迟（登录为任务最多的压测用户）"""
+    user_id, username, timezone = users[0]
+    client = todo_app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+        sess['username'] = username
+        sess['timezone'] = timezone
+
+    routes = [
+        ('index', '/', args.route_iterations),
+        ('index_filtered', '/?status=pending&priority=high', args.route_iterations),
+        ('api_list', '/api/v1/todos', args.route_iterations),
+        ('debug_reminders', '/debug_reminders', args.debug_iterations),
+    ]
+    results = {}
+    for name, path, iterations in routes:
+        response = client.get(path)  # 预热
+        if response.status_code != 200:
+            results[name] = {"error": f"HTTP {response.status_code}"}
+            continue
+        samples = []
+        counter.reset()
+        for _ in range(iterations):
+            start = time.perf_counter()
+            client.get(path)
+            samples.append((time.perf_counter() - start) * 1000)
+        results[name] = latency_summary(samples)
+        results[name]["queries_per_request"] = round(counter.count / iterations, 1) if iterations else None
+    return results
+
+
+def bench_sends(args):
+    """启动发送线程，测量把队列（周期产生的提醒 + 额外消息）发完的速率"""
+    with todo_app.db_connection() as conn:
+        robot_ids = [row[0] for row in conn.execute('SELECT id FROM robots WHERE is_active = 1')]
+    for i in range(args.messages):
+        todo_app.enqueue_wechat_message(f'压测消息 {i}', robot_ids[i % len(robot_ids)])
+
+    depth = queue_depth()
+    received_before = StubWeComHandler.received
+    todo_app.renew_scheduler_lease()
+    start = time.perf_counter()
+    todo_app.start_notification_workers()
+    deadline = start + args.send_timeout
+    while queue_depth() and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    delivered = StubWeComHandler.received - received_before
+    return {
+        "queued": depth,
+        "delivered": delivered,
+        "remaining": queue_depth(),
+        "seconds": round(elapsed, 3),
+        "sends_per_sec": round(delivered / elapsed, 1) if elapsed else None,
+    }
+
+
+def flatten(data, prefix=''):
+    """把嵌套结果展开成 {"a.b.c": 数值}，便于对比（列表中的逐周期明细不参与对比）"""
+    items = {}
+    if isinstance(data, dict):
+        for key, value in data.items():
+            items.update(flatten(value, f'{prefix}{key}.'))
+    elif isinstance(data, (int, float)) and not isinstance(data, bool):
+        items[prefix[:-1]] = data
+    return items
+
+
+def compare_results(baseline, current):
+    """打印与基准结果相比变化的指标"""
+    old = flatten(baseline['results'])
+    new = flatten(current['results'])
+    print(f"\n对比 {baseline['commit']} -> {current['commit']}")
+    for key in sorted(set(old) & set(new)):
+        before, after = old[key], new[key]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+        print(f"  {key:<45} {before:>12} -> {after:<12} {change}")
+
+
+def main():
+    global todo_app
+    parser = argparse.ArgumentParser(description='提醒引擎基准测试')
+    parser.add_argument('--todos', type=int, default=10000, help='任务数量（10k-1M）')
+    parser.add_argument('--todos-per-user', type=int, default=1000)
+    parser.add_argument('--robots', type=int, default=10)
+    parser.add_argument('--cycles', type=int, default=5, help='调度周期次数')
+    parser.add_argument('--due-per-cycle', type=int, default=1000, help='每个周期触发的任务数')
+    parser.add_argument('--minute-headroom', type=float, default=15, help='本分钟剩余秒数不足时等到下一分钟')
+    parser.add_argument('--route-iterations', type=int, default=50)
+    parser.add_argument('--debug-iterations', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=500, help='发送测试额外入队的消息数')
+    parser.add_argument('--send-timeout', type=float, default=120)
+    parser.add_argument('--webhook-latency-ms', type=float, default=20, help='模拟 webhook 的响应延迟')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workdir', help='数据库和日志目录（默认临时目录）')
+    parser.add_argument('--log-level', default='WARNING', help='测试期间 app 的日志级别')
+    parser.add_argument('--output', help='结果 JSON 文件（默认 benchmark-<commit>-<todos>.json）')
+    parser.add_argument('--compare', help='与之前的结果 JSON 对比')
+    args = parser.parse_args()
+
+    commit = get_commit()
+    output = os.path.abspath(args.output or f'benchmark-{commit}-{args.todos}.json')
+    compare = os.path.abspath(args.compare) if args.compare else None
+
+    # app 在导入时读取环境变量并在当前目录创建 app.log
+    workdir = args.workdir or tempfile.mkdtemp(prefix='todo-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    os.environ['TODO_DB_PATH'] = os.path.join(workdir, 'todolist.db')
+    os.environ.setdefault('TODO_WECOM_RATE_LIMIT', '100000')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as todo_app
+    import logging
+    missing = check_supported_commit()
+    if missing:
+        sys.exit(f"当前提交 {commit} 早于基准支持的范围（缺少 {', '.join(missing)}），见 benchmark.py 开头的说明")
+    logging.getLogger().setLevel(args.log_level)
+
+    counter = StatementCounter()
+    install_statement_counter(counter)
+    server = start_stub_server(args.webhook_latency_ms)
+    stub_url = f'http://127.0.0.1:{server.server_port}'
+    rng = random.Random(args.seed)
+
+    print(f"工作目录: {workdir}")
+    todo_app.init_db()
+    users, pending_ids, generate_seconds = generate_dataset(args, rng, stub_url)
+    print(f"生成数据: {args.todos} 个任务, {len(users)} 个用户, 耗时 {generate_seconds:.1f}秒")
+
+    start = time.perf_counter()
+    rebuild_schedule(todo_app.get_reminder_settings())
+    rebuild_seconds = time.perf_counter() - start
+    todo_app.load_reminder_heap(datetime.now(pytz.utc).replace(second=0, microsecond=0))
+    print(f"重建调度: {rebuild_seconds:.2f}秒")
+
+    cycle = bench_cycles(args, rng, pending_ids, counter)
+    print(f"调度周期: p50 {cycle['duration']['p50_ms']}ms, p99 {cycle['duration']['p99_ms']}ms, "
+          f"每周期 {cycle['queries_per_cycle']} 条 SQL")
+    routes = bench_routes(args, users, counter)
+    for name, summary in routes.items():
+        print(f"{name}: p50 {summary.get('p50_ms')}ms, p99 {summary.get('p99_ms')}ms")
+    sends = bench_sends(args)
+    print(f"发送: {sends['delivered']} 条, {sends['sends_per_sec']} 条/秒")
+
+    result = {
+        "commit": commit,
+        "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "python": sys.version.split()[0],
+        "params": {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'workdir')},
+        "results": {
+            "generate_seconds": round(generate_seconds, 3),
+            "rebuild_seconds": round(rebuild_seconds, 3),
+            "cycle": cycle,
+            "routes": routes,
+            "sends": sends,
+        },
+    }
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入: {output}")
+
+    if compare:
+        with open(compare, encoding='utf-8') as f:
+            compare_results(json.load(f), result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+"""测试公共配置：导入 app 前把数据库和日志指向临时目录"""
+import os
+import sys
+import tempfile
+
+TEST_DIR = tempfile.mkdtemp(prefix='todo-test-')
+os.environ['TODO_DB_PATH'] = os.path.join(TEST_DIR, 'todolist.db')
+os.environ['TODO_LOG_FILE'] = os.path.join(TEST_DIR, 'app.log')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,141 @@
+"""evaluate_due_reminders（单条 SQL 判断到期提醒）与逐条任务判断路径的一致性测试
+
+参照实现按原来的逐条处理流程：任务时区的本地时间精确匹配通知时间，用本地日期计算到期天数，
+should_send_reminder 判断规则，按原格式生成提醒key，再查 reminder_logs 是否已发送。
+与最初版本唯一的区别是发送失败（status = 'failed'）的提醒记录允许重新发送。
+"""
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import app as todo_app
+
+TIMEZONES = ['Asia/Shanghai', 'America/New_York', 'Europe/London', 'Asia/Kolkata',
+             'Australia/Adelaide', 'Pacific/Kiritimati', 'Pacific/Pago_Pago']
+
+# 各时区本地日期不同的时刻、夏令时切换当天、跨年和中国时间跨天前后
+INSTANTS = [
+    datetime(2026, 3, 1, 15, 30),
+    datetime(2026, 3, 8, 7, 30),
+    datetime(2026, 4, 4, 16, 45),
+    datetime(2026, 10, 25, 1, 15),
+    datetime(2026, 12, 31, 23, 45),
+    datetime(2027, 1, 1, 0, 0),
+]
+
+DUE_OFFSETS = range(-3, 40)
+
+
+@pytest.fixture
+def conn():
+    todo_app.init_db()
+    with todo_app.db_connection() as conn:
+        conn.execute('DELETE FROM reminder_logs')
+        conn.execute('DELETE FROM todos')
+        conn.commit()
+        yield conn
+
+
+def insert_todo(conn, title, due_date, notification_time, timezone, now_utc, status='pending'):
+    notify_utc_minute, offset = todo_app.compute_notify_utc_minute(notification_time, timezone, now_utc)
+    return conn.execute('''INSERT INTO todos (title, due_date, priority, status, robot_id, notification_time,
+                           user_id, timezone, notify_utc_minute, notify_utc_offset)
+                           VALUES (?, ?, 'medium', ?, 1, ?, 1, ?, ?, ?)''',
+                        (title, due_date, status, notification_time, timezone, notify_utc_minute, offset)).lastrowid
+
+
+def seed_todos(conn, now_utc):
+    """每个时区生成通知时间为本地当前分钟、到期日分布在各提醒规则范围内的任务，以及不应提醒的任务"""
+    for timezone in TIMEZONES:
+        local = now_utc.astimezone(pytz.timezone(timezone))
+        notification_time = local.strftime('%H:%M')
+        for offset in DUE_OFFSETS:
+            due_date = (local.date() + timedelta(days=offset)).strftime('%Y-%m-%d')
+            insert_todo(conn, f'{timezone} {offset}', due_date, notification_time, timezone, now_utc)
+        due_date = (local.date() + timedelta(days=1)).strftime('%Y-%m-%d')
+        other_time = (local + timedelta(minutes=1)).strftime('%H:%M')
+        insert_todo(conn, f'{timezone} 其他时间', due_date, other_time, timezone, now_utc)
+        insert_todo(conn, f'{timezone} 已完成', due_date, notification_time, timezone, now_utc, status='completed')
+        insert_todo(conn, f'{timezone} 无截止日期', None, notification_time, timezone, now_utc)
+    conn.commit()
+
+
+def reference_due_reminders(conn, now_utc, today_str, reminder_settings):
+    """逐条任务判断，返回 {(任务id, 提醒key, 提醒类型, 匹配天数, 到期天数)}"""
+    expected = set()
+    rows = conn.execute('''SELECT id, due_date, notification_time, COALESCE(timezone, 'Asia/Shanghai')
+                           FROM todos WHERE status = 'pending' AND due_date IS NOT NULL''').fetchall()
+    for todo_id, due_date, notification_time, timezone in rows:
+        task_now = now_utc.astimezone(pytz.timezone(timezone))
+        if notification_time != task_now.strftime('%H:%M'):
+            continue
+        days_until_due = (datetime.strptime(due_date, '%Y-%m-%d').date() - task_now.date()).days
+        should_remind, reminder_type, trigger_days = todo_app.should_send_reminder(days_until_due, reminder_settings)
+        if not should_remind:
+            continue
+        if reminder_type == 'daily':
+            reminder_key = f"{todo_id}_{today_str}_{task_now.hour:02d}_{task_now.minute:02d}_daily_{trigger_days}"
+        else:
+            reminder_key = f"{todo_id}_once_{days_until_due}days"
+        log = conn.execute('SELECT status FROM reminder_logs WHERE todo_id = ? AND reminder_key = ?',
+                           (todo_id, reminder_key)).fetchone()
+        if log and log[0] != 'failed':
+            continue
+        expected.add((todo_id, reminder_key, reminder_type, trigger_days, days_until_due))
+    return expected
+
+
+def evaluated(conn, now_utc, today_str):
+    return {(row['id'], row['reminder_key'], row['reminder_type'], row['trigger_days'], row['days_until_due'])
+            for row in todo_app.evaluate_due_reminders(conn, today_str, now_utc)}
+
+
+@pytest.mark.parametrize('instant', INSTANTS, ids=lambda instant: instant.strftime('%Y%m%d-%H%M'))
+def test_matches_per_todo_path(conn, instant):
+    now_utc = pytz.utc.localize(instant)
+    today_str = now_utc.astimezone(todo_app.CHINA_TZ).strftime('%Y-%m-%d')
+    reminder_settings = todo_app.get_reminder_settings()
+    seed_todos(conn, now_utc)
+
+    expected = reference_due_reminders(conn, now_utc, today_str, reminder_settings)
+    assert {item[2] for item in expected} == {'daily', 'once'}
+    assert evaluated(conn, now_utc, today_str) == expected
+
+    # 已发送的提醒被排除，发送失败的重新发送，其他key（如前一天的每日提醒）不影响判断
+    logs = []
+    for index, (todo_id, reminder_key, reminder_type, trigger_days, _) in enumerate(sorted(expected)):
+        if index % 3 == 0:
+            logs.append((todo_id, reminder_key, reminder_type, trigger_days, 'sent'))
+        elif index % 3 == 1:
+            logs.append((todo_id, reminder_key, reminder_type, trigger_days, 'failed'))
+        else:
+            logs.append((todo_id, reminder_key.replace(today_str, '2000-01-01'), reminder_type, trigger_days, 'sent'))
+    conn.executemany('''INSERT INTO reminder_logs (todo_id, reminder_key, reminder_type, days_before, status)
+                        VALUES (?, ?, ?, ?, ?)''', logs)
+    conn.commit()
+
+    expected_after_logs = reference_due_reminders(conn, now_utc, today_str, reminder_settings)
+    assert len(expected_after_logs) < len(expected)
+    assert evaluated(conn, now_utc, today_str) == expected_after_logs
+
+
+def test_todo_ids_limit_evaluation(conn):
+    """传入 todo_ids 时只判断这些任务，超过分块大小时分多次查询"""
+    now_utc = pytz.utc.localize(INSTANTS[0])
+    today_str = now_utc.astimezone(todo_app.CHINA_TZ).strftime('%Y-%m-%d')
+    seed_todos(conn, now_utc)
+    expected = reference_due_reminders(conn, now_utc, today_str, todo_app.get_reminder_settings())
+
+    ids = sorted({item[0] for item in expected})
+    subset = ids[::2]
+    rows = todo_app.evaluate_due_reminders(conn, today_str, now_utc, subset)
+    assert {row['id'] for row in rows} == set(subset)
+
+    chunk_size = todo_app.REMINDER_EVALUATE_CHUNK_SIZE
+    todo_app.REMINDER_EVALUATE_CHUNK_SIZE = 7
+    try:
+        rows = todo_app.evaluate_due_reminders(conn, today_str, now_utc, ids)
+    finally:
+        todo_app.REMINDER_EVALUATE_CHUNK_SIZE = chunk_size
+    assert {(row['id'], row['reminder_key']) for row in rows} == {item[:2] for item in expected}
@@ -0,0 +1,36 @@
+"""SQL 提醒规则（reminder_rule_ctes）与 should_send_reminder 的一致性测试"""
+import pytest
+
+import app as todo_app
+
+
+@pytest.fixture(scope='module')
+def conn():
+    todo_app.init_db()
+    with todo_app.db_connection() as conn:
+        yield conn
+
+
+def test_sample_settings_match(conn):
+    """CLI check-reminder-rules 使用的全部设置组合"""
+    mismatches = todo_app.check_reminder_rule_equivalence(conn, todo_app.reminder_rule_check_settings())
+    assert mismatches == []
+
+
+def test_active_settings_match(conn):
+    """数据库中当前启用的默认设置"""
+    current = [row[0] for row in conn.execute('SELECT days_before FROM reminder_settings WHERE is_active = 1')]
+    assert current
+    assert todo_app.check_reminder_rule_equivalence(conn, [current]) == []
+
+
+@pytest.mark.parametrize('settings, days_range', [
+    ([1, 3, 7], range(-3, 9)),          # 每日提醒：≤7 天取最接近的设置
+    ([0, 2, 5], range(-3, 9)),
+    ([7], range(0, 9)),
+    ([15, 30], range(7, 62)),           # 单次提醒：>7 天只在精确匹配当天
+    ([8, 10, 14], range(7, 16)),
+    ([3, 7, 8, 30], range(-1, 35)),     # 每日与单次混合
+])
+def test_daily_and_once_boundaries(conn, settings, days_range):
+    assert todo_app.check_reminder_rule_equivalence(conn, [settings], days_range) == []